@@ -0,0 +1,312 @@
+# api.py
+# API HTTP de sólo lectura (JSON) sobre las funciones de lectura de db
+#
+# Uso:
+#   python api.py --puerto 8502
+#
+#   GET /tickets?estado=NUEVO,ASIGNADO&area_destino=IT&limit=100&after=0
+#   GET /tickets/<id>
+#   GET /tickets/<id>/tasks
+#   GET /tickets/<id>/logs
+#   GET /catalogs
+#   GET /catalogs/<codigo>
+#
+# Pensada para integraciones que hoy leen la interfaz de Streamlit. Las listas
+# se paginan por clave (after = último id recibido, next_after en la
+# respuesta). Cada respuesta lleva un ETag calculado a partir de las versiones
+# de las filas (id + version, versión de maestras, último id del historial);
+# con If-None-Match igual se responde 304 sin cuerpo. Si GESTAR_API_TOKEN está
+# definido se exige "Authorization: Bearer <token>".
+
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import math
+import os
+import re
+from datetime import date, datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+import db
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PAGE = 100
+MAX_PAGE = 500
+TICKET_FILTERS = [
+    "estado",
+    "area_destino",
+    "responsable_asignado",
+    "prioridad",
+    "categoria",
+    "division",
+    "planta",
+]
+
+
+class ApiError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date, pd.Timestamp)):
+        return value.isoformat()
+    if hasattr(value, "item"):
+        return value.item()
+    return str(value)
+
+
+def _clean(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return None
+    if value is pd.NaT:
+        return None
+    return value
+
+
+def _records(df):
+    return [{k: _clean(v) for k, v in row.items()} for row in df.to_dict(orient="records")]
+
+
+def _etag(*parts):
+    raw = json.dumps(parts, default=_json_default, sort_keys=True)
+    return '"' + hashlib.sha1(raw.encode("utf-8")).hexdigest() + '"'
+
+
+def _int_param(query, name, default=None):
+    values = query.get(name)
+    if not values:
+        return default
+    try:
+        return int(values[0])
+    except ValueError:
+        raise ApiError(400, f"'{name}' debe ser un entero")
+
+
+def _ticket_id(match):
+    return int(match.group(1))
+
+
+# --- RECURSOS ---
+# Cada handler recibe (match, query) y retorna (etag, loader): el ETag sale de
+# una consulta liviana (ids y versiones, cantidad y último id) y loader lee el
+# cuerpo sólo si el cliente no tiene ya esa versión. loader retorna (etag,
+# cuerpo) con el ETag recalculado de lo que leyó: el cuerpo nunca viaja con el
+# ETag de una versión anterior.
+
+
+def list_tickets(match, query):
+    filters = {}
+    for key in TICKET_FILTERS:
+        values = [v for raw in query.get(key, []) for v in raw.split(",") if v]
+        if values:
+            filters[key] = values if len(values) > 1 else values[0]
+    after = _int_param(query, "after", 0)
+    limit = max(1, min(_int_param(query, "limit", DEFAULT_PAGE), MAX_PAGE))
+    include_archived = query.get("archivados", ["0"])[0] in ("1", "true")
+    fields = [f for raw in query.get("fields", []) for f in raw.split(",") if f]
+    if fields:
+        fields = list(dict.fromkeys(["id", "version"] + fields))
+
+    stamp = db.get_tickets_page(filters, after, limit, include_archived, columns=["id", "version"])
+    etag = _etag("tickets", fields, stamp["id"].tolist(), stamp["version"].tolist())
+
+    def _body():
+        df = db.get_tickets_page(filters, after, limit, include_archived, columns=fields or None)
+        next_after = int(df["id"].iloc[-1]) if len(df) == limit else None
+        return (
+            _etag("tickets", fields, df["id"].tolist(), df["version"].tolist()),
+            {"items": _records(df), "limit": limit, "next_after": next_after},
+        )
+
+    return etag, _body
+
+
+def get_ticket(match, query):
+    ticket = db.get_ticket_by_id(_ticket_id(match))
+    if ticket is None:
+        raise ApiError(404, "Ticket no encontrado")
+    etag = _etag("ticket", ticket["id"], ticket["version"], ticket["archivado"])
+    return etag, lambda: (etag, {k: _clean(v) for k, v in ticket.to_dict().items()})
+
+
+def ticket_tasks(match, query):
+    df = db.get_tasks_for_ticket(_ticket_id(match))
+    records = _records(df)
+    # Las tareas no tienen columna de versión: el ETag cubre sus valores
+    etag = _etag("tasks", records)
+    return etag, lambda: (etag, {"items": records})
+
+
+def ticket_logs(match, query):
+    ticket_id = _ticket_id(match)
+    # El historial sólo crece: alcanza con cantidad y último id
+    count, last_id = db.get_ticket_log_stamp(ticket_id)
+    etag = _etag("logs", count, last_id)
+
+    def _body():
+        df = db.get_ticket_logs(ticket_id)
+        last_id = df["id"].max() if not df.empty else None
+        return _etag("logs", len(df), _clean(last_id)), {"items": _records(df)}
+
+    return etag, _body
+
+
+def _catalog_items(snapshot, items):
+    return [
+        {
+            "id": it.id,
+            "label": it.label,
+            "sort_order": it.sort_order,
+            "activo": bool(it.is_active),
+            "children": _catalog_items(snapshot, snapshot.children(it, include_inactive=True)),
+        }
+        for it in items
+    ]
+
+
+def list_catalogs(match, query):
+    snapshot = db.get_catalog_snapshot()
+
+    def _body():
+        return {
+            "version": snapshot.version,
+            "catalogs": [
+                {"code": code, "label": snapshot.catalog(code)[1], "activo": bool(snapshot.catalog(code)[2])}
+                for code in snapshot.codes()
+            ],
+        }
+
+    etag = _etag("catalogs", snapshot.version)
+    return etag, lambda: (etag, _body())
+
+
+def get_catalog(match, query):
+    snapshot = db.get_catalog_snapshot()
+    code = match.group(1)
+    if snapshot.catalog(code) is None:
+        raise ApiError(404, "Catálogo no encontrado")
+
+    def _body():
+        return {
+            "code": code,
+            "version": snapshot.version,
+            "items": _catalog_items(snapshot, snapshot.items(code, include_inactive=True)),
+        }
+
+    etag = _etag("catalog", code, snapshot.version)
+    return etag, lambda: (etag, _body())
+
+
+ROUTES = [
+    (re.compile(r"^/tickets/?$"), list_tickets),
+    (re.compile(r"^/tickets/(\d+)/?$"), get_ticket),
+    (re.compile(r"^/tickets/(\d+)/tasks/?$"), ticket_tasks),
+    (re.compile(r"^/tickets/(\d+)/logs/?$"), ticket_logs),
+    (re.compile(r"^/catalogs/?$"), list_catalogs),
+    (re.compile(r"^/catalogs/([\w-]+)/?$"), get_catalog),
+]
+
+
+def _etag_matches(header, etag):
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    tags = [t.strip() for t in header.split(",")]
+    return etag in tags or f"W/{etag}" in tags
+
+
+def _resolve(handler, match, query, if_none_match):
+    """(etag, cuerpo) del recurso; cuerpo None si el cliente ya tiene esa versión."""
+    etag, loader = handler(match, query)
+    if _etag_matches(if_none_match, etag):
+        return etag, None
+    return loader()
+
+
+class ApiHandler(BaseHTTPRequestHandler):
+    server_version = "GestarAPI/1.0"
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        try:
+            self._check_auth()
+            if url.path in ("/health", "/health/"):
+                return self._send(200, {"status": "ok", **db.get_connection_status()})
+            for pattern, handler in ROUTES:
+                match = pattern.match(url.path)
+                if match:
+                    break
+            else:
+                raise ApiError(404, "Recurso no encontrado")
+            # Las lecturas (ETag y cuerpo) corren en el pool de db.fan_out:
+            # cada hilo tiene su conexión y la concurrencia queda acotada a
+            # GESTAR_FANOUT_WORKERS
+            etag, body = db.fan_out(
+                r=(_resolve, handler, match, parse_qs(url.query), self.headers.get("If-None-Match"))
+            )["r"]
+            if body is None:
+                return self._send(304, None, etag)
+            return self._send(200, body, etag)
+        except ApiError as e:
+            return self._send(e.status, {"error": str(e)})
+        except Exception as e:
+            logger.error(f"API: error en {url.path}: {e}")
+            return self._send(500, {"error": "Error interno"})
+
+    def _check_auth(self):
+        token = os.environ.get("GESTAR_API_TOKEN")
+        if token and not hmac.compare_digest(
+            self.headers.get("Authorization", "").encode("utf-8"), f"Bearer {token}".encode("utf-8")
+        ):
+            raise ApiError(401, "No autorizado")
+
+    def _send(self, status, body, etag=None):
+        payload = b"" if body is None else json.dumps(body, default=_json_default).encode("utf-8")
+        self.send_response(status)
+        if etag:
+            self.send_header("ETag", etag)
+            self.send_header("Cache-Control", "no-cache")
+        if body is not None:
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if payload:
+            self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        logger.info("API %s - %s", self.address_string(), format % args)
+
+
+def make_server(host="127.0.0.1", port=8502):
+    return ThreadingHTTPServer((host, port), ApiHandler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="API JSON de sólo lectura GESTAR")
+    parser.add_argument("--host", default=os.environ.get("GESTAR_API_HOST", "127.0.0.1"))
+    parser.add_argument("--puerto", type=int, default=int(os.environ.get("GESTAR_API_PORT", "8502")))
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    db.init_db()
+    server = make_server(args.host, args.puerto)
+    logger.info(f"API escuchando en http://{args.host}:{args.puerto}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -4,6 +4,7 @@
 
 import streamlit as st
 import db
+import scheduler
 import models
 
 # Configuración de la página
@@ -13,14 +14,16 @@ st.set_page_config(
 
 # Inicializar BD
 db.init_db()
+scheduler.start()
 
 # --- Sidebar: Simulación de Contexto ---
 st.sidebar.title("GESTAR")
 st.sidebar.markdown("### 👤 Simulación de Sesión")
 
-# Fetch users from DB
-df_users = db.get_users(only_active=True)
-user_names = df_users["nombre_completo"].tolist()
+# Fetch users from DB (en paralelo con las maestras)
+_header = db.fan_out(users=db.get_user_directory, catalogs=db.get_catalog_snapshot)
+users_dir = _header["users"]
+user_names = users_dir.names(only_active=True)
 
 if not user_names:
     st.sidebar.error("No hay usuarios activos en la DB.")
@@ -39,6 +42,16 @@ else:
     current_role = "Solicitante"
     current_area = "IT"
 
+# Maestras (una sola lectura, con fallback a las constantes de models)
+catalogs = _header["catalogs"]
+master_areas = catalogs.labels("areas") or models.AREAS
+master_prioridades = catalogs.labels("prioridades") or models.PRIORIDADES
+master_roles = catalogs.labels("roles") or models.ROLES
+master_categorias = catalogs.labels("categorias") or models.CATEGORIAS
+master_subcategorias = catalogs.subcategories_map() or models.SUBCATEGORIAS
+master_divisiones = catalogs.labels("divisiones") or models.DIVISIONES
+master_plantas = catalogs.labels("plantas") or models.PLANTAS
+
 st.sidebar.text_input("Rol", value=current_role, disabled=True)
 st.sidebar.text_input("Área", value=current_area, disabled=True)
 
@@ -56,8 +69,8 @@ def show_create_ticket():
         col1, col2 = st.columns(2)
         with col1:
             titulo = st.text_input("Título del Ticket*")
-            area = st.selectbox("Área Destino", models.AREAS)
-            urgencia = st.selectbox("Urgencia Sugerida", models.PRIORIDADES)
+            area = st.selectbox("Área Destino", master_areas)
+            urgencia = st.selectbox("Urgencia Sugerida", master_prioridades)
             solicitante = st.selectbox(
                 "Solicitante*",
                 user_names,
@@ -67,11 +80,11 @@ def show_create_ticket():
             )
 
         with col2:
-            categoria = st.selectbox("Categoría", models.CATEGORIAS)
-            sub_options = models.SUBCATEGORIAS.get(categoria, [])
+            categoria = st.selectbox("Categoría", master_categorias)
+            sub_options = master_subcategorias.get(categoria, [])
             subcategoria = st.selectbox("Subcategoría", sub_options)
-            division = st.selectbox("División", models.DIVISIONES)
-            planta = st.selectbox("Planta", models.PLANTAS)
+            division = st.selectbox("División", master_divisiones)
+            planta = st.selectbox("Planta", master_plantas)
             resp_sugerido = st.selectbox(
                 "Responsable Sugerido", ["Sin Sugerir"] + user_names
             )
@@ -104,8 +117,22 @@ def show_create_ticket():
                 st.success(f"Ticket creado exitosamente! ID: {ticket_id}")
 
 
+# Columnas de las tablas de bandeja: sólo éstas se leen de la base
+TABLE_COLUMNS = (
+    "id",
+    "titulo",
+    "estado",
+    "prioridad",
+    "area_destino",
+    "solicitante",
+    "updated_at",
+)
+
+
 def show_ticket_tray():
     st.header("📥 Bandeja de Tickets")
+    # Tickets abiertos en memoria (compartidos entre sesiones)
+    open_index = db.get_open_ticket_index()
 
     # Tabs para filtro rápido
     tab_cola, tab_asignados, tab_proceso, tab_cerrados, tab_todos = st.tabs(
@@ -121,40 +148,41 @@ def show_ticket_tray():
     # 1. Cola: Tickets NUEVOS de MI Área
     with tab_cola:
         st.caption(f"Tickets Nuevos para el área: {current_area}")
-        filters = {
-            "estado": "NUEVO",
-            "area_destino": current_area if current_role != "Director" else None,
-        }
-        df_cola = db.get_tickets(filters)
+        df_cola = open_index.query(
+            "NUEVO",
+            current_area if current_role != "Director" else None,
+            columns=TABLE_COLUMNS,
+        )
         render_ticket_table(df_cola, key_suffix="cola")
 
     # 2. Mis Asignados
     with tab_asignados:
-        filters = {
-            "responsable_asignado": current_user,
-            "estado": ["ASIGNADO", "EN PROCESO"],
-        }
-        df_my = db.get_tickets(filters)
+        df_my = open_index.query(
+            ["ASIGNADO", "EN PROCESO"],
+            responsable_asignado=current_user,
+            columns=TABLE_COLUMNS,
+        )
         render_ticket_table(df_my, key_suffix="my")
 
     # 3. En Proceso (Global o de Area)
     with tab_proceso:
-        f_area = st.selectbox("Filtrar Área", ["Todas"] + models.AREAS, key="fp_area")
-        filters = {"estado": ["ASIGNADO", "EN PROCESO"]}
-        if f_area != "Todas":
-            filters["area_destino"] = f_area
-        df_proc = db.get_tickets(filters)
+        f_area = st.selectbox("Filtrar Área", ["Todas"] + master_areas, key="fp_area")
+        df_proc = open_index.query(
+            ["ASIGNADO", "EN PROCESO"], f_area, columns=TABLE_COLUMNS
+        )
         render_ticket_table(df_proc, key_suffix="proc")
 
     # 4. Cerrados
     with tab_cerrados:
         filters = {"estado": ["RESUELTO", "CERRADO"]}
-        df_closed = db.get_tickets(filters)
+        df_closed = db.get_tickets(filters, columns=TABLE_COLUMNS)
         render_ticket_table(df_closed, key_suffix="closed")
 
     # 5. Todos (Busqueda)
     with tab_todos:
-        render_ticket_table(db.get_tickets(), show_filters=True, key_suffix="all")
+        render_ticket_table(
+            db.get_tickets(columns=TABLE_COLUMNS), show_filters=True, key_suffix="all"
+        )
 
 
 def render_ticket_table(df, show_filters=False, key_suffix=""):
@@ -163,17 +191,7 @@ def render_ticket_table(df, show_filters=False, key_suffix=""):
         return
 
     st.dataframe(
-        df[
-            [
-                "id",
-                "titulo",
-                "estado",
-                "prioridad",
-                "area_destino",
-                "solicitante",
-                "updated_at",
-            ]
-        ],
+        df[list(TABLE_COLUMNS)],
         width="stretch",
         hide_index=True,
     )
@@ -203,7 +221,13 @@ def show_ticket_detail():
         st.warning("Seleccione un ticket desde la Bandeja.")
         return
 
-    ticket = db.get_ticket_by_id(ticket_id)
+    # Cabecera, tareas e historial en paralelo
+    detail = db.fan_out(
+        ticket=(db.get_ticket_by_id, ticket_id),
+        tasks=(db.get_tasks_for_ticket, ticket_id),
+        logs=(db.get_ticket_logs, ticket_id),
+    )
+    ticket = detail["ticket"]
     if ticket is None:
         st.error(f"Ticket {ticket_id} no encontrado.")
         return
@@ -229,15 +253,33 @@ def show_ticket_detail():
         ):
             can_take = True
 
-    if can_take:
-        if st.button("🙋 Tomar Ticket (Autoasignar)"):
+    # Versión que el usuario tiene en pantalla (ver show_ticket_detail en app_v2)
+    ver_key = f"ticket_version_{ticket_id}"
+    submitting = st.session_state.get("take_ticket") or st.session_state.get(
+        "edit_ticket_submit"
+    )
+    if not submitting or ver_key not in st.session_state:
+        st.session_state[ver_key] = int(ticket["version"])
+
+    def _save(updates):
+        try:
             db.update_ticket(
                 ticket_id,
-                {"responsable_asignado": current_user, "estado": "ASIGNADO"},
+                updates,
                 author=current_user,
+                expected_version=st.session_state[ver_key],
             )
-            st.success("Ticket asignado a ti correctamente.")
-            st.rerun()
+        except db.ConcurrencyError as e:
+            st.session_state[ver_key] = int(ticket["version"])
+            st.error(str(e))
+            return False
+        return True
+
+    if can_take:
+        if st.button("🙋 Tomar Ticket (Autoasignar)", key="take_ticket"):
+            if _save({"responsable_asignado": current_user, "estado": "ASIGNADO"}):
+                st.success("Ticket asignado a ti correctamente.")
+                st.rerun()
 
     # --- EDICION DE CAMPOS ---
     with st.expander("📝 Editar / Gestionar", expanded=True):
@@ -251,9 +293,9 @@ def show_ticket_detail():
                 else:
                     new_prioridad = st.selectbox(
                         "Prioridad",
-                        models.PRIORIDADES,
-                        index=models.PRIORIDADES.index(ticket["prioridad"])
-                        if ticket["prioridad"] in models.PRIORIDADES
+                        master_prioridades,
+                        index=master_prioridades.index(ticket["prioridad"])
+                        if ticket["prioridad"] in master_prioridades
                         else 1,
                     )
 
@@ -291,19 +333,18 @@ def show_ticket_detail():
                     )
                     new_asignado = ticket["responsable_asignado"]
 
-            update_btn = st.form_submit_button("Guardar Cambios")
+            update_btn = st.form_submit_button("Guardar Cambios", key="edit_ticket_submit")
             if update_btn:
-                db.update_ticket(
-                    ticket_id,
+                saved = _save(
                     {
                         "prioridad": new_prioridad,
                         "estado": new_status,
                         "responsable_asignado": new_asignado,
-                    },
-                    author=current_user,
+                    }
                 )
-                st.success("Ticket actualizado")
-                st.rerun()
+                if saved:
+                    st.success("Ticket actualizado")
+                    st.rerun()
 
     # Detalles de solo lectura
     st.divider()
@@ -329,7 +370,7 @@ def show_ticket_detail():
     st.divider()
     st.subheader("📋 Tareas")
 
-    tasks = db.get_tasks_for_ticket(ticket_id)
+    tasks = detail["tasks"]
     if not tasks.empty:
         for idx, task in tasks.iterrows():
             col_t1, col_t2, col_t3 = st.columns([4, 2, 2])
@@ -343,7 +384,7 @@ def show_ticket_detail():
                 # Quick action
                 if task["estado"] != "COMPLETADA":
                     if st.button("✅", key=f"done_{task['id']}"):
-                        db.update_task_status(task["id"], "COMPLETADA")
+                        db.update_task_status(task["id"], "COMPLETADA", author=current_user)
                         st.rerun()
 
     with st.form("add_task"):
@@ -360,14 +401,14 @@ def show_ticket_detail():
             )
         if st.form_submit_button("Agregar"):
             if desc:
-                db.create_task(ticket_id, desc, resp)
+                db.create_task(ticket_id, desc, resp, author=current_user)
                 st.rerun()
 
     # --- HISTORIAL / COMENTARIOS ---
     st.divider()
     st.subheader("📜 Historial y Comentarios")
 
-    logs = db.get_ticket_logs(ticket_id)
+    logs = detail["logs"]
     if not logs.empty:
         for idx, log in logs.iterrows():
             with st.chat_message(
@@ -416,8 +457,8 @@ def show_admin():
             with st.form("add_user_form"):
                 new_name = st.text_input("Nombre Completo*")
                 new_email = st.text_input("Email")
-                new_role = st.selectbox("Rol", models.ROLES)
-                new_area = st.selectbox("Área", models.AREAS)
+                new_role = st.selectbox("Rol", master_roles)
+                new_area = st.selectbox("Área", master_areas)
 
                 if st.form_submit_button("Guardar Usuario"):
                     if new_name:
@@ -447,10 +488,10 @@ def show_admin():
                 ),
                 "email": st.column_config.TextColumn("Email"),
                 "rol": st.column_config.SelectboxColumn(
-                    "Rol", options=models.ROLES, required=True
+                    "Rol", options=master_roles, required=True
                 ),
                 "area": st.column_config.SelectboxColumn(
-                    "Área", options=models.AREAS, required=True
+                    "Área", options=master_areas, required=True
                 ),
                 "activo": st.column_config.CheckboxColumn("Activo"),
             },
@@ -465,15 +506,11 @@ def show_admin():
             edited = state.get("edited_rows", {})
 
             if edited:
-                for row_idx, updates in edited.items():
-                    idx = int(row_idx)
-                    user_id = int(df_all_users.iloc[idx]["id"])
-
-                    # Convert bool to int for SQLite
-                    if "activo" in updates:
-                        updates["activo"] = 1 if updates["activo"] else 0
-
-                    db.update_user(user_id, updates)
+                changes = {
+                    int(df_all_users.iloc[int(row_idx)]["id"]): updates
+                    for row_idx, updates in edited.items()
+                }
+                db.update_users_bulk(changes)
 
                 st.success("Cambios guardados.")
                 st.rerun()
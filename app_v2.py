@@ -1,7 +1,13 @@
 import streamlit as st
 import db
+import scheduler
 import models
+import exporter
 import base64
+import os
+import tempfile
+import pandas as pd
+from datetime import date, timedelta
 
 # Configuración de página
 st.set_page_config(
@@ -13,6 +19,7 @@ st.set_page_config(
 
 # Inicializar BD
 db.init_db()
+scheduler.start()
 
 
 # --- CACHE DE LECTURA ---
@@ -28,8 +35,12 @@ def _normalize_filters(filters):
     return tuple(normalized)
 
 
-@st.cache_data(ttl=30, show_spinner=False)
-def cached_get_tickets(filters_key):
+# Columnas que muestra render_v2_table: el resto no se lee ni se cachea
+TRAY_COLUMNS = ("id", "titulo", "estado", "prioridad", "area_destino", "updated_at")
+
+
+@db.cached_result(ttl=30)
+def cached_get_tickets(filters_key, include_archived=False, columns=TRAY_COLUMNS):
     filters = None
     if filters_key:
         filters = {}
@@ -37,7 +48,7 @@ def cached_get_tickets(filters_key):
             if isinstance(value, tuple):
                 value = list(value)
             filters[key] = value
-    return db.get_tickets(filters)
+    return db.get_tickets(filters, include_archived=include_archived, columns=columns)
 
 
 # --- LÓGICA DE NAVEGACIÓN POR QUERY PARAMS (Para Links Reales) ---
@@ -83,16 +94,21 @@ def get_base64_image(image_path):
 logo_base64 = get_base64_image("marca - Isologo Taranto.png")
 
 # --- DATA FETCHING ---
-df_users = db.get_users(only_active=True)
-user_names = df_users["nombre_completo"].tolist()
+# Usuarios y maestras son independientes: se cargan en paralelo
+_header = db.fan_out(users=db.get_user_directory, catalogs=db.get_catalog_snapshot)
+users_dir = _header["users"]
+user_names = users_dir.names(only_active=True)
 if not user_names:
     user_names = ["Invitado"]
 
-master_areas = db.get_master_items("areas") or models.AREAS
-master_prioridades = db.get_master_items("prioridades") or models.PRIORIDADES
-master_roles = db.get_master_items("roles") or models.ROLES
-master_categorias = db.get_master_items("categorias") or models.CATEGORIAS
-master_subcategorias = db.get_subcategories_map() or models.SUBCATEGORIAS
+catalogs = _header["catalogs"]
+master_areas = catalogs.labels("areas") or models.AREAS
+master_prioridades = catalogs.labels("prioridades") or models.PRIORIDADES
+master_roles = catalogs.labels("roles") or models.ROLES
+master_categorias = catalogs.labels("categorias") or models.CATEGORIAS
+master_subcategorias = catalogs.subcategories_map() or models.SUBCATEGORIAS
+master_divisiones = catalogs.labels("divisiones") or models.DIVISIONES
+master_plantas = catalogs.labels("plantas") or models.PLANTAS
 
 # --- FUNCIONES DE INTERFAZ REFACTORIZADAS ---
 
@@ -118,8 +134,8 @@ def show_create_ticket(u_names, c_user):
             categoria = st.selectbox("Categoría", master_categorias)
             sub_options = master_subcategorias.get(categoria, [])
             subcategoria = st.selectbox("Subcategoría", sub_options)
-            division = st.selectbox("División", models.DIVISIONES)
-            planta = st.selectbox("Planta", models.PLANTAS)
+            division = st.selectbox("División", master_divisiones)
+            planta = st.selectbox("Planta", master_plantas)
             resp_sugerido = st.selectbox(
                 "Responsable Sugerido", ["Sin Sugerir"] + u_names
             )
@@ -253,8 +269,7 @@ def render_v2_table(df, key_suffix=""):
 
         # Fecha corta
         updated_val = row["updated_at"]
-        if isinstance(updated_val, str) and len(updated_val) > 10:
-            updated_val = updated_val[:10]
+        updated_val = "" if pd.isna(updated_val) else f"{updated_val:%Y-%m-%d}"
         r_cols[5].markdown(
             f"<div class='v2-row-cell'>{updated_val}</div>",
             unsafe_allow_html=True,
@@ -319,35 +334,62 @@ def show_ticket_tray(c_area, c_role, c_user):
         "### <i class='bi bi-inbox'></i>Bandeja de Gestión",
         unsafe_allow_html=True,
     )
+    # COLA, MIS TICKETS y EN PROCESO (y sus badges) salen del índice de
+    # tickets abiertos en memoria; CERRADOS cuenta con ticket_counters
+    abiertos = ["ASIGNADO", "EN PROCESO"]
+    cerrados = ["RESUELTO", "CERRADO"]
+    open_index = db.get_open_ticket_index()
+    cola_area = c_area if c_role != "Director" else None
+    n_cola = open_index.count("NUEVO", cola_area)
+    n_asig = open_index.count(abiertos, responsable_asignado=c_user)
+    n_proc = open_index.count(abiertos)
+    n_cerr = db.get_ticket_count(cerrados)
+    # Vencidos: lectura por rango sobre el índice de due_at
+    df_venc = db.get_overdue_tickets(cola_area, columns=TRAY_COLUMNS)
+
     # Reordenado: BUSCADOR primero para que sea la seleccionada por defecto
-    t_all, t_cola, t_asig, t_proc, t_cerr = st.tabs(
-        ["BUSCADOR", "COLA", "MIS TICKETS", "EN PROCESO", "CERRADOS"]
+    t_all, t_cola, t_asig, t_proc, t_venc, t_cerr = st.tabs(
+        [
+            "BUSCADOR",
+            f"COLA ({n_cola})",
+            f"MIS TICKETS ({n_asig})",
+            f"EN PROCESO ({n_proc})",
+            f"VENCIDOS ({len(df_venc)})",
+            f"CERRADOS ({n_cerr})",
+        ]
     )
 
     with t_all:
-        render_v2_table(cached_get_tickets(None), "all")
+        # Búsqueda general: incluye tickets archivados
+        render_v2_table(cached_get_tickets(None, include_archived=True), "all")
 
     with t_cola:
-        f = {
-            "estado": "NUEVO",
-            "area_destino": c_area if c_role != "Director" else None,
-        }
-        render_v2_table(cached_get_tickets(_normalize_filters(f)), "cola")
+        render_v2_table(
+            open_index.query("NUEVO", cola_area, columns=TRAY_COLUMNS), "cola"
+        )
 
     with t_asig:
-        f = {"responsable_asignado": c_user, "estado": ["ASIGNADO", "EN PROCESO"]}
-        render_v2_table(cached_get_tickets(_normalize_filters(f)), "asig")
+        render_v2_table(
+            open_index.query(
+                abiertos, responsable_asignado=c_user, columns=TRAY_COLUMNS
+            ),
+            "asig",
+        )
 
     with t_proc:
         f_area = st.selectbox("Área", ["Todas"] + master_areas, key="v2_proc_area")
-        f = {"estado": ["ASIGNADO", "EN PROCESO"]}
-        if f_area != "Todas":
-            f["area_destino"] = f_area
-        render_v2_table(cached_get_tickets(_normalize_filters(f)), "proc")
+        render_v2_table(
+            open_index.query(abiertos, f_area, columns=TRAY_COLUMNS), "proc"
+        )
+
+    with t_venc:
+        render_v2_table(df_venc, "venc")
 
     with t_cerr:
-        f = {"estado": ["RESUELTO", "CERRADO"]}
-        render_v2_table(cached_get_tickets(_normalize_filters(f)), "cerr")
+        f = {"estado": cerrados}
+        render_v2_table(
+            cached_get_tickets(_normalize_filters(f), include_archived=True), "cerr"
+        )
 
 
 def show_ticket_detail(c_user, c_role, c_area, u_names):
@@ -359,20 +401,33 @@ def show_ticket_detail(c_user, c_role, c_area, u_names):
             st.rerun()
         return
 
-    ticket = db.get_ticket_by_id(tid)
+    # Cabecera, tareas e historial en paralelo
+    detail = db.fan_out(
+        ticket=(db.get_ticket_by_id, tid),
+        tasks=(db.get_tasks_for_ticket, tid),
+        logs=(db.get_ticket_logs, tid),
+    )
+    ticket = detail["ticket"]
     if ticket is None:
         st.error("Ticket no encontrado.")
         return
 
     st.markdown(f"### Ticket #{ticket['id']} - {ticket['titulo']}")
 
+    # Vencimiento según el SLA de la prioridad (UTC)
+    due = ""
+    if pd.notna(ticket.get("due_at")):
+        due = f" | <b>Vence:</b> {str(ticket['due_at'])[:16]} UTC"
+        if pd.notna(ticket.get("escalated_at")):
+            due += " <span style='color:#d52e25;'><b>VENCIDO</b></span>"
+
     # Header Info Card
     with st.container():
         st.markdown(
             f"""
         <div class='v2-card'>
             <div style='display:flex; justify-content:space-between;'>
-                <div><b>Estado:</b> {ticket["estado"]} | <b>Prioridad:</b> {ticket["prioridad"]}</div>
+                <div><b>Estado:</b> {ticket["estado"]} | <b>Prioridad:</b> {ticket["prioridad"]}{due}</div>
                 <div style='color:#156099;'><b>Solicitante:</b> {ticket["solicitante"]}</div>
             </div>
         </div>
@@ -380,23 +435,44 @@ def show_ticket_detail(c_user, c_role, c_area, u_names):
             unsafe_allow_html=True,
         )
 
+    # Los tickets archivados se muestran en modo sólo lectura
+    archived = bool(ticket.get("archivado", 0))
+    if archived:
+        st.info("Ticket archivado: sólo lectura.")
+
+    # Versión que el usuario tiene en pantalla: en el rerun de un envío se
+    # conserva la del render anterior (la lectura nueva puede traer cambios
+    # de otro usuario, que update_ticket rechaza con ConcurrencyError)
+    ver_key = f"v2_ticket_version_{tid}"
+    submitting = st.session_state.get("v2_take_ticket") or st.session_state.get(
+        "v2_edit_submit"
+    )
+    if not submitting or ver_key not in st.session_state:
+        st.session_state[ver_key] = int(ticket["version"])
+
+    def _save(updates):
+        try:
+            db.update_ticket(
+                tid, updates, author=c_user, expected_version=st.session_state[ver_key]
+            )
+        except db.ConcurrencyError as e:
+            st.session_state[ver_key] = int(ticket["version"])
+            st.error(str(e))
+            return
+        cached_get_tickets.clear()
+        st.rerun()
+
     # Actions
-    if ticket["estado"] == "NUEVO":
+    if ticket["estado"] == "NUEVO" and not archived:
         can_take = (c_role == "Director") or (
             c_role in ["Analista", "Jefe"] and ticket["area_destino"] == c_area
         )
         if can_take:
-            if st.button("🙋 TOMAR TICKET", type="primary"):
-                db.update_ticket(
-                    tid,
-                    {"responsable_asignado": c_user, "estado": "ASIGNADO"},
-                    author=c_user,
-                )
-                cached_get_tickets.clear()
-                st.rerun()
+            if st.button("🙋 TOMAR TICKET", type="primary", key="v2_take_ticket"):
+                _save({"responsable_asignado": c_user, "estado": "ASIGNADO"})
 
     # Management Form
-    with st.expander("GESTIÓN Y ASIGNACIÓN", expanded=True):
+    with st.expander("GESTIÓN Y ASIGNACIÓN", expanded=not archived):
         with st.form("v2_edit_ticket"):
             col1, col2, col3 = st.columns(3)
             with col1:
@@ -433,14 +509,10 @@ def show_ticket_detail(c_user, c_role, c_area, u_names):
                     )
                     asig = ticket["responsable_asignado"]
 
-            if st.form_submit_button("ACTUALIZAR TICKET"):
-                db.update_ticket(
-                    tid,
-                    {"prioridad": prio, "estado": stat, "responsable_asignado": asig},
-                    author=c_user,
-                )
-                cached_get_tickets.clear()
-                st.rerun()
+            if st.form_submit_button(
+                "ACTUALIZAR TICKET", disabled=archived, key="v2_edit_submit"
+            ):
+                _save({"prioridad": prio, "estado": stat, "responsable_asignado": asig})
 
     # Information Tabs
     t_desc, t_tasks, t_hist = st.tabs(["DESCRIPCIÓN", "TAREAS", "HISTORIAL"])
@@ -460,7 +532,7 @@ def show_ticket_detail(c_user, c_role, c_area, u_names):
             "#### <i class='bi bi-check2-square'></i>Tareas",
             unsafe_allow_html=True,
         )
-        tasks = db.get_tasks_for_ticket(tid)
+        tasks = detail["tasks"]
         h_t1, h_t2 = st.columns([5, 1])
         h_t1.markdown("**Tarea**")
         h_t2.markdown("**Completada**")
@@ -473,19 +545,20 @@ def show_ticket_detail(c_user, c_role, c_area, u_names):
                 value=checked,
                 key=f"v2_tk_{t['id']}",
                 label_visibility="collapsed",
+                disabled=archived,
             )
             if new_checked != checked:
                 new_status = "COMPLETADA" if new_checked else "PENDIENTE"
-                db.update_task_status(t["id"], new_status)
+                db.update_task_status(t["id"], new_status, author=c_user)
                 st.rerun()
 
         with st.form("v2_add_task"):
             c_a1, c_a2 = st.columns([3, 1])
             d = c_a1.text_input("Nueva Tarea")
             r = c_a2.selectbox("Resp.", u_names)
-            if st.form_submit_button("AGREGAR TAREA"):
+            if st.form_submit_button("AGREGAR TAREA", disabled=archived):
                 if d:
-                    db.create_task(tid, d, r)
+                    db.create_task(tid, d, r, author=c_user)
                     st.rerun()
 
     with t_hist:
@@ -493,7 +566,7 @@ def show_ticket_detail(c_user, c_role, c_area, u_names):
             "#### <i class='bi bi-chat-left-text'></i>Historial",
             unsafe_allow_html=True,
         )
-        logs = db.get_ticket_logs(tid)
+        logs = detail["logs"]
         for _, entry in logs.iterrows():
             with st.chat_message(
                 "user" if entry["event_type"] == "comment" else "assistant"
@@ -503,14 +576,128 @@ def show_ticket_detail(c_user, c_role, c_area, u_names):
 
         with st.form("v2_comment"):
             msg = st.text_area("Comentario")
-            if st.form_submit_button("ENVIAR"):
+            if st.form_submit_button("ENVIAR", disabled=archived):
                 if msg:
                     db.add_ticket_log(tid, c_user, "comment", msg)
                     st.rerun()
 
 
+def show_admin_sla():
+    st.markdown("#### Indicadores SLA")
+    dim_options = {
+        "Área": "area_destino",
+        "Categoría": "categoria",
+        "Prioridad": "prioridad",
+    }
+    c1, c2, c3 = st.columns([1, 1, 2])
+    desde = c1.date_input("Desde", date.today() - timedelta(days=30), key="v2_sla_desde")
+    hasta = c2.date_input("Hasta", date.today(), key="v2_sla_hasta")
+    dims = c3.multiselect(
+        "Agrupar por", list(dim_options), default=["Área"], key="v2_sla_dims"
+    )
+    # Sólo lee la tabla de rollups; se actualiza en segundo plano
+    df = db.get_sla_summary(desde, hasta, [dim_options[d] for d in dims])
+    if df.empty:
+        st.info("Sin datos para el período seleccionado.")
+    else:
+        for metric, label in db.SLA_METRICS.items():
+            st.markdown(f"##### {label}")
+            df_metric = df[df["metrica"] == metric].drop(columns=["metrica"])
+            if df_metric.empty:
+                st.caption("Sin eventos.")
+                continue
+            st.dataframe(df_metric, hide_index=True, use_container_width=True)
+
+    st.markdown("##### Tiempo en cada estado")
+    df_states = db.get_time_in_state(desde, hasta)
+    if df_states.empty:
+        st.caption("Sin transiciones en el período.")
+    else:
+        st.dataframe(df_states, hide_index=True, use_container_width=True)
+
+
+def show_admin_export():
+    st.markdown("#### Exportación de Datos")
+    c1, c2 = st.columns(2)
+    kind = c1.selectbox("Datos", sorted(exporter.EXPORTABLES), key="v2_export_kind")
+    fmt = c2.selectbox("Formato", exporter.FORMATS, key="v2_export_fmt")
+    if st.button("GENERAR EXPORTACIÓN", type="primary"):
+        # Se escribe por bloques a disco y se ofrece el archivo para descargar
+        # (un archivo propio por exportación: dos admins no se pisan)
+        previous = st.session_state.get("v2_export_file")
+        if previous and os.path.exists(previous[0]):
+            os.remove(previous[0])
+        fd, dest = tempfile.mkstemp(prefix=f"gestar_{kind}_", suffix=f".{fmt}")
+        os.close(fd)
+        with st.spinner("Exportando..."):
+            rows = exporter.export(kind, fmt, dest)
+        st.session_state["v2_export_file"] = (dest, kind, fmt, rows)
+
+    exported = st.session_state.get("v2_export_file")
+    if exported and os.path.exists(exported[0]):
+        dest, kind, fmt, rows = exported
+        st.caption(f"{rows} filas exportadas.")
+        with open(dest, "rb") as f:
+            st.download_button(
+                f"DESCARGAR {kind}.{fmt}",
+                data=f,
+                file_name=f"{kind}.{fmt}",
+                mime="text/csv" if fmt == "csv" else "application/octet-stream",
+            )
+
+
+def show_admin_maintenance():
+    st.markdown("#### Mantenimiento")
+    info = scheduler.status()
+    if info["this_process"] is None:
+        st.info("Scheduler desactivado en esta instancia (GESTAR_SCHEDULER=0).")
+    leader = info["leader"] or "Sin líder"
+    suffix = " (esta instancia)" if info["leader"] == info["this_process"] else ""
+    st.caption(f"Líder: {leader}{suffix} | Lease vence: {info['lease_expires_at']}")
+    if info["jobs"]:
+        st.dataframe(info["jobs"], hide_index=True, use_container_width=True)
+    st.markdown("##### Historial de ejecuciones")
+    df_runs = db.get_job_runs()
+    if df_runs.empty:
+        st.info("Todavía no hay ejecuciones registradas.")
+    else:
+        st.dataframe(df_runs, hide_index=True, use_container_width=True)
+    st.markdown("##### Outbox de eventos")
+    df_outbox = db.get_outbox_status()
+    if df_outbox.empty:
+        st.info("No hay sinks registrados (GESTAR_OUTBOX_SINKS).")
+    else:
+        st.dataframe(df_outbox, hide_index=True, use_container_width=True)
+
+
+def show_admin_cache():
+    st.markdown("#### Caché de resultados")
+    info = db.get_result_cache_info()
+    st.caption(f"En uso: {info['used_kb']} KB de {info['max_kb']} KB")
+    if info["stats"]:
+        st.dataframe(info["stats"], hide_index=True, use_container_width=True)
+    st.markdown("##### Entradas residentes")
+    if info["entries"]:
+        st.dataframe(info["entries"], hide_index=True, use_container_width=True)
+    else:
+        st.info("La caché está vacía.")
+    if st.button("VACIAR CACHÉ"):
+        db.clear_result_cache()
+        st.rerun()
+
+
 def show_admin():
-    tab_u, tab_a = st.tabs(["USUARIOS", "MAESTRAS"])
+    tab_u, tab_a, tab_s, tab_x, tab_m, tab_c = st.tabs(
+        ["USUARIOS", "MAESTRAS", "INDICADORES", "EXPORTAR", "MANTENIMIENTO", "CACHÉ"]
+    )
+    with tab_c:
+        show_admin_cache()
+    with tab_m:
+        show_admin_maintenance()
+    with tab_s:
+        show_admin_sla()
+    with tab_x:
+        show_admin_export()
     with tab_u:
         with st.expander("NUEVO USUARIO"):
             with st.form("v2_add_user"):
@@ -543,32 +730,10 @@ def show_admin():
             if "id" not in df_edit.columns:
                 st.error("No se pudo leer el ID de usuarios.")
             else:
-                editable_cols = [
-                    c for c in ["rol", "area", "email", "activo"] if c in df_all.columns
-                ]
-                df_all_by_id = df_all.set_index("id")
-                df_edit_by_id = df_edit.set_index("id")
-
-                def values_equal(a, b):
-                    if a != a and b != b:
-                        return True
-                    return a == b
-
-                updates_applied = 0
-                for uid in df_edit_by_id.index.intersection(df_all_by_id.index):
-                    updates = {}
-                    for col in editable_cols:
-                        if col not in df_edit_by_id.columns:
-                            continue
-                        old_val = df_all_by_id.at[uid, col]
-                        new_val = df_edit_by_id.at[uid, col]
-                        if not values_equal(old_val, new_val):
-                            if col == "activo":
-                                new_val = 1 if bool(new_val) else 0
-                            updates[col] = new_val
-                    if updates:
-                        db.update_user(uid, updates)
-                        updates_applied += 1
+                changes = db.diff_dataframes(
+                    df_all, df_edit, columns=["rol", "area", "email", "activo"]
+                )
+                updates_applied = db.update_users_bulk(changes)
                 if updates_applied:
                     st.success(f"Guardado ({updates_applied})")
                 else:
@@ -597,27 +762,12 @@ def show_admin():
             if "id" not in edited_df.columns:
                 st.error("No se pudo leer ID de maestra.")
                 return 0
-            editable_cols = ["label", "sort_order", "is_active"]
-            base_by_id = base_df.set_index("id")
-            edit_by_id = edited_df.set_index("id")
-            changes = 0
-            for item_id in edit_by_id.index.intersection(base_by_id.index):
-                updates = {}
-                for col in editable_cols:
-                    if col not in edit_by_id.columns:
-                        continue
-                    old_val = base_by_id.at[item_id, col]
-                    new_val = edit_by_id.at[item_id, col]
-                    if str(old_val) != str(new_val):
-                        if col == "sort_order":
-                            new_val = int(new_val)
-                        if col == "is_active":
-                            new_val = 1 if bool(new_val) else 0
-                        updates[col] = new_val
-                if updates:
-                    db.update_master_item(int(item_id), updates)
-                    changes += 1
-            return changes
+            changes = db.diff_dataframes(
+                base_df,
+                edited_df,
+                columns=["label", "sort_order", "is_active", "sla_hours"],
+            )
+            return db.update_master_items_bulk(changes)
 
         if selected_catalog_code != "categorias":
             with st.form("v2_master_add_item"):
@@ -645,8 +795,12 @@ def show_admin():
             if df_items.empty:
                 st.info("No hay items cargados en este catálogo.")
             else:
+                # Las prioridades llevan además el SLA en horas (vencimiento)
+                item_cols = ["id", "label", "sort_order", "is_active"]
+                if selected_catalog_code == "prioridades":
+                    item_cols.append("sla_hours")
                 df_edit_items = st.data_editor(
-                    df_items[["id", "label", "sort_order", "is_active"]],
+                    df_items[item_cols],
                     column_config={
                         "id": None,
                         "label": st.column_config.TextColumn("Valor"),
@@ -654,6 +808,12 @@ def show_admin():
                             "Orden", min_value=0, step=1
                         ),
                         "is_active": st.column_config.CheckboxColumn("Activo"),
+                        "sla_hours": st.column_config.NumberColumn(
+                            "SLA (horas)",
+                            min_value=0,
+                            step=1,
+                            help="Horas para resolver. Vacío o 0 = sin vencimiento.",
+                        ),
                     },
                     hide_index=True,
                     use_container_width=True,
@@ -7,6 +7,16 @@ import threading
 import logging
 import time
 import re
+import queue
+import atexit
+import sys
+import contextlib
+import copy
+import contextvars
+import functools
+import inspect
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
 
 # Configurar logging básico para capturar errores silenciosos
 logging.basicConfig(level=logging.INFO)
@@ -16,7 +26,7 @@ try:
     import pyodbc
 except ImportError:
     pyodbc = None
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from models import (
     CREATE_TICKETS_TABLE,
     CREATE_TASKS_TABLE,
@@ -27,6 +37,12 @@ from models import (
 DB_NAME = "gestar.db"
 _db_lock = threading.Lock()
 
+# Conexión a Azure SQL: timeout de login, antigüedad máxima sin verificar una
+# conexión cacheada y espera antes de reintentar tras un fallo (segundos).
+SQL_CONNECT_TIMEOUT = int(os.environ.get("GESTAR_SQL_CONNECT_TIMEOUT", "5"))
+SQL_PROBE_INTERVAL = int(os.environ.get("GESTAR_SQL_PROBE_INTERVAL", "15"))
+SQL_RETRY_INTERVAL = int(os.environ.get("GESTAR_SQL_RETRY_INTERVAL", "30"))
+
 # Whitelists para evitar inyección SQL por nombres de columnas
 ALLOWED_COLUMNS = {
     "tickets": [
@@ -48,6 +64,9 @@ ALLOWED_COLUMNS = {
         "created_at",
         "updated_at",
         "closed_at",
+        "due_at",
+        "escalated_at",
+        "version",
     ],
     "users": ["id", "nombre_completo", "email", "rol", "area", "activo"],
     "tasks": [
@@ -105,13 +124,10 @@ def _normalize_bool_attr(conn_str, key):
     return re.sub(pattern, _repl, conn_str)
 
 
-@st.cache_resource(show_spinner=False)
-def _get_cached_sql_conn(conn_str):
+def _connect_sql(conn_str):
     """
     Gestiona la conexión a SQL Server detectando el mejor driver disponible.
     """
-    import re
-
     # Normalizar valores booleanos inválidos para ODBC Driver 18
     conn_str = _normalize_bool_attr(conn_str, "Encrypt")
     conn_str = _normalize_bool_attr(conn_str, "TrustServerCertificate")
@@ -148,19 +164,19 @@ def _get_cached_sql_conn(conn_str):
                         r"(?i)Encrypt=(no|0|false)", "Encrypt=yes", conn_str
                     )
 
-        last_err = None
-        for attempt in range(3):
-            try:
-                return pyodbc.connect(conn_str)
-            except Exception as e:
-                last_err = e
-                masked = _mask_conn_str(conn_str)
-                logger.error(
-                    f"Error conectando con pyodbc (intento {attempt + 1}/3). Driver={sql_drivers[-1] if sql_drivers else 'N/A'}; ConnStr={masked}; Error={e}"
-                )
-                time.sleep(0.5 * (2**attempt))
-        if last_err:
-            raise last_err
+        # Un único intento con timeout corto: los reintentos los maneja el
+        # circuit breaker en segundo plano, nunca la sesión del usuario.
+        timeout = SQL_CONNECT_TIMEOUT
+        conn_str = re.sub(r"(?i);?\s*Connection Timeout\s*=\s*[^;]*", "", conn_str)
+        conn_str = conn_str.rstrip(";") + f";Connection Timeout={timeout};"
+        try:
+            return pyodbc.connect(conn_str, timeout=timeout)
+        except Exception as e:
+            masked = _mask_conn_str(conn_str)
+            logger.error(
+                f"Error conectando con pyodbc. Driver={sql_drivers[-1] if sql_drivers else 'N/A'}; ConnStr={masked}; Error={e}"
+            )
+            raise
 
     raise RuntimeError("No hay drivers disponibles (pyodbc) para conectar a SQL.")
 
@@ -173,29 +189,61 @@ def close_connection(conn):
     """
     En Streamlit, no queremos cerrar conexiones que están cacheadas con @st.cache_resource.
     Esta función solo cerrará si es estrictamente necesario (actualmente no cerramos nada cacheado).
+    Se llama desde los finally: si la consulta falló por desconexión de
+    Azure SQL, se avisa al circuit breaker para no seguir entregando esa conexión.
     """
     # En esta arquitectura, preferimos dejar que la caché maneje la vida de la conexión.
     # Si cerráramos una conexión SQLite cacheada, la aplicación daría error en la siguiente llamada.
+    error = sys.exc_info()[1]
+    if error is not None:
+        _report_sql_failure(conn, error)
     return
 
 
-def _get_lastrowid(cursor, conn):
-    last_id = None
-    try:
-        last_id = cursor.lastrowid
-    except Exception:
-        last_id = None
-    if last_id:
-        return int(last_id)
-    if _is_sql_server_conn(conn):
-        try:
-            cursor.execute("SELECT CAST(SCOPE_IDENTITY() AS INT)")
-            row = cursor.fetchone()
-            if row and row[0] is not None:
-                return int(row[0])
-        except Exception:
-            return None
-    return None
+# SQLSTATE de pyodbc que indican conexión perdida (08xxx) o timeout
+_DISCONNECT_STATES = ("08", "HYT00", "HYT01")
+
+
+def _report_sql_failure(conn, error):
+    """Si error es una desconexión de la conexión compartida, abre el circuito."""
+    if not _is_sql_server_conn(conn) or not getattr(error, "args", None):
+        return
+    state = str(error.args[0])
+    if not state.startswith(_DISCONNECT_STATES):
+        return
+    # El breaker del primario y el de la réplica ignoran conexiones ajenas
+    conn_str = _resolve_conn_str()
+    if conn_str:
+        _get_sql_breaker(conn_str).report_failure(conn, error)
+    target = _resolve_read_target()
+    if target is not None and target[0] == "sql":
+        _get_sql_breaker(target[1]).report_failure(conn, error)
+
+
+_SQLITE_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+
+def _insert_returning_id(cur, table, columns, values):
+    """
+    Inserta una fila y retorna su id en un solo viaje a la base:
+    OUTPUT INSERTED.id en SQL Server, RETURNING id en SQLite >= 3.35
+    (en versiones anteriores se usa cursor.lastrowid, que no consulta la base).
+    """
+    cols = ", ".join(columns)
+    marks = ", ".join(["?"] * len(columns))
+    if _is_sql_server_conn(cur.connection):
+        cur.execute(
+            f"INSERT INTO {table} ({cols}) OUTPUT INSERTED.id VALUES ({marks})",
+            values,
+        )
+        return int(cur.fetchone()[0])
+    if _SQLITE_RETURNING:
+        cur.execute(
+            f"INSERT INTO {table} ({cols}) VALUES ({marks}) RETURNING id", values
+        )
+        return int(cur.fetchone()[0])
+    cur.execute(f"INSERT INTO {table} ({cols}) VALUES ({marks})", values)
+    return int(cur.lastrowid)
 
 
 def _ensure_master_tables(conn, is_sql_server):
@@ -287,197 +335,1443 @@ def _ensure_master_tables(conn, is_sql_server):
             ON master_catalog_items(catalog_id, is_active, sort_order, label);
             """
         )
+    # Horas de SLA por item (se usa en prioridades)
+    _ensure_column(conn, is_sql_server, "master_catalog_items", "sla_hours", "INTEGER", "INT")
 
 
-def _ensure_catalog(cur, code, label):
-    cur.execute("SELECT id FROM master_catalogs WHERE code = ?", (code,))
-    row = cur.fetchone()
-    if row:
-        return int(row[0])
+def _ensure_column(conn, is_sql_server, table, column, sqlite_type, mssql_type):
+    """Agrega una columna a una tabla existente si todavía no existe."""
+    cur = conn.cursor()
+    if not is_sql_server:
+        cur.execute(f"PRAGMA table_info({table})")
+        columns = [col[1] for col in cur.fetchall()]
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {sqlite_type}")
+        return
+    # SQL Server: dynamic SQL para evitar errores de parseo si la tabla no existe
     cur.execute(
-        "INSERT INTO master_catalogs (code, label, is_active) VALUES (?, ?, 1)",
-        (code, label),
+        f"""
+        IF OBJECT_ID('{table}','U') IS NOT NULL
+        BEGIN
+        IF NOT EXISTS (SELECT 1 FROM sys.columns WHERE object_id = OBJECT_ID('{table}') AND name = '{column}')
+            BEGIN
+                EXEC sp_executesql N'ALTER TABLE {table} ADD {column} {mssql_type}';
+            END
+        END
+        """
     )
-    cur.execute("SELECT id FROM master_catalogs WHERE code = ?", (code,))
-    return int(cur.fetchone()[0])
 
 
-def _ensure_catalog_item(cur, catalog_id, label, sort_order, parent_item_id=None):
-    if parent_item_id is None:
+def _ensure_index(conn, is_sql_server, name, table, columns):
+    """Crea un índice (no único) si no existe."""
+    cur = conn.cursor()
+    if not is_sql_server:
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table}({columns})")
+        return
+    cur.execute(
+        f"""
+        IF NOT EXISTS (
+            SELECT 1 FROM sys.indexes
+            WHERE name = '{name}' AND object_id = OBJECT_ID('{table}')
+        )
+            EXEC sp_executesql N'CREATE INDEX {name} ON {table}({columns})';
+        """
+    )
+
+
+def _ensure_import_tables(conn, is_sql_server):
+    cur = conn.cursor()
+    if is_sql_server:
         cur.execute(
             """
-            SELECT id FROM master_catalog_items
-            WHERE catalog_id = ? AND label = ? AND parent_item_id IS NULL
-            """,
-            (catalog_id, label),
+            IF OBJECT_ID('import_jobs','U') IS NULL
+            CREATE TABLE import_jobs (
+                job_key NVARCHAR(100) NOT NULL PRIMARY KEY,
+                source NVARCHAR(500) NULL,
+                status NVARCHAR(20) NOT NULL DEFAULT 'EN CURSO',
+                rows_done INT NOT NULL DEFAULT 0,
+                rows_imported INT NOT NULL DEFAULT 0,
+                rows_rejected INT NOT NULL DEFAULT 0,
+                started_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+                updated_at DATETIME2 NULL
+            );
+            """
+        )
+        cur.execute(
+            """
+            IF OBJECT_ID('import_rejects','U') IS NULL
+            CREATE TABLE import_rejects (
+                job_key NVARCHAR(100) NOT NULL,
+                row_num INT NOT NULL,
+                reason NVARCHAR(MAX) NULL,
+                raw_json NVARCHAR(MAX) NULL,
+                CONSTRAINT PK_import_rejects PRIMARY KEY (job_key, row_num)
+            );
+            """
         )
     else:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS import_jobs (
+                job_key TEXT PRIMARY KEY,
+                source TEXT,
+                status TEXT NOT NULL DEFAULT 'EN CURSO',
+                rows_done INTEGER NOT NULL DEFAULT 0,
+                rows_imported INTEGER NOT NULL DEFAULT 0,
+                rows_rejected INTEGER NOT NULL DEFAULT 0,
+                started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP
+            );
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS import_rejects (
+                job_key TEXT NOT NULL,
+                row_num INTEGER NOT NULL,
+                reason TEXT,
+                raw_json TEXT,
+                PRIMARY KEY (job_key, row_num)
+            );
+            """
+        )
+
+
+def _ensure_rollup_tables(conn, is_sql_server):
+    cur = conn.cursor()
+    if is_sql_server:
         cur.execute(
             """
-            SELECT id FROM master_catalog_items
-            WHERE catalog_id = ? AND label = ? AND parent_item_id = ?
-            """,
-            (catalog_id, label, parent_item_id),
+            IF OBJECT_ID('sla_rollup','U') IS NULL
+            CREATE TABLE sla_rollup (
+                dia DATE NOT NULL,
+                area_destino NVARCHAR(150) NOT NULL,
+                categoria NVARCHAR(150) NOT NULL,
+                prioridad NVARCHAR(50) NOT NULL,
+                metrica NVARCHAR(20) NOT NULL,
+                n INT NOT NULL DEFAULT 0,
+                total_seconds FLOAT NOT NULL DEFAULT 0,
+                max_seconds FLOAT NOT NULL DEFAULT 0,
+                CONSTRAINT PK_sla_rollup
+                    PRIMARY KEY (dia, area_destino, categoria, prioridad, metrica)
+            );
+            """
         )
-    row = cur.fetchone()
-    if row:
-        item_id = int(row[0])
         cur.execute(
             """
-            UPDATE master_catalog_items
-            SET sort_order = ?, is_active = 1
-            WHERE id = ?
-            """,
-            (sort_order, item_id),
+            IF OBJECT_ID('rollup_state','U') IS NULL
+            CREATE TABLE rollup_state (
+                name NVARCHAR(50) NOT NULL PRIMARY KEY,
+                last_id INT NOT NULL DEFAULT 0,
+                updated_at DATETIME2 NULL
+            );
+            """
+        )
+    else:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS sla_rollup (
+                dia TEXT NOT NULL,
+                area_destino TEXT NOT NULL,
+                categoria TEXT NOT NULL,
+                prioridad TEXT NOT NULL,
+                metrica TEXT NOT NULL,
+                n INTEGER NOT NULL DEFAULT 0,
+                total_seconds REAL NOT NULL DEFAULT 0,
+                max_seconds REAL NOT NULL DEFAULT 0,
+                PRIMARY KEY (dia, area_destino, categoria, prioridad, metrica)
+            );
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS rollup_state (
+                name TEXT PRIMARY KEY,
+                last_id INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP
+            );
+            """
         )
-        return item_id
 
-    cur.execute(
-        """
-        INSERT INTO master_catalog_items (catalog_id, label, sort_order, is_active, parent_item_id)
-        VALUES (?, ?, ?, 1, ?)
-        """,
-        (catalog_id, label, sort_order, parent_item_id),
-    )
-    if parent_item_id is None:
+
+def _ensure_counter_tables(conn, is_sql_server):
+    cur = conn.cursor()
+    if is_sql_server:
         cur.execute(
             """
-            SELECT id FROM master_catalog_items
-            WHERE catalog_id = ? AND label = ? AND parent_item_id IS NULL
-            """,
-            (catalog_id, label),
+            IF OBJECT_ID('ticket_counters','U') IS NULL
+            CREATE TABLE ticket_counters (
+                estado NVARCHAR(50) NOT NULL,
+                area_destino NVARCHAR(150) NOT NULL,
+                responsable_asignado NVARCHAR(200) NOT NULL,
+                n INT NOT NULL DEFAULT 0,
+                CONSTRAINT PK_ticket_counters
+                    PRIMARY KEY (estado, area_destino, responsable_asignado)
+            );
+            """
         )
     else:
-        cur.execute(
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ticket_counters (
+                estado TEXT NOT NULL,
+                area_destino TEXT NOT NULL,
+                responsable_asignado TEXT NOT NULL,
+                n INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (estado, area_destino, responsable_asignado)
+            );
             """
-            SELECT id FROM master_catalog_items
-            WHERE catalog_id = ? AND label = ? AND parent_item_id = ?
-            """,
-            (catalog_id, label, parent_item_id),
         )
-    return int(cur.fetchone()[0])
 
 
-def _seed_master_data(conn):
-    from models import (
-        AREAS,
-        CATEGORIAS,
-        DIVISIONES,
-        PLANTAS,
-        PRIORIDADES,
-        ROLES,
-        SUBCATEGORIAS,
-    )
-
-    cur = conn.cursor()
-    catalog_values = {
-        "areas": AREAS,
-        "divisiones": DIVISIONES,
-        "plantas": PLANTAS,
-        "prioridades": PRIORIDADES,
-        "roles": ROLES,
-    }
-    for code, values in catalog_values.items():
-        catalog_id = _ensure_catalog(cur, code, MASTER_CATALOGS[code])
-        for idx, label in enumerate(values):
-            _ensure_catalog_item(cur, catalog_id, label, idx)
+# Columnas copiadas al archivo histórico (mismo orden en tabla activa y archivo)
+ARCHIVE_COLUMNS = {
+    "tickets": ALLOWED_COLUMNS["tickets"] + ["import_ref"],
+    "tasks": ALLOWED_COLUMNS["tasks"],
+    "ticket_log": [
+        "id", "ticket_id", "created_at", "author", "event_type", "message", "meta_json",
+        "field", "from_state", "to_state",
+    ],
+}
 
-    categorias_id = _ensure_catalog(cur, "categorias", MASTER_CATALOGS["categorias"])
-    categoria_item_ids = {}
-    for idx, categoria in enumerate(CATEGORIAS):
-        item_id = _ensure_catalog_item(cur, categorias_id, categoria, idx)
-        categoria_item_ids[categoria] = item_id
 
-    for categoria, subcategorias in SUBCATEGORIAS.items():
-        parent_id = categoria_item_ids.get(categoria)
-        if not parent_id:
-            continue
-        for idx, sub in enumerate(subcategorias):
-            _ensure_catalog_item(cur, categorias_id, sub, idx, parent_item_id=parent_id)
+def _ensure_archive_tables(conn, is_sql_server):
+    cur = conn.cursor()
+    if is_sql_server:
+        statements = [
+            """
+            IF OBJECT_ID('tickets_archive','U') IS NULL
+            CREATE TABLE tickets_archive (
+                id INT NOT NULL PRIMARY KEY,
+                titulo NVARCHAR(MAX) NOT NULL,
+                descripcion NVARCHAR(MAX) NULL,
+                area_destino NVARCHAR(255) NULL,
+                categoria NVARCHAR(255) NULL,
+                subcategoria NVARCHAR(255) NULL,
+                division NVARCHAR(255) NULL,
+                planta NVARCHAR(255) NULL,
+                prioridad NVARCHAR(50) NULL,
+                urgencia_sugerida NVARCHAR(50) NULL,
+                responsable_sugerido NVARCHAR(255) NULL,
+                responsable_asignado NVARCHAR(255) NULL,
+                estado NVARCHAR(50) NULL,
+                solicitante NVARCHAR(255) NULL,
+                created_by NVARCHAR(255) NULL,
+                created_at DATETIME2 NULL,
+                updated_at DATETIME2 NULL,
+                closed_at DATETIME2 NULL,
+                import_ref NVARCHAR(120) NULL,
+                archived_at DATETIME2 NOT NULL
+            );
+            """,
+            """
+            IF OBJECT_ID('tasks_archive','U') IS NULL
+            CREATE TABLE tasks_archive (
+                id INT NOT NULL PRIMARY KEY,
+                ticket_id INT NOT NULL,
+                descripcion NVARCHAR(MAX) NOT NULL,
+                responsable NVARCHAR(255) NULL,
+                estado NVARCHAR(50) NULL,
+                fecha_creacion DATETIME2 NULL
+            );
+            """,
+            """
+            IF OBJECT_ID('ticket_log_archive','U') IS NULL
+            CREATE TABLE ticket_log_archive (
+                id INT NOT NULL PRIMARY KEY,
+                ticket_id INT NOT NULL,
+                created_at DATETIME2 NULL,
+                author NVARCHAR(255) NULL,
+                event_type NVARCHAR(100) NULL,
+                message NVARCHAR(MAX) NULL,
+                meta_json NVARCHAR(MAX) NULL
+            );
+            """,
+        ]
+        for statement in statements:
+            cur.execute(statement)
+    else:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tickets_archive (
+                id INTEGER PRIMARY KEY,
+                titulo TEXT NOT NULL,
+                descripcion TEXT,
+                area_destino TEXT,
+                categoria TEXT,
+                subcategoria TEXT,
+                division TEXT,
+                planta TEXT,
+                prioridad TEXT,
+                urgencia_sugerida TEXT,
+                responsable_sugerido TEXT,
+                responsable_asignado TEXT,
+                estado TEXT,
+                solicitante TEXT,
+                created_by TEXT,
+                created_at TIMESTAMP,
+                updated_at TIMESTAMP,
+                closed_at TIMESTAMP,
+                import_ref TEXT,
+                archived_at TIMESTAMP NOT NULL
+            );
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS tasks_archive (
+                id INTEGER PRIMARY KEY,
+                ticket_id INTEGER NOT NULL,
+                descripcion TEXT NOT NULL,
+                responsable TEXT,
+                estado TEXT,
+                fecha_creacion TIMESTAMP
+            );
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ticket_log_archive (
+                id INTEGER PRIMARY KEY,
+                ticket_id INTEGER NOT NULL,
+                created_at TIMESTAMP,
+                author TEXT,
+                event_type TEXT,
+                message TEXT,
+                meta_json TEXT
+            );
+            """
+        )
+    _ensure_index(conn, is_sql_server, "IX_tasks_archive_ticket", "tasks_archive", "ticket_id")
+    _ensure_index(
+        conn, is_sql_server, "IX_ticket_log_archive_ticket", "ticket_log_archive", "ticket_id"
+    )
+    _ensure_index(conn, is_sql_server, "IX_tickets_estado_closed", "tickets", "estado, closed_at")
+    _ensure_transition_columns(conn, is_sql_server, "ticket_log_archive")
+    # Purga de historial por tipo de evento y antigüedad (purge_ticket_logs)
+    for table in ("ticket_log", "ticket_log_archive"):
+        _ensure_index(
+            conn, is_sql_server, f"IX_{table}_type_created", table, "event_type, created_at"
+        )
+    _ensure_due_columns(conn, is_sql_server, "tickets_archive")
+    _ensure_version_column(conn, is_sql_server, "tickets_archive")
 
+    # Vistas de lectura (activos + archivo). archivado distingue el origen.
+    for table, columns in ARCHIVE_COLUMNS.items():
+        cols = ", ".join(columns)
+        _ensure_view(
+            conn,
+            is_sql_server,
+            f"{table}_all",
+            f"SELECT {cols}, 0 AS archivado FROM {table} "
+            f"UNION ALL SELECT {cols}, 1 AS archivado FROM {table}_archive",
+        )
 
-@st.cache_resource(show_spinner="Conectando a DB...")
-def _get_connection_cached(conn_str):
-    """Crea y retorna una conexión a la base de datos (Azure SQL o SQLite)."""
-    if conn_str:
-        try:
-            conn = _get_cached_sql_conn(conn_str)
-            try:
-                conn.execute("SELECT 1")
-            except Exception:
-                _get_cached_sql_conn.clear()
-                conn = _get_cached_sql_conn(conn_str)
-            return conn
-        except Exception as e:
-            # Silenciamos el warning en la UI para evitar mensajes redundantes.
-            # El error ya queda registrado en los logs del servidor.
-            logger.info(f"Azure SQL no disponible, usando SQLite: {e}")
 
-    # Fallback a SQLite local
-    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
-    # Habilitar foreign keys (Solo SQLite)
-    conn.execute("PRAGMA foreign_keys = ON")
-    return conn
+def _ensure_transition_columns(conn, is_sql_server, table):
+    """Columnas tipadas de las transiciones (campo, valor anterior y nuevo)."""
+    _ensure_column(conn, is_sql_server, table, "field", "TEXT", "NVARCHAR(100)")
+    _ensure_column(conn, is_sql_server, table, "from_state", "TEXT", "NVARCHAR(255)")
+    _ensure_column(conn, is_sql_server, table, "to_state", "TEXT", "NVARCHAR(255)")
 
 
-def get_connection():
-    """
-    Wrapper para resolver la cadena de conexión.
-    Se pasa como argumento cacheado para evitar que quede fija una conexión
-    SQLite si la app arrancó sin variables de entorno y luego se reconfigura.
-    """
-    conn_str = os.environ.get("AZURE_SQL_CONNECTION_STRING")
+def _ensure_due_columns(conn, is_sql_server, table):
+    """Vencimiento según el SLA de la prioridad y marca de escalado."""
+    _ensure_column(conn, is_sql_server, table, "due_at", "TIMESTAMP", "DATETIME2")
+    _ensure_column(conn, is_sql_server, table, "escalated_at", "TIMESTAMP", "DATETIME2")
 
-    if not conn_str and "azure_sql" in st.secrets:
-        conn_str = st.secrets["azure_sql"].get("connection_string")
 
-    return _get_connection_cached(conn_str or "")
+def _ensure_version_column(conn, is_sql_server, table):
+    """Versión de fila para control de concurrencia optimista (ver update_ticket)."""
+    _ensure_column(
+        conn, is_sql_server, table, "version", "INTEGER NOT NULL DEFAULT 1", "INT NOT NULL DEFAULT 1"
+    )
 
 
-def init_db():
-    """Inicializa la base de datos creando las tablas si no existen."""
-    # Evitar reinicialización redundante en la misma sesión
-    if st.session_state.get("db_initialized"):
+def _ensure_view(conn, is_sql_server, name, select_sql):
+    """Crea la vista name o la recrea si su definición cambió."""
+    cur = conn.cursor()
+    if is_sql_server:
+        cur.execute("SELECT OBJECT_DEFINITION(OBJECT_ID(?))", (name,))
+    else:
+        cur.execute("SELECT sql FROM sqlite_master WHERE type = 'view' AND name = ?", (name,))
+    row = cur.fetchone()
+    if row and row[0] and select_sql in row[0]:
         return
+    if is_sql_server:
+        cur.execute(f"CREATE OR ALTER VIEW {name} AS {select_sql}")
+    else:
+        conn.execute(f"DROP VIEW IF EXISTS {name}")
+        conn.execute(f"CREATE VIEW {name} AS {select_sql}")
 
-    conn = get_connection()
-    try:
-        with _db_lock:
-            # Detectar si es SQL Server o SQLite
-            is_sql_server = _is_sql_server_conn(conn)
 
-            # Crear tablas
-            if is_sql_server:
-                cursor = conn.cursor()
-                create_statements = [
-                    """
-                    IF OBJECT_ID('tickets','U') IS NULL
-                    CREATE TABLE tickets (
-                        id INT IDENTITY(1,1) PRIMARY KEY,
-                        titulo NVARCHAR(MAX) NOT NULL,
-                        descripcion NVARCHAR(MAX) NULL,
-                        area_destino NVARCHAR(255) NULL,
-                        categoria NVARCHAR(255) NULL,
-                        subcategoria NVARCHAR(255) NULL,
-                        division NVARCHAR(255) NULL,
-                        planta NVARCHAR(255) NULL,
-                        prioridad NVARCHAR(50) NULL,
-                        urgencia_sugerida NVARCHAR(50) NULL,
-                        responsable_sugerido NVARCHAR(255) NULL,
-                        responsable_asignado NVARCHAR(255) NULL,
-                        estado NVARCHAR(50) DEFAULT 'NUEVO',
-                        solicitante NVARCHAR(255) NULL,
-                        created_by NVARCHAR(255) NULL,
-                        created_at DATETIME2 DEFAULT SYSUTCDATETIME(),
-                        updated_at DATETIME2 NULL,
-                        closed_at DATETIME2 NULL
-                    );
-                    """,
-                    """
-                    IF OBJECT_ID('users','U') IS NULL
-                    CREATE TABLE users (
-                        id INT IDENTITY(1,1) PRIMARY KEY,
-                        nombre_completo NVARCHAR(255) NOT NULL,
+def _ensure_scheduler_tables(conn, is_sql_server):
+    cur = conn.cursor()
+    if is_sql_server:
+        cur.execute(
+            """
+            IF OBJECT_ID('scheduler_lease','U') IS NULL
+            CREATE TABLE scheduler_lease (
+                name NVARCHAR(100) NOT NULL PRIMARY KEY,
+                holder NVARCHAR(200) NULL,
+                expires_at DATETIME2 NOT NULL
+            );
+            """
+        )
+        cur.execute(
+            """
+            IF OBJECT_ID('job_runs','U') IS NULL
+            CREATE TABLE job_runs (
+                id INT IDENTITY(1,1) PRIMARY KEY,
+                job NVARCHAR(100) NOT NULL,
+                holder NVARCHAR(200) NULL,
+                started_at DATETIME2 NOT NULL,
+                finished_at DATETIME2 NULL,
+                duration_ms INT NULL,
+                status NVARCHAR(20) NOT NULL,
+                detail NVARCHAR(MAX) NULL
+            );
+            """
+        )
+        cur.execute(
+            """
+            IF OBJECT_ID('replica_heartbeat','U') IS NULL
+            CREATE TABLE replica_heartbeat (
+                id INT NOT NULL PRIMARY KEY,
+                beat_at DATETIME2 NOT NULL
+            );
+            """
+        )
+        cur.execute(
+            """
+            IF NOT EXISTS (SELECT 1 FROM replica_heartbeat WHERE id = 1)
+            INSERT INTO replica_heartbeat (id, beat_at) VALUES (1, SYSUTCDATETIME())
+            """
+        )
+        cur.execute(
+            """
+            IF NOT EXISTS (SELECT 1 FROM scheduler_lease WHERE name = 'scheduler')
+            INSERT INTO scheduler_lease (name, holder, expires_at)
+            VALUES ('scheduler', NULL, '2000-01-01')
+            """
+        )
+    else:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS scheduler_lease (
+                name TEXT NOT NULL PRIMARY KEY,
+                holder TEXT,
+                expires_at TIMESTAMP NOT NULL
+            );
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS job_runs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job TEXT NOT NULL,
+                holder TEXT,
+                started_at TIMESTAMP NOT NULL,
+                finished_at TIMESTAMP,
+                duration_ms INTEGER,
+                status TEXT NOT NULL,
+                detail TEXT
+            );
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS replica_heartbeat (
+                id INTEGER PRIMARY KEY,
+                beat_at TIMESTAMP NOT NULL
+            );
+            """
+        )
+        conn.execute(
+            "INSERT OR IGNORE INTO replica_heartbeat (id, beat_at) VALUES (1, ?)",
+            (_to_utc_naive(get_now_utc()),),
+        )
+        conn.execute(
+            """
+            INSERT OR IGNORE INTO scheduler_lease (name, holder, expires_at)
+            VALUES ('scheduler', NULL, '2000-01-01 00:00:00')
+            """
+        )
+    _ensure_index(conn, is_sql_server, "IX_job_runs_job", "job_runs", "job, started_at")
+
+
+def _ensure_outbox_tables(conn, is_sql_server):
+    cur = conn.cursor()
+    if is_sql_server:
+        cur.execute(
+            """
+            IF OBJECT_ID('outbox','U') IS NULL
+            CREATE TABLE outbox (
+                id BIGINT IDENTITY(1,1) PRIMARY KEY,
+                created_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME(),
+                event_type NVARCHAR(100) NOT NULL,
+                ticket_id INT NULL,
+                payload_json NVARCHAR(MAX) NULL
+            );
+            """
+        )
+        cur.execute(
+            """
+            IF OBJECT_ID('outbox_cursors','U') IS NULL
+            CREATE TABLE outbox_cursors (
+                sink NVARCHAR(200) NOT NULL PRIMARY KEY,
+                last_id BIGINT NOT NULL DEFAULT 0,
+                attempts INT NOT NULL DEFAULT 0,
+                last_error NVARCHAR(1000) NULL,
+                updated_at DATETIME2 NULL
+            );
+            """
+        )
+        cur.execute(
+            """
+            IF OBJECT_ID('outbox_dead_letter','U') IS NULL
+            CREATE TABLE outbox_dead_letter (
+                id INT IDENTITY(1,1) PRIMARY KEY,
+                outbox_id BIGINT NOT NULL,
+                sink NVARCHAR(200) NOT NULL,
+                event_type NVARCHAR(100) NOT NULL,
+                payload_json NVARCHAR(MAX) NULL,
+                attempts INT NOT NULL,
+                error NVARCHAR(1000) NULL,
+                created_at DATETIME2 NOT NULL DEFAULT SYSUTCDATETIME()
+            );
+            """
+        )
+    else:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                event_type TEXT NOT NULL,
+                ticket_id INTEGER,
+                payload_json TEXT
+            );
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox_cursors (
+                sink TEXT NOT NULL PRIMARY KEY,
+                last_id INTEGER NOT NULL DEFAULT 0,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                last_error TEXT,
+                updated_at TIMESTAMP
+            );
+            """
+        )
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS outbox_dead_letter (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                outbox_id INTEGER NOT NULL,
+                sink TEXT NOT NULL,
+                event_type TEXT NOT NULL,
+                payload_json TEXT,
+                attempts INTEGER NOT NULL,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            );
+            """
+        )
+    _ensure_index(conn, is_sql_server, "IX_outbox_created", "outbox", "created_at")
+
+
+def _ensure_feed_tables(conn, is_sql_server):
+    cur = conn.cursor()
+    if is_sql_server:
+        cur.execute(
+            """
+            IF OBJECT_ID('feed_checkpoints','U') IS NULL
+            CREATE TABLE feed_checkpoints (
+                consumer NVARCHAR(200) NOT NULL PRIMARY KEY,
+                last_id INT NOT NULL DEFAULT 0,
+                updated_at DATETIME2 NULL
+            );
+            """
+        )
+        # Hora de inserción puesta por el servidor: created_at la manda el
+        # cliente (writer diferido, importación, relojes desfasados) y no
+        # sirve para la ventana de FEED_SETTLE_SECONDS
+        _ensure_column(
+            conn,
+            is_sql_server,
+            "ticket_log",
+            "logged_at",
+            "TIMESTAMP",
+            "DATETIME2 NOT NULL CONSTRAINT DF_ticket_log_logged_at DEFAULT SYSUTCDATETIME()",
+        )
+    else:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS feed_checkpoints (
+                consumer TEXT NOT NULL PRIMARY KEY,
+                last_id INTEGER NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP
+            );
+            """
+        )
+
+
+def _ensure_version_table(conn, is_sql_server):
+    cur = conn.cursor()
+    if is_sql_server:
+        cur.execute(
+            """
+            IF OBJECT_ID('app_versions','U') IS NULL
+            CREATE TABLE app_versions (
+                name NVARCHAR(100) NOT NULL PRIMARY KEY,
+                version INT NOT NULL DEFAULT 0
+            );
+            """
+        )
+    else:
+        conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS app_versions (
+                name TEXT NOT NULL PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            );
+            """
+        )
+
+
+def _bump_version(cur, name):
+    """Incrementa la versión de un conjunto de datos (en la transacción actual)."""
+    cur.execute("UPDATE app_versions SET version = version + 1 WHERE name = ?", (name,))
+    if cur.rowcount == 0:
+        cur.execute("INSERT INTO app_versions (name, version) VALUES (?, 1)", (name,))
+
+
+def _ensure_catalog(cur, code, label):
+    cur.execute("SELECT id FROM master_catalogs WHERE code = ?", (code,))
+    row = cur.fetchone()
+    if row:
+        return int(row[0])
+    return _insert_returning_id(
+        cur, "master_catalogs", ("code", "label", "is_active"), (code, label, 1)
+    )
+
+
+def _ensure_catalog_item(cur, catalog_id, label, sort_order, parent_item_id=None):
+    if parent_item_id is None:
+        cur.execute(
+            """
+            SELECT id FROM master_catalog_items
+            WHERE catalog_id = ? AND label = ? AND parent_item_id IS NULL
+            """,
+            (catalog_id, label),
+        )
+    else:
+        cur.execute(
+            """
+            SELECT id FROM master_catalog_items
+            WHERE catalog_id = ? AND label = ? AND parent_item_id = ?
+            """,
+            (catalog_id, label, parent_item_id),
+        )
+    row = cur.fetchone()
+    if row:
+        item_id = int(row[0])
+        cur.execute(
+            """
+            UPDATE master_catalog_items
+            SET sort_order = ?, is_active = 1
+            WHERE id = ?
+            """,
+            (sort_order, item_id),
+        )
+        return item_id
+
+    return _insert_returning_id(
+        cur,
+        "master_catalog_items",
+        ("catalog_id", "label", "sort_order", "is_active", "parent_item_id"),
+        (catalog_id, label, sort_order, 1, parent_item_id),
+    )
+
+
+def _seed_master_data(conn):
+    from models import (
+        AREAS,
+        CATEGORIAS,
+        DIVISIONES,
+        PLANTAS,
+        PRIORIDADES,
+        ROLES,
+        SLA_HORAS,
+        SUBCATEGORIAS,
+    )
+
+    cur = conn.cursor()
+    catalog_values = {
+        "areas": AREAS,
+        "divisiones": DIVISIONES,
+        "plantas": PLANTAS,
+        "prioridades": PRIORIDADES,
+        "roles": ROLES,
+    }
+    for code, values in catalog_values.items():
+        catalog_id = _ensure_catalog(cur, code, MASTER_CATALOGS[code])
+        for idx, label in enumerate(values):
+            _ensure_catalog_item(cur, catalog_id, label, idx)
+
+    # SLA inicial de prioridades; no pisa lo editado desde ADMIN
+    prioridades_id = _ensure_catalog(cur, "prioridades", MASTER_CATALOGS["prioridades"])
+    for label, hours in SLA_HORAS.items():
+        cur.execute(
+            """
+            UPDATE master_catalog_items SET sla_hours = ?
+            WHERE catalog_id = ? AND label = ? AND sla_hours IS NULL
+            """,
+            (hours, prioridades_id, label),
+        )
+
+    categorias_id = _ensure_catalog(cur, "categorias", MASTER_CATALOGS["categorias"])
+    categoria_item_ids = {}
+    for idx, categoria in enumerate(CATEGORIAS):
+        item_id = _ensure_catalog_item(cur, categorias_id, categoria, idx)
+        categoria_item_ids[categoria] = item_id
+
+    for categoria, subcategorias in SUBCATEGORIAS.items():
+        parent_id = categoria_item_ids.get(categoria)
+        if not parent_id:
+            continue
+        for idx, sub in enumerate(subcategorias):
+            _ensure_catalog_item(cur, categorias_id, sub, idx, parent_item_id=parent_id)
+
+
+class _SqlCircuitBreaker:
+    """
+    Circuit breaker para la conexión compartida a Azure SQL.
+
+    - CERRADO: se usa la conexión cacheada; si pasaron más de
+      SQL_PROBE_INTERVAL desde la última verificación se prueba con SELECT 1
+      antes de entregarla. Una consulta que falla por desconexión abre el
+      circuito (ver close_connection).
+    - ABIERTO: tras un fallo, checkout() retorna None de inmediato (el llamador
+      usa el fallback) y un hilo en segundo plano reintenta la conexión
+      (SEMIABIERTO) con backoff hasta que vuelve a funcionar.
+    Ninguna sesión espera más que un único timeout de conexión.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = "CERRADO", "ABIERTO", "SEMIABIERTO"
+
+    def __init__(self, conn_str):
+        self._conn_str = conn_str
+        self._lock = threading.Lock()
+        # Conexión y SELECT 1 corren fuera de _lock, de a un hilo por vez
+        self._refresh_lock = threading.Lock()
+        self._conn = None
+        self._last_ok = 0.0
+        # Aumenta cada vez que cambia la conexión compartida: los hilos de
+        # fan_out descartan las suyas abiertas en una generación anterior
+        self.generation = 0
+        self.state = self.CLOSED
+        self.failures = 0
+        self.last_error = None
+
+    def _usable(self):
+        return self._conn is not None and time.monotonic() - self._last_ok <= SQL_PROBE_INTERVAL
+
+    def checkout(self):
+        """Retorna una conexión verificada, o None si el circuito está abierto."""
+        with self._lock:
+            if self.state != self.CLOSED:
+                return None
+            if self._usable():
+                return self._conn
+        # Otra sesión ya está conectando/verificando: se espera a lo sumo un
+        # timeout de conexión y, si no terminó, se usa el fallback
+        if not self._refresh_lock.acquire(timeout=SQL_CONNECT_TIMEOUT):
+            return None
+        try:
+            with self._lock:
+                if self.state != self.CLOSED:
+                    return None
+                if self._usable():
+                    return self._conn
+                conn = self._conn
+            try:
+                if conn is None:
+                    conn = _connect_sql(self._conn_str)
+                else:
+                    conn.execute("SELECT 1").fetchone()
+            except Exception as e:
+                with self._lock:
+                    if self.state == self.CLOSED:
+                        self._trip(e)
+                return None
+            with self._lock:
+                if self.state != self.CLOSED:
+                    if conn is not self._conn:
+                        conn.close()
+                    return None
+                # _last_ok sólo avanza tras conectar o verificar de verdad
+                if conn is not self._conn:
+                    self._conn = conn
+                    self.generation += 1
+                self._last_ok = time.monotonic()
+                return conn
+        finally:
+            self._refresh_lock.release()
+
+    def report_failure(self, conn, error):
+        """
+        Una consulta sobre conn falló por desconexión, o (conn None) falló
+        abrir una conexión propia contra el mismo destino: abre el circuito.
+        """
+        with self._lock:
+            if self.state == self.CLOSED and (conn is None or conn is self._conn):
+                self._trip(error)
+
+    def opener(self):
+        """Abre una conexión propia (fan_out, streaming) avisando si falla."""
+
+        def _open():
+            try:
+                return _connect_sql(self._conn_str)
+            except Exception as e:
+                self.report_failure(None, e)
+                raise
+
+        return _open
+
+    def _trip(self, error):
+        logger.info(f"Azure SQL no disponible, usando SQLite: {error}")
+        self.failures += 1
+        self.last_error = str(error)
+        self.state = self.OPEN
+        conn, self._conn = self._conn, None
+        self.generation += 1
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+        threading.Thread(
+            target=self._retry_loop, name="gestar-sql-retry", daemon=True
+        ).start()
+
+    def _retry_loop(self):
+        delay = SQL_RETRY_INTERVAL
+        while True:
+            time.sleep(delay)
+            with self._lock:
+                self.state = self.HALF_OPEN
+            try:
+                conn = _connect_sql(self._conn_str)
+                conn.execute("SELECT 1").fetchone()
+            except Exception as e:
+                with self._lock:
+                    self.state = self.OPEN
+                    self.failures += 1
+                    self.last_error = str(e)
+                delay = min(delay * 2, 300)
+                continue
+            with self._lock:
+                self._conn = conn
+                self.generation += 1
+                self._last_ok = time.monotonic()
+                self.state = self.CLOSED
+                self.failures = 0
+            logger.info("Azure SQL disponible nuevamente.")
+            return
+
+
+@st.cache_resource(show_spinner=False)
+def _get_sql_breaker(conn_str):
+    return _SqlCircuitBreaker(conn_str)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_sqlite_connection():
+    """Conexión SQLite local compartida (fallback o backend principal)."""
+    conn = sqlite3.connect(DB_NAME, check_same_thread=False)
+    # Habilitar foreign keys (Solo SQLite)
+    conn.execute("PRAGMA foreign_keys = ON")
+    # Sólo tiene efecto en una base nueva (sin tablas): permite devolver
+    # páginas libres con incremental_vacuum tras las purgas de historial.
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    return conn
+
+
+def get_connection():
+    """
+    Retorna la conexión a la base de datos (Azure SQL o SQLite).
+    La cadena de conexión se resuelve en cada llamada para que no quede fija
+    una conexión SQLite si la app arrancó sin variables de entorno y luego se
+    reconfigura. Si Azure SQL no responde, la decisión de usar SQLite es
+    inmediata (ver _SqlCircuitBreaker). Dentro de una función @_read_only la
+    conexión puede ser la de réplica de lectura (ver RUTEO DE LECTURAS), y en
+    un hilo de fan_out es una conexión propia del hilo.
+    """
+    conn, opener, slot = _route()
+    if getattr(_fanout_local, "active", False):
+        return _fanout_connection(slot, opener)
+    return conn
+
+
+def _route():
+    """
+    Retorna (conexión compartida, abrir_conexión_propia, (destino, generación))
+    para el contexto actual. La generación cambia cuando el circuit breaker
+    reemplaza la conexión compartida del destino.
+    """
+    if _routing.get() == "read":
+        routed = _read_route()
+        if routed is not None:
+            return routed
+    conn_str = _resolve_conn_str()
+    if conn_str:
+        breaker = _get_sql_breaker(conn_str)
+        conn = breaker.checkout()
+        if conn is not None:
+            return conn, breaker.opener(), (conn_str, breaker.generation)
+    return (
+        _get_sqlite_connection(),
+        lambda: sqlite3.connect(DB_NAME, check_same_thread=False),
+        (DB_NAME, 0),
+    )
+
+
+def get_connection_status():
+    """Estado de la conexión a Azure SQL (para diagnóstico)."""
+    conn_str = _resolve_conn_str()
+    if not conn_str:
+        return {"backend": "SQLite", "state": None}
+    breaker = _get_sql_breaker(conn_str)
+    return {
+        "backend": "Azure SQL" if breaker.state == breaker.CLOSED else "SQLite",
+        "state": breaker.state,
+        "failures": breaker.failures,
+        "last_error": breaker.last_error,
+    }
+
+
+def _open_dedicated_connection():
+    """
+    Abre una conexión propia (no cacheada) contra el mismo backend que
+    get_connection(). Se usa para lecturas largas en streaming que no deben
+    ocupar la conexión compartida. El llamador debe cerrarla.
+    """
+    return _route()[1]()
+
+
+def _resolve_conn_str():
+    conn_str = os.environ.get("AZURE_SQL_CONNECTION_STRING")
+
+    if not conn_str:
+        try:
+            if "azure_sql" in st.secrets:
+                conn_str = st.secrets["azure_sql"].get("connection_string")
+        except Exception:
+            # Fuera de Streamlit (CLI/scripts) puede no existir secrets.toml
+            conn_str = None
+    return conn_str or ""
+
+
+# --- RUTEO DE LECTURAS ---
+# Las funciones marcadas con @_read_only pueden leer de un endpoint de sólo
+# lectura: AZURE_SQL_READ_CONNECTION_STRING (réplica con
+# ApplicationIntent=ReadOnly) o, en local, GESTAR_SQLITE_READ_DB (segundo
+# archivo SQLite que el scheduler sincroniza desde gestar.db). Se vuelve al
+# primario si la réplica atrasa más de READ_MAX_STALENESS segundos (medido con
+# replica_heartbeat) o si la sesión escribió hace menos de READ_PIN_SECONDS.
+
+READ_MAX_STALENESS = int(os.environ.get("GESTAR_READ_MAX_STALENESS", "30"))
+READ_PIN_SECONDS = int(os.environ.get("GESTAR_READ_PIN_SECONDS", "30"))
+_STALENESS_CHECK_SECONDS = 5
+
+_routing = contextvars.ContextVar("gestar_db_routing", default=None)
+_fallback_session = {}
+_replica_checks = {}
+_replica_checks_lock = threading.Lock()
+
+
+def _read_only(fn):
+    """Marca una función de lectura: sus consultas pueden ir a la réplica."""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        token = _routing.set("read")
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            _routing.reset(token)
+
+    return wrapper
+
+
+def _resolve_read_target():
+    """("sql", conn_str) / ("sqlite", path) del endpoint de lectura, o None."""
+    conn_str = os.environ.get("AZURE_SQL_READ_CONNECTION_STRING")
+    if not conn_str:
+        try:
+            if "azure_sql" in st.secrets:
+                conn_str = st.secrets["azure_sql"].get("read_connection_string")
+        except Exception:
+            conn_str = None
+    if conn_str:
+        if "applicationintent" not in conn_str.lower():
+            conn_str = conn_str.rstrip(";") + ";ApplicationIntent=ReadOnly;"
+        return ("sql", conn_str)
+    path = os.environ.get("GESTAR_SQLITE_READ_DB")
+    return ("sqlite", path) if path else None
+
+
+def read_routing_configured():
+    return _resolve_read_target() is not None
+
+
+def _session_store():
+    """st.session_state dentro de Streamlit; un dict del proceso fuera de él."""
+    try:
+        from streamlit import runtime
+
+        if runtime.exists():
+            return st.session_state
+    except Exception:
+        pass
+    return _fallback_session
+
+
+def _pin_reads():
+    """Read-your-writes: la sesión que escribió lee del primario un tiempo."""
+    try:
+        _session_store()["_db_read_pin_until"] = time.monotonic() + READ_PIN_SECONDS
+    except Exception:
+        pass
+
+
+def _reads_pinned():
+    try:
+        return _session_store().get("_db_read_pin_until", 0) > time.monotonic()
+    except Exception:
+        return False
+
+
+def _read_pin_token():
+    """Marca de la última escritura de la sesión si sigue fijada al primario, o None."""
+    try:
+        until = _session_store().get("_db_read_pin_until", 0)
+    except Exception:
+        return None
+    return until if until > time.monotonic() else None
+
+
+@st.cache_resource(show_spinner=False)
+def _get_sqlite_read_connection(path):
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+
+
+def _replica_fresh(target, conn):
+    """True si el último heartbeat visible en la réplica es reciente."""
+    now = time.monotonic()
+    with _replica_checks_lock:
+        checked = _replica_checks.get(target)
+        if checked and now - checked[0] < _STALENESS_CHECK_SECONDS:
+            return checked[1]
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT beat_at FROM replica_heartbeat WHERE id = 1")
+            row = cur.fetchone()
+            beat_at = _to_utc_naive(row[0]) if row else None
+            lag = (
+                (_to_utc_naive(get_now_utc()) - beat_at).total_seconds()
+                if beat_at
+                else None
+            )
+            fresh = lag is not None and lag <= READ_MAX_STALENESS
+        except Exception as e:
+            logger.warning(f"Réplica de lectura no disponible: {e}")
+            _report_sql_failure(conn, e)
+            fresh = False
+        _replica_checks[target] = (now, fresh)
+        return fresh
+
+
+def _read_route():
+    """(conexión, abrir_propia, (destino, generación)) de la réplica, o None para usar el primario."""
+    if _reads_pinned():
+        return None
+    target = _resolve_read_target()
+    if target is None:
+        return None
+    kind, ref = target
+    primary = _resolve_conn_str()
+    if kind == "sql":
+        # Sólo si el primario también es Azure SQL y está disponible
+        if not primary or _get_sql_breaker(primary).state != _SqlCircuitBreaker.CLOSED:
+            return None
+        breaker = _get_sql_breaker(ref)
+        # Como en el primario: una réplica caída abre su circuito y las
+        # lecturas van al primario sin esperar un timeout en cada una
+        conn = breaker.checkout()
+        opener = breaker.opener()
+        slot = (ref, breaker.generation)
+    else:
+        if primary or not os.path.exists(ref):
+            return None
+        conn = _get_sqlite_read_connection(ref)
+        opener = lambda: sqlite3.connect(f"file:{ref}?mode=ro", uri=True)
+        slot = (ref, 0)
+    if conn is None or not _replica_fresh(target, conn):
+        return None
+    return conn, opener, slot
+
+
+def write_replica_heartbeat():
+    """Job del scheduler: marca la hora en el primario para medir el atraso."""
+    beat_at = _to_utc_naive(get_now_utc())
+
+    def _job(conn):
+        conn.cursor().execute("UPDATE replica_heartbeat SET beat_at = ? WHERE id = 1", (beat_at,))
+
+    # Sin _run_write: no es una escritura de la sesión, no debe fijar lecturas
+    token = _routing.set("write")
+    try:
+        submit_write(_job).result()
+    finally:
+        _routing.reset(token)
+
+
+def sync_sqlite_replica():
+    """Job del scheduler (sólo local): copia gestar.db al archivo de lectura."""
+    target = _resolve_read_target()
+    if not target or target[0] != "sqlite" or _resolve_conn_str():
+        return
+    tmp = f"{target[1]}.tmp"
+    src = sqlite3.connect(DB_NAME)
+    dst = sqlite3.connect(tmp)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+    # Reemplazo atómico: los lectores ven la copia anterior o la nueva
+    os.replace(tmp, target[1])
+    _get_sqlite_read_connection.clear()
+
+
+# --- CACHÉ DE RESULTADOS ---
+# Caché de lecturas compartida por todas las sesiones del proceso, acotada por
+# memoria: las entradas se desalojan por LRU según su tamaño aproximado
+# (memory_usage(deep=True) para DataFrames) hasta quedar bajo
+# RESULT_CACHE_MB. Lleva contadores de aciertos, fallos y desalojos por
+# función para ADMIN. Se usa con el decorador @cached_result(ttl=...).
+
+RESULT_CACHE_MB = int(os.environ.get("GESTAR_RESULT_CACHE_MB", "64"))
+
+_CacheEntry = namedtuple("_CacheEntry", ["value", "size", "created", "expires", "function"])
+
+
+def _approx_size(value):
+    """Tamaño aproximado en bytes de un resultado."""
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(deep=True).sum())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(_approx_size(v) for v in value)
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(
+            _approx_size(k) + _approx_size(v) for k, v in value.items()
+        )
+    return sys.getsizeof(value)
+
+
+class _ResultCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._entries = OrderedDict()
+        self._hits = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _stat(self, function):
+        return self._stats.setdefault(
+            function, {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+        )
+
+    def get(self, key):
+        """(True, valor) si la clave está vigente; (False, None) si no."""
+        function = key[0]
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.expires < time.monotonic():
+                self._remove(key)
+                self._stat(function)["expired"] += 1
+                entry = None
+            if entry is None:
+                self._stat(function)["misses"] += 1
+                return False, None
+            self._entries.move_to_end(key)
+            self._hits[key] = self._hits.get(key, 0) + 1
+            self._stat(function)["hits"] += 1
+            return True, entry.value
+
+    def put(self, key, value, ttl):
+        size = _approx_size(value)
+        if size > self.max_bytes:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = _CacheEntry(value, size, now, now + ttl, key[0])
+            self.used += size
+            while self.used > self.max_bytes and self._entries:
+                old_key = next(iter(self._entries))
+                self._remove(old_key)
+                self._stat(old_key[0])["evictions"] += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self._hits.pop(key, None)
+        self.used -= entry.size
+
+    def clear(self, function=None):
+        with self._lock:
+            for key in [k for k in self._entries if function is None or k[0] == function]:
+                self._remove(key)
+
+    def entries(self):
+        """Entradas residentes (de la menos a la más usada recientemente)."""
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "funcion": entry.function,
+                    "argumentos": repr(key[1:])[:200],
+                    "kb": round(entry.size / 1024, 1),
+                    "edad_s": int(now - entry.created),
+                    "vence_en_s": max(0, int(entry.expires - now)),
+                    "aciertos": self._hits.get(key, 0),
+                }
+                for key, entry in self._entries.items()
+            ]
+
+    def stats(self):
+        with self._lock:
+            sizes = {}
+            for entry in self._entries.values():
+                count, total = sizes.get(entry.function, (0, 0))
+                sizes[entry.function] = (count + 1, total + entry.size)
+            return [
+                {
+                    "funcion": function,
+                    "entradas": sizes.get(function, (0, 0))[0],
+                    "kb": round(sizes.get(function, (0, 0))[1] / 1024, 1),
+                    **counters,
+                }
+                for function, counters in sorted(self._stats.items())
+            ]
+
+
+@st.cache_resource(show_spinner=False)
+def _get_result_cache():
+    return _ResultCache(RESULT_CACHE_MB * 1024 * 1024)
+
+
+def cached_result(ttl=30):
+    """
+    Decorador: cachea el resultado por (función, argumentos) durante ttl
+    segundos en la caché acotada del proceso. Los argumentos deben ser
+    hashables; f(x), f(x, default) y f(a=x) comparten la entrada. Cada
+    llamada recibe una copia profunda. func.clear() borra las entradas de la
+    función.
+    """
+
+    def decorator(fn):
+        name = f"{fn.__module__}.{fn.__qualname__}"
+        sig = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            bound = sig.bind(*args, **kwargs)
+            bound.apply_defaults()
+            key = (name,) + tuple(
+                tuple(sorted(v.items()))
+                if sig.parameters[k].kind is inspect.Parameter.VAR_KEYWORD
+                else v
+                for k, v in bound.arguments.items()
+            )
+            cache = _get_result_cache()
+            found, value = cache.get(key)
+            if not found:
+                value = fn(*args, **kwargs)
+                cache.put(key, value, ttl)
+            # Copia profunda: el llamador puede modificar el resultado (celdas,
+            # columnas, dicts) sin alterar la entrada compartida
+            return copy.deepcopy(value)
+
+        wrapper.clear = lambda: _get_result_cache().clear(name)
+        return wrapper
+
+    return decorator
+
+
+def get_result_cache_info():
+    """Uso de la caché de resultados para ADMIN."""
+    cache = _get_result_cache()
+    return {
+        "used_kb": round(cache.used / 1024, 1),
+        "max_kb": round(cache.max_bytes / 1024, 1),
+        "stats": cache.stats(),
+        "entries": cache.entries(),
+    }
+
+
+def clear_result_cache():
+    _get_result_cache().clear()
+
+
+# --- CONSULTAS EN PARALELO ---
+# fan_out ejecuta lecturas independientes a la vez (encabezado, detalle de un
+# ticket) para que la latencia de la página sea la de la consulta más lenta y
+# no la suma de los viajes a Azure SQL. Cada hilo del pool usa su propia
+# conexión: la conexión compartida no admite consultas simultáneas.
+
+FANOUT_WORKERS = int(os.environ.get("GESTAR_FANOUT_WORKERS", "4"))
+
+_fanout_local = threading.local()
+
+
+@st.cache_resource(show_spinner=False)
+def _get_fanout_pool():
+    return ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="gestar-fanout")
+
+
+def _fanout_connection(slot, opener):
+    """
+    Conexión del hilo para el destino de la conexión compartida. Si el
+    breaker la reemplazó (otra generación), la del hilo se cierra y se abre
+    de nuevo.
+    """
+    conns = getattr(_fanout_local, "conns", None)
+    if conns is None:
+        conns = _fanout_local.conns = {}
+    target, generation = slot
+    entry = conns.get(target)
+    if entry is not None and entry[0] != generation:
+        try:
+            entry[1].close()
+        except Exception:
+            pass
+        entry = None
+    if entry is None:
+        entry = conns[target] = (generation, opener())
+    return entry[1]
+
+
+def _drop_fanout_connections():
+    for _, conn in getattr(_fanout_local, "conns", {}).values():
+        try:
+            conn.close()
+        except Exception:
+            pass
+    _fanout_local.conns = {}
+
+
+def _fanout_call(fn, args):
+    _fanout_local.active = True
+    try:
+        return fn(*args)
+    except Exception:
+        # La conexión del hilo puede haber quedado inservible
+        _drop_fanout_connections()
+        raise
+    finally:
+        _fanout_local.active = False
+
+
+def fan_out(**calls):
+    """
+    Ejecuta en paralelo lecturas independientes y retorna {nombre: resultado}.
+    Cada llamada es una función o una tupla (función, *args). Si alguna falla,
+    se relanza su excepción después de esperar a las demás.
+
+        r = db.fan_out(ticket=(db.get_ticket_by_id, tid), logs=(db.get_ticket_logs, tid))
+    """
+    try:
+        from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+
+        script_ctx = get_script_run_ctx(suppress_warning=True)
+    except Exception:
+        add_script_run_ctx, script_ctx = None, None
+
+    def _task(ctx, fn, args):
+        if add_script_run_ctx and script_ctx is not None:
+            add_script_run_ctx(threading.current_thread(), script_ctx)
+        return ctx.run(_fanout_call, fn, args)
+
+    pool = _get_fanout_pool()
+    futures = {}
+    for name, call in calls.items():
+        fn, args = (call[0], call[1:]) if isinstance(call, tuple) else (call, ())
+        # Cada tarea hereda el contexto (ruteo, pin de lecturas) del llamador
+        futures[name] = pool.submit(_task, contextvars.copy_context(), fn, args)
+
+    results, error = {}, None
+    for name, future in futures.items():
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            error = error or e
+    if error is not None:
+        raise error
+    return results
+
+
+def init_db():
+    """Inicializa la base de datos creando las tablas si no existen."""
+    # Evitar reinicialización redundante en la misma sesión
+    if st.session_state.get("db_initialized"):
+        return
+
+    conn = get_connection()
+    try:
+        with _db_lock:
+            # Detectar si es SQL Server o SQLite
+            is_sql_server = _is_sql_server_conn(conn)
+
+            # Crear tablas
+            if is_sql_server:
+                cursor = conn.cursor()
+                create_statements = [
+                    """
+                    IF OBJECT_ID('tickets','U') IS NULL
+                    CREATE TABLE tickets (
+                        id INT IDENTITY(1,1) PRIMARY KEY,
+                        titulo NVARCHAR(MAX) NOT NULL,
+                        descripcion NVARCHAR(MAX) NULL,
+                        area_destino NVARCHAR(255) NULL,
+                        categoria NVARCHAR(255) NULL,
+                        subcategoria NVARCHAR(255) NULL,
+                        division NVARCHAR(255) NULL,
+                        planta NVARCHAR(255) NULL,
+                        prioridad NVARCHAR(50) NULL,
+                        urgencia_sugerida NVARCHAR(50) NULL,
+                        responsable_sugerido NVARCHAR(255) NULL,
+                        responsable_asignado NVARCHAR(255) NULL,
+                        estado NVARCHAR(50) DEFAULT 'NUEVO',
+                        solicitante NVARCHAR(255) NULL,
+                        created_by NVARCHAR(255) NULL,
+                        created_at DATETIME2 DEFAULT SYSUTCDATETIME(),
+                        updated_at DATETIME2 NULL,
+                        closed_at DATETIME2 NULL
+                    );
+                    """,
+                    """
+                    IF OBJECT_ID('users','U') IS NULL
+                    CREATE TABLE users (
+                        id INT IDENTITY(1,1) PRIMARY KEY,
+                        nombre_completo NVARCHAR(255) NOT NULL,
                         email NVARCHAR(255) NULL,
                         rol NVARCHAR(50) NULL,
                         area NVARCHAR(255) NULL,
@@ -513,775 +1807,3580 @@ def init_db():
                 for statement in create_statements:
                     cursor.execute(statement)
             else:
-                conn.execute(CREATE_TICKETS_TABLE)
-                conn.execute(CREATE_TASKS_TABLE)
-                conn.execute(CREATE_TICKET_LOG_TABLE)
-                conn.execute(CREATE_USERS_TABLE)
+                conn.execute(CREATE_TICKETS_TABLE)
+                conn.execute(CREATE_TASKS_TABLE)
+                conn.execute(CREATE_TICKET_LOG_TABLE)
+                conn.execute(CREATE_USERS_TABLE)
+
+            # Crear y sembrar tablas maestras (idempotente)
+            _ensure_master_tables(conn, is_sql_server)
+            _seed_master_data(conn)
+
+            # MIGRATION: columnas agregadas después de la creación inicial
+            _ensure_column(
+                conn, is_sql_server, "tickets", "subcategoria", "TEXT", "NVARCHAR(MAX)"
+            )
+            _ensure_column(
+                conn, is_sql_server, "tickets", "import_ref", "TEXT", "NVARCHAR(120)"
+            )
+            _ensure_index(
+                conn, is_sql_server, "IX_tickets_import_ref", "tickets", "import_ref"
+            )
+            _ensure_transition_columns(conn, is_sql_server, "ticket_log")
+            _ensure_index(
+                conn,
+                is_sql_server,
+                "IX_ticket_log_transition",
+                "ticket_log",
+                "field, to_state, from_state",
+            )
+            _ensure_due_columns(conn, is_sql_server, "tickets")
+            _ensure_version_column(conn, is_sql_server, "tickets")
+            _ensure_index(conn, is_sql_server, "IX_tickets_due", "tickets", "due_at, estado")
+            _ensure_import_tables(conn, is_sql_server)
+            _ensure_rollup_tables(conn, is_sql_server)
+            _ensure_counter_tables(conn, is_sql_server)
+            _ensure_version_table(conn, is_sql_server)
+            _ensure_archive_tables(conn, is_sql_server)
+            _ensure_scheduler_tables(conn, is_sql_server)
+            _ensure_outbox_tables(conn, is_sql_server)
+            _ensure_feed_tables(conn, is_sql_server)
+
+            # Check if users table is empty and populate initial users
+            cur = conn.cursor()
+            cur.execute("SELECT count(*) FROM users")
+            if cur.fetchone()[0] == 0:
+                from models import USERS_PROV
+
+                # Primary Admin
+                if is_sql_server:
+                    cur.execute(
+                        "INSERT INTO users (nombre_completo, email, rol, area, activo) VALUES (?, ?, ?, ?, 1)",
+                        (
+                            "Gauto, Pablo",
+                            "gautop@taranto.com.ar",
+                            "Administrador",
+                            "Sistemas",
+                        ),
+                    )
+                else:
+                    conn.execute(
+                        "INSERT INTO users (nombre_completo, email, rol, area, activo) VALUES (?, ?, ?, ?, 1)",
+                        (
+                            "Gauto, Pablo",
+                            "gautop@taranto.com.ar",
+                            "Administrador",
+                            "Sistemas",
+                        ),
+                    )
+
+                for u in USERS_PROV:
+                    # Basic parsing "Name <email>"
+                    if " <" in u:
+                        name, email = u.split(" <")
+                        email = email.rstrip(">")
+                    else:
+                        name, email = u, ""
+
+                    # Assign default for current list
+                    role = "Analista"
+                    area = "IT"  # Default to IT for initial list
+                    if "Ranea" in name:
+                        area = "Ing. Procesos"
+                    if "Vazquez" in name:
+                        area = "Sistemas"  # Placeholder
+
+                    if is_sql_server:
+                        cur.execute(
+                            "INSERT INTO users (nombre_completo, email, rol, area, activo) VALUES (?, ?, ?, ?, 1)",
+                            (name, email, role, area),
+                        )
+                    else:
+                        conn.execute(
+                            "INSERT INTO users (nombre_completo, email, rol, area, activo) VALUES (?, ?, ?, ?, 1)",
+                            (name, email, role, area),
+                        )
+
+            # Check if empty and populate tickets
+            cur.execute("SELECT count(*) FROM tickets")
+            if cur.fetchone()[0] == 0:
+                populate_samples(conn)
+
+            # Contadores vacíos (tabla nueva): se calculan desde tickets
+            cur.execute("SELECT count(*) FROM ticket_counters")
+            if cur.fetchone()[0] == 0:
+                _reconcile_counters(cur)
+
+            conn.commit()
+            clear_master_cache()
+        st.session_state["db_initialized"] = True
+    finally:
+        close_connection(conn)
+
+
+def populate_samples(conn):
+    """Carga datos de ejemplo."""
+    tickets_data = [
+        (
+            "Falla en Impresora",
+            "La impresora de RRHH no conecta en red.",
+            "IT",
+            "Hardware",
+            "Administración",
+            "Planta 1",
+            "Media",
+            "Media",
+            "Juan Perez",
+            None,
+            "NUEVO",
+            "Maria Garcia",
+            "Maria Garcia",
+        ),
+        (
+            "Mantenimiento AA",
+            "Aire acondicionado de sala de reuniones gotea.",
+            "Mantenimiento",
+            "Infraestructura",
+            "Administración",
+            "Planta 1",
+            "Baja",
+            "Baja",
+            "Luis Gomez",
+            "Carlos Ruiz",
+            "ASIGNADO",
+            "Pedro Martinez",
+            "Pedro Martinez",
+        ),
+        (
+            "Error en validación",
+            "El sistema de calidad da error 500 al guardar.",
+            "IT",
+            "Software",
+            "Calidad",
+            "Planta 2",
+            "Alta",
+            "Alta",
+            "Ana Lopez",
+            None,
+            "NUEVO",
+            "Juan Lopez",
+            "Juan Lopez",
+        ),
+        (
+            "Solicitud de Notebook",
+            "Notebook para nuevo ingreso.",
+            "IT",
+            "Hardware",
+            "RRHH",
+            "Planta 1",
+            "Media",
+            "Media",
+            None,
+            "Juan Perez",
+            "EN PROCESO",
+            "Maria Garcia",
+            "Maria Garcia",
+        ),
+    ]
+
+    cur = conn.cursor()
+    for t in tickets_data:
+        ticket_id = _insert_returning_id(
+            cur,
+            "tickets",
+            (
+                "titulo", "descripcion", "area_destino", "categoria", "division", "planta",
+                "prioridad", "urgencia_sugerida", "responsable_sugerido", "responsable_asignado",
+                "estado", "solicitante", "created_by",
+            ),
+            t,
+        )
+
+        # Add sample task if not NEW
+        if ticket_id and t[10] != "NUEVO":
+            cur.execute(
+                "INSERT INTO tasks (ticket_id, descripcion, responsable, estado) VALUES (?, ?, ?, ?)",
+                (
+                    ticket_id,
+                    f"Investigar {t[0]}",
+                    t[9] if t[9] else "Sin Asignar",
+                    "PENDIENTE",
+                ),
+            )
+
+        # Add init log
+        if ticket_id:
+            cur.execute(
+                """
+                INSERT INTO ticket_log (ticket_id, author, event_type, message, field, to_state)
+                VALUES (?, ?, ?, ?, ?, ?)
+                """,
+                (ticket_id, "System", "system", "Ticket creado con datos de ejemplo.", "estado", t[10]),
+            )
+
+    conn.commit()
+
+
+# --- ESCRITURAS ---
+
+
+class _SqliteWriter:
+    """
+    Hilo único de escritura para SQLite. Es dueño de su propia conexión, toma
+    trabajos de una cola y confirma varios en una sola transacción (group
+    commit): el costo del fsync se reparte entre todo el lote.
+    Cada trabajo corre dentro de un SAVEPOINT, así un error sólo deshace ese
+    trabajo y no el resto del lote.
+    """
+
+    def __init__(self, path, max_batch=64, max_delay=0.005):
+        self._path = path
+        self._queue = queue.Queue()
+        self._max_batch = max_batch
+        self._max_delay = max_delay
+        self._ready = threading.Event()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="gestar-sqlite-writer", daemon=True
+        )
+        self._thread.start()
+        self._ready.wait()
+        atexit.register(self.close)
+
+    def submit(self, job):
+        """Encola job(conn) y retorna un Future con su resultado."""
+        future = Future()
+        if self._closed:
+            # Escrituras tardías (p. ej. otros handlers de atexit): se
+            # ejecutan en el momento con una conexión propia.
+            conn = self._connect()
+            try:
+                self._execute(conn, [(job, future)])
+            finally:
+                conn.close()
+            return future
+        self._queue.put((job, future))
+        return future
+
+    def _connect(self):
+        # isolation_level=None: las transacciones se manejan explícitamente
+        conn = sqlite3.connect(self._path, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA foreign_keys = ON")
+        return conn
+
+    def _run(self):
+        conn = self._connect()
+        self._ready.set()
+        while True:
+            item = self._queue.get()
+            if item is None:
+                conn.close()
+                return
+            batch = [item]
+            deadline = time.monotonic() + self._max_delay
+            stop = False
+            while len(batch) < self._max_batch:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = (
+                        self._queue.get(timeout=timeout)
+                        if timeout > 0
+                        else self._queue.get_nowait()
+                    )
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._execute(conn, batch)
+            if stop:
+                conn.close()
+                return
+
+    def _execute(self, conn, batch):
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for job, future in batch:
+                if not future.set_running_or_notify_cancel():
+                    continue
+                conn.execute("SAVEPOINT job")
+                try:
+                    results.append((future, job(conn), None))
+                    conn.execute("RELEASE job")
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((future, None, e))
+            conn.execute("COMMIT")
+        except Exception as e:
+            logger.error(f"Writer SQLite: fallo al confirmar lote de {len(batch)}: {e}")
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            for job, future in batch:
+                if not future.done():
+                    if not future.running():
+                        future.set_running_or_notify_cancel()
+                    future.set_exception(e)
+            return
+        for future, result, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        self._closed = True
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join(timeout=30)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_sqlite_writer(db_name):
+    return _SqliteWriter(db_name)
+
+
+def _sqlite_writer():
+    """Writer del proceso si el backend es SQLite (GESTAR_SQLITE_WRITER=0 lo desactiva)."""
+    if os.environ.get("GESTAR_SQLITE_WRITER", "1").lower() in ("0", "false", "no"):
+        return None
+    if _is_sql_server_conn(get_connection()):
+        return None
+    return _get_sqlite_writer(DB_NAME)
+
+
+def submit_write(job):
+    """
+    Ejecuta job(conn) como transacción de escritura y retorna un Future.
+    En SQLite el trabajo lo ejecuta el hilo escritor (posiblemente agrupado
+    con otros en el mismo commit); en SQL Server se ejecuta en el momento.
+    job no debe llamar a commit/rollback.
+    """
+    writer = _sqlite_writer()
+    if writer is not None:
+        return writer.submit(job)
+    future = Future()
+    future.set_running_or_notify_cancel()
+    conn = get_connection()
+    try:
+        with _db_lock:
+            try:
+                result = job(conn)
+                conn.commit()
+            except Exception as e:
+                try:
+                    conn.rollback()
+                except Exception:
+                    pass
+                _report_sql_failure(conn, e)
+                future.set_exception(e)
+                return future
+        future.set_result(result)
+        return future
+    finally:
+        close_connection(conn)
+
+
+def _run_write(job):
+    """Versión sincrónica de submit_write: retorna el resultado de job."""
+    _pin_reads()
+    token = _routing.set("write")
+    try:
+        return submit_write(job).result()
+    finally:
+        _routing.reset(token)
+
+
+def _execute_write(query, params=()):
+    """Ejecuta una única sentencia de escritura."""
+
+    def _job(conn):
+        conn.cursor().execute(query, params)
+
+    _run_write(_job)
+
+
+# --- LOGGING ---
+
+LOG_COLUMNS = ARCHIVE_COLUMNS["ticket_log"]
+
+
+class _AsyncLogWriter:
+    """
+    Escritura diferida de ticket_log: add_ticket_log encola el registro y un
+    hilo lo inserta en lotes con un único commit (group commit).
+    Los registros encolados siguen visibles en get_ticket_logs hasta que se
+    confirman, de modo que quien comenta ve su comentario de inmediato.
+    """
+
+    def __init__(self, maxsize=1000, batch_size=200, flush_interval=0.2, max_attempts=5):
+        self._queue = queue.Queue(maxsize)
+        self._batch_size = batch_size
+        self._flush_interval = flush_interval
+        self._max_attempts = max_attempts
+        self._pending = {}  # ticket_id -> [entry, ...]
+        self._pending_lock = threading.Lock()
+        # Se toma al confirmar un lote y al leer logs con pendientes, para que
+        # la lectura no vea un registro dos veces (en DB y en memoria).
+        self._flush_lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(
+            target=self._run, name="gestar-log-writer", daemon=True
+        )
+        self._thread.start()
+        atexit.register(self.close)
+
+    def submit(self, entry):
+        """Encola un registro. Retorna False si la cola está llena."""
+        if self._closed:
+            return False
+        with self._pending_lock:
+            self._pending.setdefault(entry["ticket_id"], []).append(entry)
+        try:
+            self._queue.put_nowait(entry)
+            return True
+        except queue.Full:
+            self._forget([entry])
+            return False
+
+    def has_pending(self, ticket_id):
+        with self._pending_lock:
+            return bool(self._pending.get(ticket_id))
+
+    def pending_for(self, ticket_id):
+        with self._pending_lock:
+            return list(self._pending.get(ticket_id, []))
+
+    def read_consistent(self, ticket_id, read_fn):
+        """Ejecuta read_fn y toma los pendientes sin carrera con un flush."""
+        with self._flush_lock:
+            return read_fn(), self.pending_for(ticket_id)
+
+    def _forget(self, entries):
+        with self._pending_lock:
+            for entry in entries:
+                items = self._pending.get(entry["ticket_id"], [])
+                if entry in items:
+                    items.remove(entry)
+                if not items:
+                    self._pending.pop(entry["ticket_id"], None)
+
+    def _run(self):
+        while True:
+            entry = self._queue.get()
+            if entry is None:
+                return
+            batch = [entry]
+            deadline = time.monotonic() + self._flush_interval
+            stop = False
+            while len(batch) < self._batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._flush(batch)
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
+
+    def _flush(self, batch):
+        params = [tuple(e[c] for c in LOG_COLUMNS[1:]) for e in batch]
+        attempt = 0
+        while True:
+            try:
+                with self._flush_lock:
+                    _insert_logs(params)
+                    self._forget(batch)
+                return
+            except Exception as e:
+                attempt += 1
+                logger.error(
+                    f"Log diferido: fallo al insertar {len(batch)} registros (intento {attempt}): {e}"
+                )
+                if attempt >= self._max_attempts or (self._closed and attempt >= 3):
+                    break
+                time.sleep(min(0.5 * (2 ** attempt), 30))
+        # Un lote que sigue fallando (FK de un ticket archivado, truncamiento)
+        # no debe frenar la cola: se reintenta de a un registro y se descartan
+        # sólo los que fallan
+        for entry, row in zip(batch, params):
+            try:
+                with self._flush_lock:
+                    _insert_logs([row])
+                    self._forget([entry])
+            except Exception as e:
+                logger.error(f"Log diferido: registro descartado {row}: {e}")
+                self._forget([entry])
+
+    def flush(self):
+        """Bloquea hasta que todo lo encolado esté confirmado."""
+        self._queue.join()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout=30)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_async_log_writer():
+    """Writer diferido del proceso, o None si GESTAR_ASYNC_LOG no está activo."""
+    if os.environ.get("GESTAR_ASYNC_LOG", "0").lower() not in ("1", "true", "yes"):
+        return None
+    return _AsyncLogWriter(
+        maxsize=int(os.environ.get("GESTAR_ASYNC_LOG_QUEUE", "1000"))
+    )
+
+
+def _insert_logs(params):
+    """Inserta registros con las columnas de LOG_COLUMNS salvo id, en ese orden."""
+    cols = LOG_COLUMNS[1:]
+
+    def _job(conn):
+        conn.cursor().executemany(
+            f"INSERT INTO ticket_log ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+            params,
+        )
+
+    _run_write(_job)
+
+
+def add_ticket_log(
+    ticket_id, author, event_type, message, meta_json=None, field=None, from_state=None, to_state=None
+):
+    """
+    Inserta un registro en el log del ticket. field/from_state/to_state
+    describen la transición cuando el evento cambia un campo.
+    """
+    entry = {
+        "ticket_id": int(ticket_id),
+        "created_at": get_now_utc().replace(tzinfo=None),
+        "author": author,
+        "event_type": event_type,
+        "message": message,
+        "meta_json": meta_json,
+        "field": field,
+        "from_state": from_state,
+        "to_state": to_state,
+    }
+    writer = _get_async_log_writer()
+    if writer and writer.submit(entry):
+        _pin_reads()
+        return
+    # Sin writer diferido (o cola llena): inserción sincrónica
+    _insert_logs([tuple(entry[c] for c in LOG_COLUMNS[1:])])
+
+
+@_read_only
+def get_ticket_logs(ticket_id):
+    """Retorna los logs de un ticket ordenados cronológicamente."""
+
+    def _read():
+        conn = get_connection()
+        try:
+            # ticket_log_all incluye el historial de tickets archivados
+            query = f"SELECT {', '.join(LOG_COLUMNS)} FROM ticket_log_all WHERE ticket_id = ? ORDER BY id ASC"
+            return pd.read_sql_query(
+                query,
+                conn,
+                params=(ticket_id,),
+            )
+        finally:
+            close_connection(conn)
+
+    writer = _get_async_log_writer()
+    if not writer or not writer.has_pending(int(ticket_id)):
+        return _read()
+    df, pending = writer.read_consistent(int(ticket_id), _read)
+    if not pending:
+        return df
+    df_pending = pd.DataFrame(pending, columns=LOG_COLUMNS)
+    return pd.concat([df, df_pending], ignore_index=True)
+
+
+@_read_only
+def get_ticket_log_stamp(ticket_id):
+    """
+    (cantidad, último id) del historial del ticket, con los pendientes del
+    writer diferido: alcanza para saber si cambió sin leer los mensajes.
+    """
+
+    def _read():
+        conn = get_connection()
+        try:
+            cur = conn.cursor()
+            cur.execute(
+                "SELECT COUNT(*), MAX(id) FROM ticket_log_all WHERE ticket_id = ?",
+                (ticket_id,),
+            )
+            count, last_id = cur.fetchone()
+            return int(count), (int(last_id) if last_id is not None else None)
+        finally:
+            close_connection(conn)
+
+    writer = _get_async_log_writer()
+    if not writer or not writer.has_pending(int(ticket_id)):
+        return _read()
+    (count, last_id), pending = writer.read_consistent(int(ticket_id), _read)
+    return count + len(pending), last_id
+
+
+# --- OUTBOX DE EVENTOS ---
+# Las escrituras de tickets agregan sus eventos a outbox en la misma
+# transacción (una fila por evento, sin importar cuántos suscriptores haya).
+# outbox.py los entrega a los sinks en segundo plano; cada sink avanza su
+# propio cursor en outbox_cursors.
+
+
+def _enqueue_event(cur, event_type, ticket_id, payload):
+    cur.execute(
+        "INSERT INTO outbox (event_type, ticket_id, payload_json) VALUES (?, ?, ?)",
+        (event_type, ticket_id, json.dumps(payload, default=str)),
+    )
+
+
+def _enqueue_events(cur, events):
+    """events: lista de (event_type, ticket_id, payload)."""
+    if not events:
+        return
+    cur.executemany(
+        "INSERT INTO outbox (event_type, ticket_id, payload_json) VALUES (?, ?, ?)",
+        [(e, t, json.dumps(p, default=str)) for e, t, p in events],
+    )
+
+
+def get_outbox_cursor(sink):
+    """
+    (last_id, attempts, last_error) del sink. Un sink nuevo arranca al final
+    del outbox: recibe los eventos desde que se registra, no el historial.
+    """
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "SELECT last_id, attempts, last_error FROM outbox_cursors WHERE sink = ?",
+            (sink,),
+        )
+        row = cur.fetchone()
+        if row:
+            return int(row[0]), int(row[1]), row[2]
+    finally:
+        close_connection(conn)
+
+    def _job(conn):
+        cur = conn.cursor()
+        cur.execute("SELECT COALESCE(MAX(id), 0) FROM outbox")
+        last_id = int(cur.fetchone()[0])
+        cur.execute(
+            "INSERT INTO outbox_cursors (sink, last_id, attempts, updated_at) VALUES (?, ?, 0, ?)",
+            (sink, last_id, _to_utc_naive(get_now_utc())),
+        )
+        return last_id
+
+    return _run_write(_job), 0, None
+
+
+def fetch_outbox(after_id, limit=100, settled=True):
+    """
+    Eventos con id > after_id en orden de id (lectura por rango de la PK). En
+    Azure SQL, con settled no entrega los más nuevos que FEED_SETTLE_SECONDS:
+    el dispatcher avanza el cursor hasta el último entregado y no debe saltear
+    un id que aún no confirmó. settled=False los incluye (quien avance con
+    _settled_cursor).
+    """
+    conn = get_connection()
+    try:
+        is_sql_server = _is_sql_server_conn(conn)
+        query = "SELECT id, created_at, event_type, ticket_id, payload_json FROM outbox WHERE id > ?"
+        params = [int(after_id)]
+        if settled and is_sql_server and FEED_SETTLE_SECONDS > 0:
+            query += " AND created_at < DATEADD(second, ?, SYSUTCDATETIME())"
+            params.append(-FEED_SETTLE_SECONDS)
+        query = _paged(query + " ORDER BY id", is_sql_server, limit)
+        cur = conn.cursor()
+        cur.execute(query, params)
+        return [
+            {
+                "id": int(r[0]),
+                "created_at": r[1],
+                "event_type": r[2],
+                "ticket_id": r[3],
+                "payload": json.loads(r[4]) if r[4] else None,
+            }
+            for r in cur.fetchall()
+        ]
+    finally:
+        close_connection(conn)
+
+
+def save_outbox_cursor(sink, last_id, attempts=0, last_error=None):
+    """Guarda el cursor del sink (desde el scheduler, sólo si sigue siendo líder)."""
+    fence = _lease_fence.get()
+
+    def _job(conn):
+        cur = conn.cursor()
+        lease_sql, lease_params = _lease_condition(conn, fence)
+        cur.execute(
+            """
+            UPDATE outbox_cursors
+            SET last_id = ?, attempts = ?, last_error = ?, updated_at = ?
+            WHERE sink = ?
+            """
+            + lease_sql,
+            (
+                int(last_id),
+                int(attempts),
+                (str(last_error)[:1000] if last_error is not None else None),
+                _to_utc_naive(get_now_utc()),
+                sink,
+            )
+            + lease_params,
+        )
+        if fence and cur.rowcount == 0:
+            raise _WatermarkMoved(f"outbox:{sink}")
+
+    _run_write(_job)
+
+
+def dead_letter_event(sink, event, attempts, error):
+    """Mueve un evento que agotó sus reintentos a outbox_dead_letter y lo saltea."""
+    fence = _lease_fence.get()
+
+    def _job(conn):
+        cur = conn.cursor()
+        lease_sql, lease_params = _lease_condition(conn, fence)
+        cur.execute(
+            """
+            INSERT INTO outbox_dead_letter
+            (outbox_id, sink, event_type, payload_json, attempts, error)
+            VALUES (?, ?, ?, ?, ?, ?)
+            """,
+            (
+                event["id"],
+                sink,
+                event["event_type"],
+                json.dumps(event["payload"], default=str),
+                int(attempts),
+                str(error)[:1000],
+            ),
+        )
+        cur.execute(
+            """
+            UPDATE outbox_cursors
+            SET last_id = ?, attempts = 0, last_error = NULL, updated_at = ?
+            WHERE sink = ?
+            """
+            + lease_sql,
+            (event["id"], _to_utc_naive(get_now_utc()), sink) + lease_params,
+        )
+        if fence and cur.rowcount == 0:
+            raise _WatermarkMoved(f"outbox:{sink}")
+
+    _run_write(_job)
+
+
+def get_outbox_status():
+    """Por sink: cursor, eventos pendientes, reintentos y eventos descartados."""
+    conn = get_connection()
+    try:
+        return pd.read_sql_query(
+            """
+            SELECT c.sink, c.last_id,
+                   (SELECT COUNT(*) FROM outbox o WHERE o.id > c.last_id) AS pendientes,
+                   c.attempts, c.last_error, c.updated_at,
+                   (SELECT COUNT(*) FROM outbox_dead_letter d WHERE d.sink = c.sink) AS descartados
+            FROM outbox_cursors c
+            ORDER BY c.sink
+            """,
+            conn,
+        )
+    finally:
+        close_connection(conn)
+
+
+def prune_outbox(days=7):
+    """
+    Borra los eventos de más de days días que ya entregaron todos los sinks.
+    Retorna la cantidad borrada.
+    """
+    cutoff = _to_utc_naive(get_now_utc()) - timedelta(days=days)
+
+    def _job(conn):
+        cur = conn.cursor()
+        cur.execute("SELECT MIN(last_id) FROM outbox_cursors")
+        row = cur.fetchone()
+        if row is None or row[0] is None:
+            cur.execute("DELETE FROM outbox WHERE created_at < ?", (cutoff,))
+        else:
+            cur.execute(
+                "DELETE FROM outbox WHERE id <= ? AND created_at < ?",
+                (int(row[0]), cutoff),
+            )
+        return cur.rowcount
+
+    return _run_write(_job)
+
+
+# --- TICKETS ---
+
+
+def create_ticket(data):
+    """
+    Crea un nuevo ticket.
+    data: dict con las columnas del ticket.
+    """
+    columns = (
+        "titulo", "descripcion", "area_destino", "categoria", "subcategoria", "division", "planta",
+        "prioridad", "urgencia_sugerida", "responsable_sugerido", "solicitante",
+        "created_by", "estado",
+    )
+    # Prioridad default a Media (o Null) si no se provee. Logica de negocio: Solicitante no define prioridad final.
+    prioridad = data.get("prioridad", "Media")
+
+    def _job(conn):
+        cursor = conn.cursor()
+        ticket_id = _insert_returning_id(
+            cursor,
+            "tickets",
+            columns,
+            (
+                data["titulo"],
+                data["descripcion"],
+                data["area_destino"],
+                data["categoria"],
+                data.get("subcategoria"),
+                data["division"],
+                data["planta"],
+                prioridad,
+                data.get("urgencia_sugerida"),
+                data.get("responsable_sugerido"),
+                data["solicitante"],
+                data.get("created_by"),
+                "NUEVO",
+            ),
+        )
+
+        # Log creation
+        if ticket_id:
+            cursor.execute(
+                """
+                INSERT INTO ticket_log (ticket_id, author, event_type, message, field, to_state)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """,
+                (
+                    ticket_id,
+                    data.get("created_by", "System"),
+                    "system",
+                    "Ticket creado.",
+                    "estado",
+                    "NUEVO",
+                ),
+            )
+            _bump_ticket_counter(cursor, "NUEVO", data["area_destino"], None, 1)
+            _set_due_at(
+                cursor, _is_sql_server_conn(conn), "id = ?", (ticket_id,), bump_version=False
+            )
+            _enqueue_event(
+                cursor,
+                "ticket.created",
+                ticket_id,
+                {
+                    "id": ticket_id,
+                    "titulo": data["titulo"],
+                    "area_destino": data["area_destino"],
+                    "categoria": data["categoria"],
+                    "prioridad": prioridad,
+                    "planta": data["planta"],
+                    "solicitante": data["solicitante"],
+                    "estado": "NUEVO",
+                    "author": data.get("created_by", "System"),
+                },
+            )
+        return ticket_id
+
+    return _run_write(_job)
+
+
+@_read_only
+def get_tickets(filters=None, include_archived=False, columns=None):
+    """
+    Retorna Tickets como DataFrame.
+    filters: dict opcional para filtrar.
+    include_archived: si es True lee también los tickets archivados
+    (vista tickets_all); por defecto sólo la tabla activa.
+    columns: proyección opcional (id se incluye siempre); por defecto todas.
+    Las columnas de pocos valores quedan como category y las fechas como
+    datetime (ver _compact_tickets).
+    """
+    conn = get_connection()
+    try:
+        cols = ", ".join(_ticket_projection(columns))
+        where, params = _build_ticket_filters(filters)
+        source = "tickets_all" if include_archived else "tickets"
+        query = f"SELECT {cols} FROM {source}{where}"
+        df = pd.read_sql_query(query, conn, params=params)
+        return _compact_tickets(df)
+    finally:
+        close_connection(conn)
+
+
+# Columnas de tickets con pocos valores distintos (dtype category) y fechas
+TICKET_CATEGORY_COLUMNS = [
+    "area_destino",
+    "categoria",
+    "subcategoria",
+    "division",
+    "planta",
+    "prioridad",
+    "urgencia_sugerida",
+    "estado",
+    "responsable_asignado",
+    "responsable_sugerido",
+]
+TICKET_DATE_COLUMNS = ["created_at", "updated_at", "closed_at", "due_at", "escalated_at"]
+
+
+def _ticket_projection(columns):
+    """Valida la proyección contra ALLOWED_COLUMNS; id siempre primero."""
+    if not columns:
+        return list(ALLOWED_COLUMNS["tickets"])
+    cols = [c for c in dict.fromkeys(columns) if c in ALLOWED_COLUMNS["tickets"]]
+    return ["id"] + [c for c in cols if c != "id"]
+
+
+def _compact_tickets(df):
+    """Pasa a category las columnas de pocos valores y parsea las fechas (UTC naive)."""
+    for col in TICKET_CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    for col in TICKET_DATE_COLUMNS:
+        if col in df.columns:
+            df[col] = pd.to_datetime(
+                df[col], errors="coerce", utc=True, format="ISO8601"
+            ).dt.tz_localize(None)
+    return df
+
+
+@_read_only
+def get_tickets_page(filters=None, after_id=0, limit=100, include_archived=False, columns=None):
+    """
+    Página de tickets en orden de id, con id > after_id (paginación por
+    clave: cada página es una lectura por rango de la PK). columns limita las
+    columnas leídas (por defecto todas las de ALLOWED_COLUMNS).
+    """
+    conn = get_connection()
+    try:
+        is_sql_server = _is_sql_server_conn(conn)
+        cols = _ticket_projection(columns)
+        where, params = _build_ticket_filters(filters)
+        where = f"{where} AND id > ?" if where else " WHERE id > ?"
+        params.append(int(after_id))
+        source = "tickets_all" if include_archived else "tickets"
+        query = _paged(
+            f"SELECT {', '.join(cols)} FROM {source}{where} ORDER BY id",
+            is_sql_server,
+            limit,
+        )
+        return _compact_tickets(pd.read_sql_query(query, conn, params=params))
+    finally:
+        close_connection(conn)
+
+
+def _build_ticket_filters(filters):
+    """Traduce el dict de filtros de tickets a (' WHERE ...', params)."""
+    params = []
+    conditions = []
+    for k, v in (filters or {}).items():
+        # Validar que la columna esté en el whitelist
+        if k not in ALLOWED_COLUMNS["tickets"]:
+            logger.warning(f"Intento de filtrar por columna no permitida: {k}")
+            continue
+
+        if v and v != "Todos" and v != "Todas":
+            # Handle list filters for IN clause
+            if isinstance(v, list):
+                placeholders = ",".join("?" * len(v))
+                conditions.append(f"{k} IN ({placeholders})")
+                params.extend(v)
+            else:
+                conditions.append(f"{k} = ?")
+                params.append(v)
+    if not conditions:
+        return "", params
+    return " WHERE " + " AND ".join(conditions), params
+
+
+# --- EDICIÓN MASIVA ---
+
+
+def _plain(value):
+    """Convierte escalares numpy/pandas a tipos nativos (NaN/NaT -> None)."""
+    if value is None or (not isinstance(value, (list, dict)) and pd.isna(value)):
+        return None
+    return value.item() if hasattr(value, "item") else value
+
+
+def diff_dataframes(base, edited, key="id", columns=None):
+    """
+    Compara dos DataFrames (p. ej. el original y el devuelto por
+    st.data_editor) y retorna {key: {columna: valor_nuevo}} sólo con las
+    celdas que cambiaron. La comparación es vectorizada y trata NaN/None
+    como iguales entre sí. Filas nuevas o eliminadas se ignoran.
+    """
+    if key not in base.columns or key not in edited.columns:
+        raise ValueError(f"Falta la columna clave '{key}'.")
+    cols = [
+        c
+        for c in (columns or edited.columns)
+        if c != key and c in base.columns and c in edited.columns
+    ]
+    if not cols:
+        return {}
+    b = base.drop_duplicates(key).set_index(key)
+    e = edited.drop_duplicates(key).set_index(key)
+    ids = e.index.intersection(b.index)
+    b_vals = b.loc[ids, cols].to_numpy(dtype=object)
+    e_vals = e.loc[ids, cols].to_numpy(dtype=object)
+
+    b_na = pd.isna(b_vals)
+    e_na = pd.isna(e_vals)
+    changed = (b_na != e_na) | (~b_na & ~e_na & (b_vals != e_vals))
+
+    result = {}
+    for r, c in zip(*changed.nonzero()):
+        result.setdefault(_plain(ids[r]), {})[cols[c]] = _plain(e_vals[r, c])
+    return result
+
+
+def _bulk_update(table, changes, on_job=None):
+    """
+    Ejecuta UPDATE ... WHERE id = ? para {id: {columna: valor}} en una única
+    transacción. Las filas que cambian las mismas columnas se agrupan en un
+    executemany. on_job(cur) corre en la misma transacción. Retorna filas.
+    Las columnas deben venir ya validadas contra una whitelist.
+    """
+    groups = {}
+    for row_id, updates in changes.items():
+        if not updates:
+            continue
+        cols = tuple(sorted(updates))
+        groups.setdefault(cols, []).append(
+            tuple(updates[c] for c in cols) + (row_id,)
+        )
+    if not groups:
+        return 0
+
+    def _job(conn):
+        cur = conn.cursor()
+        if _is_sql_server_conn(conn):
+            cur.fast_executemany = True
+        for cols, params in groups.items():
+            set_clause = ", ".join(f"{c} = ?" for c in cols)
+            cur.executemany(f"UPDATE {table} SET {set_clause} WHERE id = ?", params)
+        if on_job:
+            on_job(cur)
+
+    _run_write(_job)
+    return sum(len(p) for p in groups.values())
+
+
+# --- FOTOS VERSIONADAS ---
+
+# Segundos entre verificaciones de la versión de una foto en app_versions
+# (cambios hechos por otros procesos). Los del propio proceso son inmediatos.
+VERSION_CHECK_INTERVAL = int(os.environ.get("GESTAR_VERSION_CHECK_INTERVAL", "30"))
 
-            # Crear y sembrar tablas maestras (idempotente)
-            _ensure_master_tables(conn, is_sql_server)
-            _seed_master_data(conn)
 
-            # MIGRATION: Check if subcategoria exists in tickets
-            if not is_sql_server:
-                cur = conn.cursor()
-                cur.execute("PRAGMA table_info(tickets)")
-                columns = [col[1] for col in cur.fetchall()]
-                if "subcategoria" not in columns:
-                    conn.execute("ALTER TABLE tickets ADD COLUMN subcategoria TEXT")
+class _SnapshotCache:
+    """Contenedor por proceso de la foto vigente de un conjunto de datos."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshot = None
+        self.checked_at = 0.0
+
+
+@st.cache_resource(show_spinner=False)
+def _get_snapshot_cache(name):
+    return _SnapshotCache()
+
+
+def _read_version(name):
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT version FROM app_versions WHERE name = ?", (name,))
+        row = cur.fetchone()
+        return int(row[0]) if row else 0
+    finally:
+        close_connection(conn)
+
+
+def _get_versioned_snapshot(name, loader):
+    """
+    Retorna la foto cacheada de name (objeto con atributo version) o la
+    recarga con loader() si su versión en app_versions cambió. La versión se
+    verifica como máximo cada VERSION_CHECK_INTERVAL segundos.
+    """
+    cache = _get_snapshot_cache(name)
+    with cache.lock:
+        snap = cache.snapshot
+        now = time.monotonic()
+        if snap is not None and now - cache.checked_at < VERSION_CHECK_INTERVAL:
+            return snap
+        if snap is None or _read_version(name) != snap.version:
+            snap = loader()
+            cache.snapshot = snap
+        cache.checked_at = now
+        return snap
+
+
+def _drop_snapshot(name):
+    """Descarta la foto de name; la próxima lectura la recarga."""
+    cache = _get_snapshot_cache(name)
+    with cache.lock:
+        cache.snapshot = None
+
+
+# --- CATÁLOGO MAESTRO ---
+
+CatalogItem = namedtuple(
+    "CatalogItem",
+    ["id", "catalog", "label", "sort_order", "is_active", "parent_id", "sla_hours"],
+    defaults=(None,),
+)
+
+
+class CatalogSnapshot:
+    """
+    Foto inmutable de todas las maestras (master_catalogs + master_catalog_items)
+    leída en una sola consulta. Los items quedan enlazados padre/hijo y se
+    consultan por código de catálogo. version identifica la foto: cambia cada
+    vez que se modifica una maestra.
+    """
+
+    def __init__(self, version, catalogs, items):
+        self.version = version
+        # code -> (id, label, is_active)
+        self._catalogs = dict(catalogs)
+        self._items = {it.id: it for it in items}
+        roots, children = {}, {}
+        for it in items:
+            if it.parent_id is None:
+                roots.setdefault(it.catalog, []).append(it)
             else:
-                # SQL Server migration check: use dynamic SQL to avoid parse-time errors if table missing
-                cursor = conn.cursor()
-                cursor.execute(
-                    """
-                    IF OBJECT_ID('tickets','U') IS NOT NULL 
-                    BEGIN
-                    IF NOT EXISTS (SELECT 1 FROM sys.columns WHERE object_id = OBJECT_ID('tickets') AND name = 'subcategoria')
-                        BEGIN
-                            EXEC sp_executesql N'ALTER TABLE tickets ADD subcategoria NVARCHAR(MAX)';
-                        END
-                    END
-                    """
+                children.setdefault(it.parent_id, []).append(it)
+        self._roots = {k: tuple(v) for k, v in roots.items()}
+        self._children = {k: tuple(v) for k, v in children.items()}
+
+    def codes(self):
+        return list(self._catalogs)
+
+    def catalog(self, code):
+        """(id, label, is_active) del catálogo o None."""
+        return self._catalogs.get(code)
+
+    def item(self, item_id):
+        return self._items.get(item_id)
+
+    def parent(self, item):
+        return self._items.get(item.parent_id) if item.parent_id is not None else None
+
+    def _visible(self, code, include_inactive):
+        return include_inactive or bool(self._catalogs.get(code, (None, None, 0))[2])
+
+    def items(self, code, include_inactive=False):
+        """Items de primer nivel de un catálogo, ordenados."""
+        if not self._visible(code, include_inactive):
+            return ()
+        return tuple(
+            it for it in self._roots.get(code, ()) if include_inactive or it.is_active
+        )
+
+    def children(self, item, include_inactive=False):
+        return tuple(
+            it
+            for it in self._children.get(item.id, ())
+            if include_inactive or it.is_active
+        )
+
+    def labels(self, code, include_inactive=False):
+        return [it.label for it in self.items(code, include_inactive)]
+
+    def sla_hours(self, prioridad):
+        """Horas de SLA de una prioridad (None si no tiene o es <= 0)."""
+        for it in self._roots.get("prioridades", ()):
+            if it.label == prioridad:
+                return it.sla_hours if it.sla_hours and it.sla_hours > 0 else None
+        return None
+
+    def subcategories_map(self, include_inactive=False):
+        """Mapa categoria -> [subcategorias] (sólo categorías con hijos)."""
+        result = {}
+        for parent in self.items("categorias", include_inactive):
+            subs = self.children(parent, include_inactive)
+            if subs:
+                result[parent.label] = [it.label for it in subs]
+        return result
+
+
+def _load_catalog_snapshot():
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT c.id, c.code, c.label, c.is_active,
+                   i.id, i.label, i.sort_order, i.is_active, i.parent_item_id, i.sla_hours,
+                   (SELECT version FROM app_versions WHERE name = 'catalogs')
+            FROM master_catalogs c
+            LEFT JOIN master_catalog_items i ON i.catalog_id = c.id
+            ORDER BY c.code ASC, i.sort_order ASC, i.label ASC
+            """
+        )
+        rows = cur.fetchall()
+    finally:
+        close_connection(conn)
+
+    version = 0
+    catalogs, items = {}, []
+    for (
+        cat_id, code, cat_label, cat_active, item_id, label, sort_order, active, parent_id,
+        sla_hours, ver,
+    ) in rows:
+        version = int(ver or 0)
+        catalogs[code] = (int(cat_id), cat_label, int(cat_active or 0))
+        if item_id is not None:
+            items.append(
+                CatalogItem(
+                    int(item_id),
+                    code,
+                    label,
+                    int(sort_order or 0),
+                    int(active or 0),
+                    int(parent_id) if parent_id is not None else None,
+                    int(sla_hours) if sla_hours is not None else None,
                 )
+            )
+    return CatalogSnapshot(version, catalogs, items)
+
+
+def get_catalog_snapshot():
+    """
+    Retorna la foto vigente del catálogo maestro (CatalogSnapshot).
+    Se recarga cuando cambia la versión 'catalogs' en app_versions.
+    """
+    return _get_versioned_snapshot("catalogs", _load_catalog_snapshot)
+
+
+def clear_master_cache():
+    """Descarta la foto del catálogo; la próxima lectura la recarga."""
+    _drop_snapshot("catalogs")
+
+
+def get_master_items(catalog_code, include_inactive=False):
+    """Retorna labels de un catálogo maestro ordenados."""
+    return get_catalog_snapshot().labels(catalog_code, include_inactive)
+
+
+def get_subcategories_map(include_inactive=False):
+    """Retorna mapa categoria -> [subcategorias]."""
+    return get_catalog_snapshot().subcategories_map(include_inactive)
+
+
+def get_master_catalogs():
+    """Retorna catálogo de maestras disponibles."""
+    snap = get_catalog_snapshot()
+    rows = []
+    for code in snap.codes():
+        cat_id, label, active = snap.catalog(code)
+        rows.append((cat_id, code, label, active))
+    df = pd.DataFrame(rows, columns=["id", "code", "label", "is_active"])
+    return df.sort_values("label", ignore_index=True)
+
+
+def get_master_items_admin(catalog_code, parent_item_id=None):
+    """Retorna items de maestra para administración."""
+    snap = get_catalog_snapshot()
+    if parent_item_id is None:
+        items = snap.items(catalog_code, include_inactive=True)
+    else:
+        parent = snap.item(int(parent_item_id))
+        items = snap.children(parent, include_inactive=True) if parent else ()
+    parent_label = parent.label if parent_item_id is not None and parent else None
+    return pd.DataFrame(
+        [
+            (it.id, it.label, it.sort_order, it.is_active, it.sla_hours, it.parent_id, parent_label)
+            for it in items
+        ],
+        columns=[
+            "id", "label", "sort_order", "is_active", "sla_hours", "parent_item_id", "parent_label",
+        ],
+    )
+
+
+def create_master_item(catalog_code, label, sort_order=0, parent_item_id=None):
+    """Crea un item maestro si no existe. Retorna su id (None si ya existía)."""
+    if not label or not str(label).strip():
+        raise ValueError("Label de maestra vacío.")
+
+    label = str(label).strip()
+
+    def _job(conn):
+        cur = conn.cursor()
+        cur.execute("SELECT id FROM master_catalogs WHERE code = ?", (catalog_code,))
+        row = cur.fetchone()
+        if not row:
+            raise ValueError(f"Catálogo inexistente: {catalog_code}")
+        catalog_id = int(row[0])
+
+        if parent_item_id is None:
+            cur.execute(
+                """
+                SELECT id FROM master_catalog_items
+                WHERE catalog_id = ? AND label = ? AND parent_item_id IS NULL
+                """,
+                (catalog_id, label),
+            )
+        else:
+            cur.execute(
+                """
+                SELECT id FROM master_catalog_items
+                WHERE catalog_id = ? AND label = ? AND parent_item_id = ?
+                """,
+                (catalog_id, label, parent_item_id),
+            )
+
+        if cur.fetchone():
+            return None
+
+        item_id = _insert_returning_id(
+            cur,
+            "master_catalog_items",
+            ("catalog_id", "label", "sort_order", "is_active", "parent_item_id"),
+            (catalog_id, label, int(sort_order), 1, parent_item_id),
+        )
+        _bump_version(cur, "catalogs")
+        return item_id
+
+    item_id = _run_write(_job)
+    if item_id:
+        clear_master_cache()
+    return item_id
+
+
+def update_master_item(item_id, updates):
+    """Actualiza un item de maestra."""
+    update_master_items_bulk({item_id: updates})
+
+
+def update_master_items_bulk(changes):
+    """
+    Aplica {item_id: {columna: valor}} en una sola transacción (ver
+    diff_dataframes). Retorna la cantidad de items actualizados.
+    """
+    allowed = {"label", "sort_order", "is_active", "parent_item_id", "sla_hours"}
+    normalized = {}
+    for item_id, updates in changes.items():
+        updates = {k: v for k, v in updates.items() if k in allowed}
+        if "sort_order" in updates:
+            updates["sort_order"] = int(updates["sort_order"])
+        if "sla_hours" in updates:
+            value = updates["sla_hours"]
+            updates["sla_hours"] = None if value is None or pd.isna(value) else int(value)
+        if "is_active" in updates:
+            updates["is_active"] = 1 if updates["is_active"] else 0
+        normalized[item_id] = updates
+    sla_ids = [int(i) for i, u in normalized.items() if "sla_hours" in u]
+
+    def _on_job(cur):
+        _bump_version(cur, "catalogs")
+        if sla_ids:
+            # Cambió el SLA: vencimiento nuevo para los abiertos de esas prioridades
+            states = sorted(CLOSED_STATES)
+            _set_due_at(
+                cur,
+                _is_sql_server_conn(cur.connection),
+                f"""estado NOT IN ({",".join("?" * len(states))}) AND prioridad IN (
+                    SELECT label FROM master_catalog_items
+                    WHERE id IN ({",".join("?" * len(sla_ids))})
+                )""",
+                states + sla_ids,
+            )
+
+    n = _bulk_update("master_catalog_items", normalized, on_job=_on_job)
+    if n:
+        clear_master_cache()
+    return n
+
+
+# --- GESTION DE USUARIOS ---
+
+
+UserRecord = namedtuple("UserRecord", ALLOWED_COLUMNS["users"])
+
+
+class UserDirectory:
+    """
+    Foto inmutable de la tabla users leída en una sola consulta, con índices
+    por id, nombre, email (sin distinguir mayúsculas) y la forma
+    "Nombre <email>", más agrupaciones por área y por rol.
+    """
+
+    def __init__(self, version, users):
+        self.version = version
+        self._users = tuple(users)
+        self._by_id = {}
+        self._by_name = {}
+        self._by_email = {}
+        self._by_area = {}
+        self._by_role = {}
+        for u in self._users:
+            self._by_id[u.id] = u
+            self._by_name.setdefault(u.nombre_completo, u)
+            if u.email:
+                self._by_email.setdefault(u.email.lower(), u)
+                self._by_name.setdefault(f"{u.nombre_completo} <{u.email}>", u)
+            self._by_area.setdefault(u.area, []).append(u)
+            self._by_role.setdefault(u.rol, []).append(u)
+
+    def users(self, only_active=False):
+        return [u for u in self._users if u.activo or not only_active]
+
+    def names(self, only_active=False):
+        return [u.nombre_completo for u in self.users(only_active)]
+
+    def by_id(self, user_id):
+        return self._by_id.get(user_id)
+
+    def by_name(self, name):
+        """Busca por nombre completo o por "Nombre <email>"."""
+        return self._by_name.get(name)
+
+    def by_email(self, email):
+        return self._by_email.get(email.lower()) if email else None
+
+    def in_area(self, area, only_active=True):
+        return [u for u in self._by_area.get(area, ()) if u.activo or not only_active]
+
+    def with_role(self, rol, only_active=True):
+        return [u for u in self._by_role.get(rol, ()) if u.activo or not only_active]
+
+
+def _load_user_directory():
+    conn = get_connection()
+    try:
+        cols = ", ".join(ALLOWED_COLUMNS["users"])
+        cur = conn.cursor()
+        cur.execute(
+            f"""
+            SELECT {cols}, (SELECT version FROM app_versions WHERE name = 'users')
+            FROM users
+            ORDER BY nombre_completo ASC
+            """
+        )
+        rows = cur.fetchall()
+    finally:
+        close_connection(conn)
+    version = int(rows[0][-1] or 0) if rows else _read_version("users")
+    return UserDirectory(version, [UserRecord(*row[:-1]) for row in rows])
+
+
+def get_user_directory():
+    """
+    Retorna el directorio de usuarios vigente (UserDirectory), compartido por
+    todas las sesiones del proceso. Se recarga cuando cambia la versión
+    'users' en app_versions.
+    """
+    return _get_versioned_snapshot("users", _load_user_directory)
+
+
+def get_users(only_active=False):
+    """Retorna un DataFrame con todos los usuarios."""
+    return pd.DataFrame(
+        get_user_directory().users(only_active), columns=ALLOWED_COLUMNS["users"]
+    )
+
+
+def clear_users_cache():
+    """Invalida la caché de usuarios."""
+    _drop_snapshot("users")
+
+
+def create_user(data):
+    """Crea un nuevo usuario. Retorna su id."""
+    params = (
+        data["nombre_completo"],
+        data.get("email"),
+        data.get("rol", "Solicitante"),
+        data.get("area"),
+        data.get("activo", 1),
+    )
+
+    def _job(conn):
+        cur = conn.cursor()
+        user_id = _insert_returning_id(
+            cur, "users", ("nombre_completo", "email", "rol", "area", "activo"), params
+        )
+        _bump_version(cur, "users")
+        return user_id
+
+    user_id = _run_write(_job)
+    clear_users_cache()
+    return user_id
+
+
+def update_user(user_id, updates):
+    """Actualiza datos de un usuario."""
+    update_users_bulk({user_id: updates})
+
+
+def update_users_bulk(changes):
+    """
+    Aplica {user_id: {columna: valor}} en una sola transacción (ver
+    diff_dataframes). Retorna la cantidad de usuarios actualizados.
+    """
+    normalized = {}
+    for user_id, updates in changes.items():
+        # Whitelist check
+        updates = {
+            k: v for k, v in updates.items() if k in ALLOWED_COLUMNS["users"] and k != "id"
+        }
+        if "activo" in updates:
+            updates["activo"] = 1 if updates["activo"] else 0
+        normalized[user_id] = updates
+    n = _bulk_update("users", normalized, on_job=lambda cur: _bump_version(cur, "users"))
+    if n:
+        clear_users_cache()
+    return n
+
+
+def get_user_by_name(name):
+    """Busca un usuario por su nombre completo (o "Nombre <email>")."""
+    user = get_user_directory().by_name(name)
+    return user._asdict() if user else None
+
+
+@_read_only
+def get_ticket_by_id(ticket_id):
+    """
+    Retorna un ticket específico como Series (None si no existe). Busca
+    también en el archivo; archivado = 1 indica un ticket de sólo lectura.
+    """
+    conn = get_connection()
+    try:
+        cols = ", ".join(ALLOWED_COLUMNS["tickets"])
+        query = f"SELECT {cols}, archivado FROM tickets_all WHERE id = ?"
+        df = pd.read_sql_query(query, conn, params=(ticket_id,))
+        if not df.empty:
+            return df.iloc[0]
+        return None
+    finally:
+        close_connection(conn)
+
+
+_TRANSITION_LOG_SQL = """
+    INSERT INTO ticket_log
+    (ticket_id, author, event_type, message, meta_json, field, from_state, to_state)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+class ConcurrencyError(Exception):
+    """El ticket cambió desde que se leyó (su version no es la esperada)."""
+
+
+def update_ticket(ticket_id, updates, author="System", expected_version=None):
+    """
+    Actualiza campos de un ticket y registra cambios en el log.
+    updates: dict con {campo: valor}
+    author: usuario que realiza el cambio
+    expected_version: version del ticket que vio el usuario (get_ticket_by_id).
+    El UPDATE es condicional (WHERE id = ? AND version = ?): si otra sesión u
+    otra instancia lo modificó antes se lanza ConcurrencyError y no se aplica
+    ningún cambio.
+    """
+    conflict = (
+        f"El ticket #{ticket_id} fue modificado por otro usuario. "
+        "Revise los datos actuales y vuelva a guardar."
+    )
+
+    def _job(conn):
+        # Get current state for comparison
+        current = pd.read_sql_query(
+            "SELECT * FROM tickets WHERE id = ?", conn, params=(ticket_id,)
+        )
+        if current.empty:
+            return
+        current = current.iloc[0]
+        version = int(current["version"])
+        if expected_version is not None and int(expected_version) != version:
+            raise ConcurrencyError(conflict)
+        cur = conn.cursor()
+
+        # Whitelist check (id y version no se editan)
+        filtered_updates = {
+            k: v
+            for k, v in updates.items()
+            if k in ALLOWED_COLUMNS["tickets"] and k not in ("id", "version")
+        }
+        filtered_updates["updated_at"] = get_now_utc()
+        # If closed/resolved, set closed_at
+        if (
+            filtered_updates.get("estado") in ["RESUELTO", "CERRADO"]
+            and not current["closed_at"]
+        ):
+            filtered_updates["closed_at"] = get_now_utc()
+
+        # Perform Update (sólo si nadie lo cambió desde la lectura)
+        set_clause = ", ".join([f"{k} = ?" for k in filtered_updates.keys()])
+        values = list(filtered_updates.values()) + [ticket_id, version]
+        cur.execute(
+            f"UPDATE tickets SET {set_clause}, version = version + 1 WHERE id = ? AND version = ?",
+            values,
+        )
+        if cur.rowcount == 0:
+            raise ConcurrencyError(conflict)
+
+        # Detect changes and log
+        if "estado" in updates and updates["estado"] != current["estado"]:
+            msg = f"Cambio de estado: {current['estado']} -> {updates['estado']}"
+            meta = json.dumps({"from": current["estado"], "to": updates["estado"]})
+            cur.execute(
+                _TRANSITION_LOG_SQL,
+                (ticket_id, author, "status_change", msg, meta, "estado", current["estado"], updates["estado"]),
+            )
+
+        if (
+            "responsable_asignado" in updates
+            and updates["responsable_asignado"] != current["responsable_asignado"]
+        ):
+            old = (
+                current["responsable_asignado"]
+                if current["responsable_asignado"]
+                else "Sin Asignar"
+            )
+            new = updates["responsable_asignado"]
+            msg = f"Asignación: {old} -> {new}"
+            cur.execute(
+                _TRANSITION_LOG_SQL,
+                (
+                    ticket_id, author, "assignment", msg, None,
+                    "responsable_asignado", _plain(current["responsable_asignado"]), new,
+                ),
+            )
+
+        if "prioridad" in updates and updates["prioridad"] != current["prioridad"]:
+            msg = (
+                f"Prioridad cambiada: {current['prioridad']} -> {updates['prioridad']}"
+            )
+            cur.execute(
+                _TRANSITION_LOG_SQL,
+                (
+                    ticket_id, author, "priority_change", msg, None,
+                    "prioridad", _plain(current["prioridad"]), updates["prioridad"],
+                ),
+            )
+            _set_due_at(
+                cur, _is_sql_server_conn(conn), "id = ?", (ticket_id,), bump_version=False
+            )
 
-            # Check if users table is empty and populate initial users
-            cur = conn.cursor()
-            cur.execute("SELECT count(*) FROM users")
-            if cur.fetchone()[0] == 0:
-                from models import USERS_PROV
+        old_key = _counter_key(
+            current["estado"],
+            current["area_destino"],
+            current["responsable_asignado"],
+        )
+        new_key = _counter_key(
+            filtered_updates.get("estado", current["estado"]),
+            filtered_updates.get("area_destino", current["area_destino"]),
+            filtered_updates.get(
+                "responsable_asignado", current["responsable_asignado"]
+            ),
+        )
+        if old_key != new_key:
+            _bump_ticket_counter(cur, *old_key, -1)
+            _bump_ticket_counter(cur, *new_key, 1)
+
+        changes = {
+            k: {"from": _plain(current[k]), "to": _plain(v)}
+            for k, v in filtered_updates.items()
+            if k not in ("updated_at", "closed_at") and _plain(current[k]) != _plain(v)
+        }
+        if changes:
+            _enqueue_event(
+                cur,
+                "ticket.updated",
+                ticket_id,
+                {
+                    "id": ticket_id,
+                    "area_destino": filtered_updates.get("area_destino", current["area_destino"]),
+                    "estado": filtered_updates.get("estado", current["estado"]),
+                    "author": author,
+                    "version": version + 1,
+                    "changes": changes,
+                },
+            )
 
-                # Primary Admin
-                if is_sql_server:
-                    cur.execute(
-                        "INSERT INTO users (nombre_completo, email, rol, area, activo) VALUES (?, ?, ?, ?, 1)",
-                        (
-                            "Gauto, Pablo",
-                            "gautop@taranto.com.ar",
-                            "Administrador",
-                            "Sistemas",
-                        ),
-                    )
-                else:
-                    conn.execute(
-                        "INSERT INTO users (nombre_completo, email, rol, area, activo) VALUES (?, ?, ?, ?, 1)",
-                        (
-                            "Gauto, Pablo",
-                            "gautop@taranto.com.ar",
-                            "Administrador",
-                            "Sistemas",
-                        ),
-                    )
+    _run_write(_job)
 
-                for u in USERS_PROV:
-                    # Basic parsing "Name <email>"
-                    if " <" in u:
-                        name, email = u.split(" <")
-                        email = email.rstrip(">")
-                    else:
-                        name, email = u, ""
 
-                    # Assign default for current list
-                    role = "Analista"
-                    area = "IT"  # Default to IT for initial list
-                    if "Ranea" in name:
-                        area = "Ing. Procesos"
-                    if "Vazquez" in name:
-                        area = "Sistemas"  # Placeholder
+# --- CONTADORES DE BANDEJA ---
 
-                    if is_sql_server:
-                        cur.execute(
-                            "INSERT INTO users (nombre_completo, email, rol, area, activo) VALUES (?, ?, ?, ?, 1)",
-                            (name, email, role, area),
-                        )
-                    else:
-                        conn.execute(
-                            "INSERT INTO users (nombre_completo, email, rol, area, activo) VALUES (?, ?, ?, ?, 1)",
-                            (name, email, role, area),
-                        )
 
-            # Check if empty and populate tickets
-            cur.execute("SELECT count(*) FROM tickets")
-            if cur.fetchone()[0] == 0:
-                populate_samples(conn)
+# Ancho de estado, area_destino y responsable_asignado en ticket_counters
+COUNTER_KEY_WIDTHS = (50, 150, 200)
 
-            conn.commit()
-            clear_master_cache()
-        st.session_state["db_initialized"] = True
-    finally:
-        close_connection(conn)
 
+def _counter_key(estado, area_destino, responsable_asignado):
+    """
+    Clave de ticket_counters: los NULL se guardan como cadena vacía y cada
+    valor se recorta al ancho de su columna (NVARCHAR en Azure SQL).
+    """
+    return tuple(
+        "" if v is None or v != v else str(v)[:width]
+        for v, width in zip((estado, area_destino, responsable_asignado), COUNTER_KEY_WIDTHS)
+    )
 
-def populate_samples(conn):
-    """Carga datos de ejemplo."""
-    tickets_data = [
-        (
-            "Falla en Impresora",
-            "La impresora de RRHH no conecta en red.",
-            "IT",
-            "Hardware",
-            "Administración",
-            "Planta 1",
-            "Media",
-            "Media",
-            "Juan Perez",
-            None,
-            "NUEVO",
-            "Maria Garcia",
-            "Maria Garcia",
-        ),
-        (
-            "Mantenimiento AA",
-            "Aire acondicionado de sala de reuniones gotea.",
-            "Mantenimiento",
-            "Infraestructura",
-            "Administración",
-            "Planta 1",
-            "Baja",
-            "Baja",
-            "Luis Gomez",
-            "Carlos Ruiz",
-            "ASIGNADO",
-            "Pedro Martinez",
-            "Pedro Martinez",
-        ),
-        (
-            "Error en validación",
-            "El sistema de calidad da error 500 al guardar.",
-            "IT",
-            "Software",
-            "Calidad",
-            "Planta 2",
-            "Alta",
-            "Alta",
-            "Ana Lopez",
-            None,
-            "NUEVO",
-            "Juan Lopez",
-            "Juan Lopez",
-        ),
-        (
-            "Solicitud de Notebook",
-            "Notebook para nuevo ingreso.",
-            "IT",
-            "Hardware",
-            "RRHH",
-            "Planta 1",
-            "Media",
-            "Media",
-            None,
-            "Juan Perez",
-            "EN PROCESO",
-            "Maria Garcia",
-            "Maria Garcia",
-        ),
-    ]
 
-    cur = conn.cursor()
-    for t in tickets_data:
+def _bump_ticket_counter(cur, estado, area_destino, responsable_asignado, delta):
+    """Suma delta al contador; debe llamarse dentro de la transacción de escritura."""
+    key = _counter_key(estado, area_destino, responsable_asignado)
+    if _is_sql_server_conn(cur.connection):
+        # UPDATE + INSERT compite entre instancias (dos primeros incrementos
+        # insertan la misma clave): MERGE con HOLDLOCK lo hace atómico
         cur.execute(
             """
-            INSERT INTO tickets (
-                titulo, descripcion, area_destino, categoria, division, planta,
-                prioridad, urgencia_sugerida, responsable_sugerido, responsable_asignado,
-                estado, solicitante, created_by
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            MERGE ticket_counters WITH (HOLDLOCK) AS c
+            USING (SELECT ? AS estado, ? AS area_destino, ? AS responsable_asignado) AS k
+            ON c.estado = k.estado AND c.area_destino = k.area_destino
+               AND c.responsable_asignado = k.responsable_asignado
+            WHEN MATCHED THEN UPDATE SET n = c.n + ?
+            WHEN NOT MATCHED THEN
+                INSERT (estado, area_destino, responsable_asignado, n)
+                VALUES (k.estado, k.area_destino, k.responsable_asignado, ?);
+            """,
+            key + (delta, delta),
+        )
+        return
+    # SQLite: el UPDATE ya toma el lock de escritura de la base hasta el commit
+    cur.execute(
+        """
+        UPDATE ticket_counters SET n = n + ?
+        WHERE estado = ? AND area_destino = ? AND responsable_asignado = ?
         """,
-            t,
+        (delta,) + key,
+    )
+    if cur.rowcount == 0:
+        cur.execute(
+            """
+            INSERT INTO ticket_counters (estado, area_destino, responsable_asignado, n)
+            VALUES (?, ?, ?, ?)
+            """,
+            key + (delta,),
         )
 
-        ticket_id = _get_lastrowid(cur, conn)
 
-        # Add sample task if not NEW
-        if ticket_id and t[10] != "NUEVO":
+def _reconcile_counters(cur):
+    """
+    Recalcula los contadores desde tickets (activos + archivados, para que los
+    totales no cambien al archivar) y corrige los que difieren.
+    """
+    cur.execute(
+        """
+        SELECT estado, area_destino, responsable_asignado, COUNT(*)
+        FROM tickets_all
+        GROUP BY estado, area_destino, responsable_asignado
+        """
+    )
+    expected = {}
+    for estado, area, resp, n in cur.fetchall():
+        key = _counter_key(estado, area, resp)
+        expected[key] = expected.get(key, 0) + int(n)
+
+    cur.execute(
+        "SELECT estado, area_destino, responsable_asignado, n FROM ticket_counters"
+    )
+    actual = {(r[0], r[1], r[2]): int(r[3]) for r in cur.fetchall()}
+
+    fixed = 0
+    for key in set(expected) | set(actual):
+        want, have = expected.get(key, 0), actual.get(key)
+        if have == want:
+            continue
+        fixed += 1
+        if have is None:
             cur.execute(
-                "INSERT INTO tasks (ticket_id, descripcion, responsable, estado) VALUES (?, ?, ?, ?)",
-                (
-                    ticket_id,
-                    f"Investigar {t[0]}",
-                    t[9] if t[9] else "Sin Asignar",
-                    "PENDIENTE",
-                ),
+                """
+                INSERT INTO ticket_counters (estado, area_destino, responsable_asignado, n)
+                VALUES (?, ?, ?, ?)
+                """,
+                key + (want,),
+            )
+        elif want == 0:
+            cur.execute(
+                """
+                DELETE FROM ticket_counters
+                WHERE estado = ? AND area_destino = ? AND responsable_asignado = ?
+                """,
+                key,
+            )
+        else:
+            cur.execute(
+                """
+                UPDATE ticket_counters SET n = ?
+                WHERE estado = ? AND area_destino = ? AND responsable_asignado = ?
+                """,
+                (want,) + key,
             )
+    return fixed
 
-        # Add init log
-        if ticket_id:
+
+def reconcile_ticket_counters():
+    """Job de reconciliación: corrige deriva de ticket_counters. Retorna claves corregidas."""
+    fixed = _run_write(lambda conn: _reconcile_counters(conn.cursor()))
+    if fixed:
+        logger.warning(f"ticket_counters: {fixed} contadores corregidos")
+    return fixed
+
+
+@_read_only
+def get_ticket_count(estado=None, area_destino=None, responsable_asignado=None):
+    """
+    Cantidad de tickets leída de ticket_counters. Cada filtro acepta un valor
+    o una lista; None/"Todos"/"Todas" no filtra.
+    """
+    conditions = []
+    params = []
+    for (col, value), width in zip(
+        (
+            ("estado", estado),
+            ("area_destino", area_destino),
+            ("responsable_asignado", responsable_asignado),
+        ),
+        COUNTER_KEY_WIDTHS,
+    ):
+        if not value or value in ("Todos", "Todas"):
+            continue
+        values = value if isinstance(value, list) else [value]
+        conditions.append(f"{col} IN ({','.join('?' * len(values))})")
+        params.extend(str(v)[:width] for v in values)
+    query = "SELECT COALESCE(SUM(n), 0) FROM ticket_counters"
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(query, params)
+        return int(cur.fetchone()[0])
+    finally:
+        close_connection(conn)
+
+
+# --- ÍNDICE DE TICKETS ABIERTOS ---
+# Las vistas de bandeja (COLA, MIS TICKETS, EN PROCESO) son subconjuntos de
+# los tickets no cerrados, que son pocos. OpenTicketIndex los mantiene en
+# memoria (uno por proceso) con índices invertidos por estado, área y
+# responsable. Se actualiza de forma incremental leyendo outbox por cursor de
+# id (toda escritura de tickets deja ahí su evento) y releyendo sólo los
+# tickets que cambiaron; cada OPEN_INDEX_RELOAD segundos se recarga entero.
+
+OPEN_INDEX_COLUMNS = [
+    "id",
+    "titulo",
+    "estado",
+    "prioridad",
+    "area_destino",
+    "responsable_asignado",
+    "solicitante",
+    "updated_at",
+]
+OPEN_INDEX_KEYS = ["estado", "area_destino", "responsable_asignado"]
+OPEN_INDEX_REFRESH = float(os.environ.get("GESTAR_OPEN_INDEX_REFRESH", "2"))
+OPEN_INDEX_RELOAD = int(os.environ.get("GESTAR_OPEN_INDEX_RELOAD", "600"))
+_OPEN_INDEX_MAX_EVENTS = 5000
+
+
+class OpenTicketIndex:
+    def __init__(self):
+        self._rows = {}
+        self._index = {k: {} for k in OPEN_INDEX_KEYS}
+        self._cursor = None
+        self._checked = 0.0
+        self._loaded = 0.0
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+
+    # -- consulta --
+
+    def query(self, estado=None, area_destino=None, responsable_asignado=None, columns=None):
+        """
+        Tickets abiertos que cumplen los filtros (mismas reglas que
+        get_tickets: valor o lista; None/"Todos"/"Todas" no filtra), en
+        orden de id, como DataFrame con columns (default OPEN_INDEX_COLUMNS).
+        """
+        self.refresh()
+        cols = [c for c in (columns or OPEN_INDEX_COLUMNS) if c in OPEN_INDEX_COLUMNS]
+        positions = [OPEN_INDEX_COLUMNS.index(c) for c in cols]
+        with self._lock:
+            ids = self._match(
+                {"estado": estado, "area_destino": area_destino, "responsable_asignado": responsable_asignado}
+            )
+            records = [tuple(self._rows[i][p] for p in positions) for i in sorted(ids)]
+        return _compact_tickets(pd.DataFrame.from_records(records, columns=cols))
+
+    def count(self, estado=None, area_destino=None, responsable_asignado=None):
+        self.refresh()
+        with self._lock:
+            return len(
+                self._match(
+                    {"estado": estado, "area_destino": area_destino, "responsable_asignado": responsable_asignado}
+                )
+            )
+
+    def _match(self, filters):
+        result = None
+        for key, value in filters.items():
+            if value is None or value in ("Todos", "Todas"):
+                continue
+            values = value if isinstance(value, (list, tuple, set)) else [value]
+            ids = set()
+            for v in values:
+                ids |= self._index[key].get(v, set())
+            result = ids if result is None else result & ids
+            if not result:
+                return set()
+        return set(self._rows) if result is None else result
+
+    # -- actualización --
+    # Las lecturas a la base se hacen fuera de _lock (que sólo protege los
+    # diccionarios) y el resultado se aplica bajo él: una consulta a Azure SQL
+    # lenta no frena a las sesiones que sólo leen el índice. _refresh_lock
+    # serializa las actualizaciones entre sí.
+
+    @staticmethod
+    def _add(rows, index, row):
+        ticket_id = row[0]
+        rows[ticket_id] = row
+        for key in OPEN_INDEX_KEYS:
+            value = row[OPEN_INDEX_COLUMNS.index(key)]
+            index[key].setdefault(value, set()).add(ticket_id)
+
+    @staticmethod
+    def _discard(rows, index, ticket_id):
+        row = rows.pop(ticket_id, None)
+        if row is None:
+            return
+        for key in OPEN_INDEX_KEYS:
+            value = row[OPEN_INDEX_COLUMNS.index(key)]
+            ids = index[key].get(value)
+            if ids is not None:
+                ids.discard(ticket_id)
+                if not ids:
+                    del index[key][value]
+
+    def refresh(self, force=False):
+        """
+        Aplica los cambios pendientes (a lo sumo cada OPEN_INDEX_REFRESH s).
+        Una sesión que acaba de escribir actualiza una vez por escritura
+        (read-your-writes), no en cada consulta de la página.
+        """
+        pin = _read_pin_token()
+        synced = pin is None or _session_store().get("_open_index_pin") == pin
+        if not force and synced and time.monotonic() - self._checked < OPEN_INDEX_REFRESH:
+            return
+        # Sin apuro, si otra sesión ya está actualizando se usa lo que hay
+        if not self._refresh_lock.acquire(blocking=bool(force or not synced)):
+            return
+        try:
+            now = time.monotonic()
+            if not force and synced and now - self._checked < OPEN_INDEX_REFRESH:
+                return
+            self._checked = now
+            if self._cursor is None or now - self._loaded > OPEN_INDEX_RELOAD:
+                self._reload()
+            else:
+                self._apply_changes()
+            if pin is not None:
+                _session_store()["_open_index_pin"] = pin
+        finally:
+            self._refresh_lock.release()
+
+    def _reload(self):
+        conn = get_connection()
+        try:
+            cur = conn.cursor()
+            # El cursor se lee antes que los tickets: lo escrito durante la
+            # carga se vuelve a aplicar en la próxima actualización
+            cur.execute("SELECT COALESCE(MAX(id), 0) FROM outbox")
+            cursor = int(cur.fetchone()[0])
+            placeholders = ",".join("?" * len(CLOSED_STATES))
+            cur.execute(
+                f"SELECT {', '.join(OPEN_INDEX_COLUMNS)} FROM tickets WHERE estado NOT IN ({placeholders})",
+                CLOSED_STATES,
+            )
+            fetched = cur.fetchall()
+        finally:
+            close_connection(conn)
+        rows, index = {}, {k: {} for k in OPEN_INDEX_KEYS}
+        for row in fetched:
+            self._add(rows, index, tuple(row))
+        with self._lock:
+            self._rows, self._index = rows, index
+            self._cursor = cursor
+        self._loaded = time.monotonic()
+
+    def _apply_changes(self):
+        # Sin ventana: las escrituras recientes se ven ya (read-your-writes);
+        # _settled_cursor evita saltear ids confirmados fuera de orden
+        events = fetch_outbox(self._cursor, _OPEN_INDEX_MAX_EVENTS, settled=False)
+        if not events:
+            return
+        if len(events) == _OPEN_INDEX_MAX_EVENTS:
+            self._reload()
+            return
+        changed = {e["ticket_id"] for e in events if e["ticket_id"] is not None}
+        fetched = _fetch_open_index_rows(changed)
+        with self._lock:
+            for ticket_id in changed:
+                self._discard(self._rows, self._index, ticket_id)
+                row = fetched.get(ticket_id)
+                if row is not None and row[OPEN_INDEX_COLUMNS.index("estado")] not in CLOSED_STATES:
+                    self._add(self._rows, self._index, row)
+            self._cursor = _settled_cursor(self._cursor, events)
+
+    def info(self):
+        with self._lock:
+            return {
+                "tickets": len(self._rows),
+                "cursor": self._cursor,
+                "estados": {k: len(v) for k, v in self._index["estado"].items()},
+            }
+
+
+def _fetch_open_index_rows(ticket_ids, chunk=500):
+    """{id: fila} de los tickets indicados (los borrados no aparecen)."""
+    ids = list(ticket_ids)
+    result = {}
+    conn = get_connection()
+    try:
+        cur = conn.cursor()
+        for start in range(0, len(ids), chunk):
+            part = ids[start:start + chunk]
+            cur.execute(
+                f"SELECT {', '.join(OPEN_INDEX_COLUMNS)} FROM tickets WHERE id IN ({','.join('?' * len(part))})",
+                part,
+            )
+            for row in cur.fetchall():
+                result[row[0]] = tuple(row)
+    finally:
+        close_connection(conn)
+    return result
+
+
+def _settled_cursor(cursor, events):
+    """
+    Nuevo cursor tras aplicar events. En Azure SQL los id IDENTITY pueden
+    confirmarse fuera de orden: el cursor sólo avanza sobre eventos más viejos
+    que FEED_SETTLE_SECONDS, y los recientes se releen (releer es idempotente).
+    """
+    if not _resolve_conn_str() or FEED_SETTLE_SECONDS <= 0:
+        return events[-1]["id"]
+    horizon = _to_utc_naive(get_now_utc()) - timedelta(seconds=FEED_SETTLE_SECONDS)
+    for event in events:
+        created = _to_utc_naive(event["created_at"])
+        if created is None or created >= horizon:
+            break
+        cursor = event["id"]
+    return cursor
+
+
+@st.cache_resource(show_spinner=False)
+def get_open_ticket_index():
+    """Índice de tickets abiertos compartido por todas las sesiones del proceso."""
+    return OpenTicketIndex()
+
+
+# --- TASKS ---
+
+
+def create_task(ticket_id, descripcion, responsable, author="System"):
+    """Crea una tarea PENDIENTE para el ticket y la registra en el log. Retorna su id."""
+
+    def _job(conn):
+        cur = conn.cursor()
+        task_id = _insert_returning_id(
+            cur,
+            "tasks",
+            ("ticket_id", "descripcion", "responsable", "estado"),
+            (ticket_id, descripcion, responsable, "PENDIENTE"),
+        )
+        cur.execute(
+            _TRANSITION_LOG_SQL,
+            (
+                ticket_id,
+                author,
+                "task_created",
+                f"Tarea creada: {descripcion}",
+                json.dumps({"task_id": task_id, "responsable": responsable}),
+                "tarea.estado",
+                None,
+                "PENDIENTE",
+            ),
+        )
+        return task_id
+
+    return _run_write(_job)
+
+
+@_read_only
+def get_tasks_for_ticket(ticket_id):
+    conn = get_connection()
+    try:
+        cols = ", ".join(ALLOWED_COLUMNS["tasks"])
+        query = f"SELECT {cols} FROM tasks_all WHERE ticket_id = ?"
+        return pd.read_sql_query(query, conn, params=(ticket_id,))
+    finally:
+        close_connection(conn)
+
+
+def update_task_status(task_id, new_status, author="System"):
+    """Cambia el estado de una tarea y lo registra en el log del ticket."""
+
+    def _job(conn):
+        cur = conn.cursor()
+        cur.execute("SELECT ticket_id, estado FROM tasks WHERE id = ?", (task_id,))
+        row = cur.fetchone()
+        if row is None:
+            return
+        cur.execute("UPDATE tasks SET estado = ? WHERE id = ?", (new_status, task_id))
+        if row[1] != new_status:
             cur.execute(
-                "INSERT INTO ticket_log (ticket_id, author, event_type, message) VALUES (?, ?, ?, ?)",
-                (ticket_id, "System", "system", "Ticket creado con datos de ejemplo."),
+                _TRANSITION_LOG_SQL,
+                (
+                    row[0],
+                    author,
+                    "task_status",
+                    f"Tarea {task_id}: {row[1]} -> {new_status}",
+                    json.dumps({"task_id": task_id, "from": row[1], "to": new_status}),
+                    "tarea.estado",
+                    row[1],
+                    new_status,
+                ),
             )
 
-    conn.commit()
+    _run_write(_job)
 
 
-# --- LOGGING ---
+@_read_only
+def get_tasks_by_user(user_name):
+    """Retorna tareas asignadas a un usuario específico."""
+    conn = get_connection()
+    try:
+        cols_tasks = ", ".join([f"t.{c}" for c in ALLOWED_COLUMNS["tasks"]])
+        query = f"""
+            SELECT {cols_tasks}, tk.titulo as ticket_titulo 
+            FROM tasks t 
+            JOIN tickets tk ON t.ticket_id = tk.id 
+            WHERE t.responsable = ? AND t.estado != 'COMPLETADA'
+        """
+        return pd.read_sql_query(
+            query,
+            conn,
+            params=(user_name,),
+        )
+    finally:
+        close_connection(conn)
 
 
-def add_ticket_log(ticket_id, author, event_type, message, meta_json=None):
-    """Inserta un registro en el log del ticket."""
+# --- IMPORTACIÓN MASIVA ---
+
+# Columnas de tickets que acepta la importación masiva (orden del INSERT)
+IMPORT_TICKET_COLUMNS = [
+    "titulo",
+    "descripcion",
+    "area_destino",
+    "categoria",
+    "subcategoria",
+    "division",
+    "planta",
+    "prioridad",
+    "urgencia_sugerida",
+    "responsable_sugerido",
+    "responsable_asignado",
+    "estado",
+    "solicitante",
+    "created_by",
+    "created_at",
+    "closed_at",
+]
+
+
+def _import_ref(job_key, row_number):
+    # Zero-padding para que el rango de un lote sea un BETWEEN sobre el índice
+    return f"{job_key}:{int(row_number):010d}"
+
+
+def get_import_job(job_key):
+    """Retorna el estado de un job de importación (dict) o None."""
     conn = get_connection()
     try:
         cur = conn.cursor()
-        with _db_lock:
-            cur.execute(
-                """
-                INSERT INTO ticket_log (ticket_id, author, event_type, message, meta_json)
-                VALUES (?, ?, ?, ?, ?)
+        cur.execute(
+            """
+            SELECT job_key, source, status, rows_done, rows_imported, rows_rejected
+            FROM import_jobs WHERE job_key = ?
             """,
-                (ticket_id, author, event_type, message, meta_json),
-            )
-            conn.commit()
+            (job_key,),
+        )
+        row = cur.fetchone()
+        if not row:
+            return None
+        return {
+            "job_key": row[0],
+            "source": row[1],
+            "status": row[2],
+            "rows_done": int(row[3]),
+            "rows_imported": int(row[4]),
+            "rows_rejected": int(row[5]),
+        }
     finally:
         close_connection(conn)
 
 
-def get_ticket_logs(ticket_id):
-    """Retorna los logs de un ticket ordenados cronológicamente."""
+def start_import_job(job_key, source):
+    """Registra un job de importación (idempotente) y retorna su estado."""
+    if ":" in job_key:
+        raise ValueError("El identificador de importación no puede contener ':'.")
+
+    def _job(conn):
+        cur = conn.cursor()
+        cur.execute("SELECT 1 FROM import_jobs WHERE job_key = ?", (job_key,))
+        if not cur.fetchone():
+            cur.execute(
+                "INSERT INTO import_jobs (job_key, source, status) VALUES (?, ?, 'EN CURSO')",
+                (job_key, source),
+            )
+        else:
+            cur.execute(
+                "UPDATE import_jobs SET status = 'EN CURSO', updated_at = ? WHERE job_key = ?",
+                (get_now_utc(), job_key),
+            )
+
+    _run_write(_job)
+    return get_import_job(job_key)
+
+
+def get_import_rejects(job_key):
+    """Filas rechazadas de un job: lista de (fila, motivo, datos_json) por fila."""
     conn = get_connection()
     try:
-        query = "SELECT id, ticket_id, created_at, author, event_type, message, meta_json FROM ticket_log WHERE ticket_id = ? ORDER BY id ASC"
-        return pd.read_sql_query(
-            query,
-            conn,
-            params=(ticket_id,),
+        cur = conn.cursor()
+        cur.execute(
+            """
+            SELECT row_num, reason, raw_json FROM import_rejects
+            WHERE job_key = ? ORDER BY row_num
+            """,
+            (job_key,),
         )
+        return [(int(r[0]), r[1], r[2]) for r in cur.fetchall()]
     finally:
         close_connection(conn)
 
 
-# --- TICKETS ---
+def finish_import_job(job_key, status="FINALIZADO"):
+    _execute_write(
+        "UPDATE import_jobs SET status = ?, updated_at = ? WHERE job_key = ?",
+        (status, get_now_utc(), job_key),
+    )
 
 
-def create_ticket(data):
+def bulk_insert_tickets(
+    job_key, tickets, rows_done, rows_rejected=0, author="System", rejects=None
+):
     """
-    Crea un nuevo ticket.
-    data: dict con las columnas del ticket.
+    Inserta un lote de tickets importados junto con su log de creación.
+    tickets: lista de (numero_de_fila, dict) ya validados.
+    rows_done: filas del archivo consumidas al terminar este lote (checkpoint).
+    rejects: lista opcional de (numero_de_fila, motivo, fila_original); se
+    guardan en import_rejects y reemplazan a rows_rejected en el conteo.
+    Tickets, logs, rechazos y checkpoint se confirman en una única transacción,
+    por lo que un fallo a mitad de lote no deja filas huérfanas ni rechazos
+    duplicados y la importación puede reanudarse desde rows_done.
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    query = """
-        INSERT INTO tickets (
-            titulo, descripcion, area_destino, categoria, subcategoria, division, planta,
-            prioridad, urgencia_sugerida, responsable_sugerido, solicitante,
-            created_by, estado
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    rejects = rejects or []
+    if rejects:
+        rows_rejected = len(rejects)
+    cols = IMPORT_TICKET_COLUMNS + ["import_ref"]
+    query = f"""
+        INSERT INTO tickets ({", ".join(cols)})
+        VALUES ({", ".join("?" * len(cols))})
     """
-    # Prioridad default a Media (o Null) si no se provee. Logica de negocio: Solicitante no define prioridad final.
-    prioridad = data.get("prioridad", "Media")
+    now = get_now_utc()
+    params = []
+    refs = []
+    deltas = {}
+    for row_number, data in tickets:
+        values = [data.get(c) for c in IMPORT_TICKET_COLUMNS]
+        values[IMPORT_TICKET_COLUMNS.index("estado")] = data.get("estado") or "NUEVO"
+        values[IMPORT_TICKET_COLUMNS.index("created_at")] = data.get("created_at") or now
+        values.append(_import_ref(job_key, row_number))
+        params.append(tuple(values))
+        refs.append((values[-1], data))
+        key = _counter_key(
+            data.get("estado") or "NUEVO",
+            data.get("area_destino"),
+            data.get("responsable_asignado"),
+        )
+        deltas[key] = deltas.get(key, 0) + 1
 
-    try:
-        with _db_lock:
-            cursor.execute(
-                query,
-                (
-                    data["titulo"],
-                    data["descripcion"],
-                    data["area_destino"],
-                    data["categoria"],
-                    data.get("subcategoria"),
-                    data["division"],
-                    data["planta"],
-                    prioridad,
-                    data.get("urgencia_sugerida"),
-                    data.get("responsable_sugerido"),
-                    data["solicitante"],
-                    data.get("created_by"),
-                    "NUEVO",
-                ),
+    def _job(conn):
+        cur = conn.cursor()
+        if params:
+            if _is_sql_server_conn(conn):
+                cur.fast_executemany = True
+            cur.executemany(query, params)
+            _set_due_at(
+                cur,
+                _is_sql_server_conn(conn),
+                "import_ref BETWEEN ? AND ?",
+                (params[0][-1], params[-1][-1]),
+                bump_version=False,
             )
-            ticket_id = _get_lastrowid(cursor, conn)
-
-            # Log creation
-            if ticket_id:
-                cursor.execute(
-                    """
-                    INSERT INTO ticket_log (ticket_id, author, event_type, message)
-                    VALUES (?, ?, ?, ?)
+            cur.execute(
+                """
+                INSERT INTO ticket_log
+                (ticket_id, created_at, author, event_type, message, field, to_state)
+                SELECT id, created_at, COALESCE(created_by, ?), 'system', ?, 'estado', estado
+                FROM tickets
+                WHERE import_ref BETWEEN ? AND ?
                 """,
+                (author, f"Ticket importado ({job_key}).", params[0][-1], params[-1][-1]),
+            )
+            for key, delta in deltas.items():
+                _bump_ticket_counter(cur, *key, delta)
+            cur.execute(
+                "SELECT id, import_ref FROM tickets WHERE import_ref BETWEEN ? AND ?",
+                (params[0][-1], params[-1][-1]),
+            )
+            by_ref = {ref: data for ref, data in refs}
+            _enqueue_events(
+                cur,
+                [
                     (
-                        ticket_id,
-                        data.get("created_by", "System"),
-                        "system",
-                        "Ticket creado.",
-                    ),
-                )
+                        "ticket.created",
+                        int(tid),
+                        {
+                            "id": int(tid),
+                            "titulo": by_ref[ref].get("titulo"),
+                            "area_destino": by_ref[ref].get("area_destino"),
+                            "categoria": by_ref[ref].get("categoria"),
+                            "prioridad": by_ref[ref].get("prioridad"),
+                            "planta": by_ref[ref].get("planta"),
+                            "solicitante": by_ref[ref].get("solicitante"),
+                            "estado": by_ref[ref].get("estado") or "NUEVO",
+                            "author": author,
+                            "import_job": job_key,
+                        },
+                    )
+                    for tid, ref in cur.fetchall()
+                    if ref in by_ref
+                ],
+            )
+        if rejects:
+            cur.executemany(
+                """
+                INSERT INTO import_rejects (job_key, row_num, reason, raw_json)
+                VALUES (?, ?, ?, ?)
+                """,
+                [
+                    (job_key, int(n), reason, json.dumps(raw, default=str, ensure_ascii=False))
+                    for n, reason, raw in rejects
+                ],
+            )
+        cur.execute(
+            """
+            UPDATE import_jobs
+            SET rows_done = ?,
+                rows_imported = rows_imported + ?,
+                rows_rejected = rows_rejected + ?,
+                updated_at = ?
+            WHERE job_key = ?
+            """,
+            (int(rows_done), len(params), int(rows_rejected), now, job_key),
+        )
 
-            conn.commit()
-        return ticket_id
-    finally:
-        close_connection(conn)
+    _run_write(_job)
+    return len(params)
+
+
+# --- LECTURA EN STREAMING ---
+
+DEFAULT_FETCH_BATCH = 5000
 
 
-def get_tickets(filters=None):
+def _iter_query(query, params=(), batch_size=DEFAULT_FETCH_BATCH):
     """
-    Retorna Tickets como DataFrame.
-    filters: dict opcional para filtrar.
+    Ejecuta una consulta en una conexión dedicada y genera DataFrames de a
+    batch_size filas usando cursor.fetchmany, sin materializar el resultado.
+    Como es sólo lectura, puede abrirse contra la réplica.
     """
-    conn = get_connection()
+    token = _routing.set("read")
     try:
-        cols = ", ".join(ALLOWED_COLUMNS["tickets"])
-        query = f"SELECT {cols} FROM tickets"
-        params = []
-        if filters:
-            conditions = []
-            for k, v in filters.items():
-                # Validar que la columna esté en el whitelist
-                if k not in ALLOWED_COLUMNS["tickets"]:
-                    logger.warning(f"Intento de filtrar por columna no permitida: {k}")
-                    continue
+        conn = _open_dedicated_connection()
+    finally:
+        _routing.reset(token)
+    try:
+        cur = conn.cursor()
+        cur.execute(query, params)
+        columns = [d[0] for d in cur.description]
+        while True:
+            rows = cur.fetchmany(batch_size)
+            if not rows:
+                break
+            yield pd.DataFrame.from_records([tuple(r) for r in rows], columns=columns)
+    finally:
+        conn.close()
 
-                if v and v != "Todos" and v != "Todas":
-                    # Handle list filters for IN clause
-                    if isinstance(v, list):
-                        placeholders = ",".join("?" * len(v))
-                        conditions.append(f"{k} IN ({placeholders})")
-                        params.extend(v)
-                    else:
-                        conditions.append(f"{k} = ?")
-                        params.append(v)
-            if conditions:
-                query += " WHERE " + " AND ".join(conditions)
 
-        df = pd.read_sql_query(query, conn, params=params)
-        return df
-    finally:
-        close_connection(conn)
+def _iter_with_archive(table, query_for, params, batch_size, include_archived):
+    """
+    Recorre primero {table}_archive y luego la tabla activa, cada una en
+    orden de clave primaria (sin ordenar la unión completa).
+    """
+    if include_archived:
+        yield from _iter_query(query_for(f"{table}_archive"), params, batch_size)
+    yield from _iter_query(query_for(table), params, batch_size)
+
+
+def iter_tickets(filters=None, batch_size=DEFAULT_FETCH_BATCH, include_archived=True):
+    """Genera los tickets (mismos filtros que get_tickets) en bloques."""
+    cols = ", ".join(ALLOWED_COLUMNS["tickets"])
+    where, params = _build_ticket_filters(filters)
+    return _iter_with_archive(
+        "tickets",
+        lambda source: f"SELECT {cols} FROM {source}{where} ORDER BY id ASC",
+        params,
+        batch_size,
+        include_archived,
+    )
 
 
-@st.cache_data(ttl=600)
-def get_master_items(catalog_code, include_inactive=False):
-    """Retorna labels de un catálogo maestro ordenados."""
-    conn = get_connection()
-    try:
-        query = """
-            SELECT i.label
-            FROM master_catalog_items i
-            INNER JOIN master_catalogs c ON c.id = i.catalog_id
-            WHERE c.code = ?
-              AND i.parent_item_id IS NULL
-        """
-        params = [catalog_code]
-        if not include_inactive:
-            query += " AND c.is_active = 1 AND i.is_active = 1"
-        query += " ORDER BY i.sort_order ASC, i.label ASC"
-        df = pd.read_sql_query(query, conn, params=params)
-        return df["label"].tolist() if not df.empty else []
-    finally:
-        close_connection(conn)
+def iter_tasks(ticket_id=None, batch_size=DEFAULT_FETCH_BATCH, include_archived=True):
+    """Genera las tareas (opcionalmente de un ticket) en bloques."""
+    cols = ", ".join(ALLOWED_COLUMNS["tasks"])
+    where, params = "", []
+    if ticket_id is not None:
+        where = " WHERE ticket_id = ?"
+        params.append(ticket_id)
+    return _iter_with_archive(
+        "tasks",
+        lambda source: f"SELECT {cols} FROM {source}{where} ORDER BY id ASC",
+        params,
+        batch_size,
+        include_archived,
+    )
 
 
-@st.cache_data(ttl=600)
-def get_subcategories_map(include_inactive=False):
-    """Retorna mapa categoria -> [subcategorias]."""
+def iter_ticket_logs(ticket_id=None, batch_size=DEFAULT_FETCH_BATCH, include_archived=True):
+    """Genera el historial (opcionalmente de un ticket) en bloques."""
+    cols = ", ".join(LOG_COLUMNS)
+    where, params = "", []
+    if ticket_id is not None:
+        where = " WHERE ticket_id = ?"
+        params.append(ticket_id)
+    return _iter_with_archive(
+        "ticket_log",
+        lambda source: f"SELECT {cols} FROM {source}{where} ORDER BY id ASC",
+        params,
+        batch_size,
+        include_archived,
+    )
+
+
+# --- FEED DE CAMBIOS ---
+# Consumidores externos (BI, reportes) leen "lo que pasó desde X" sobre
+# ticket_log (cambios de tickets, comentarios y eventos de tareas) con
+# lecturas por rango de la clave primaria: WHERE id > ? ORDER BY id.
+# Cada consumidor guarda su posición en feed_checkpoints y avanza a su ritmo.
+
+FEED_COLUMNS = LOG_COLUMNS
+# En Azure SQL los id IDENTITY pueden confirmarse fuera de orden: no se
+# entregan filas más nuevas que esto (según logged_at, que pone el servidor)
+# para no saltear una que aún no confirmó.
+FEED_SETTLE_SECONDS = int(os.environ.get("GESTAR_FEED_SETTLE_SECONDS", "2"))
+
+
+def get_feed_checkpoint(consumer):
+    """Último id procesado por el consumidor (0 si es nuevo)."""
     conn = get_connection()
     try:
-        query = """
-            SELECT p.label AS categoria, c.label AS subcategoria
-            FROM master_catalog_items c
-            INNER JOIN master_catalog_items p ON p.id = c.parent_item_id
-            INNER JOIN master_catalogs cat ON cat.id = c.catalog_id
-            WHERE cat.code = 'categorias'
-        """
-        if not include_inactive:
-            query += (
-                " AND cat.is_active = 1 AND p.is_active = 1 AND c.is_active = 1"
-            )
-        query += " ORDER BY p.sort_order ASC, c.sort_order ASC, c.label ASC"
-
-        df = pd.read_sql_query(query, conn)
-        result = {}
-        if df.empty:
-            return result
-        for _, row in df.iterrows():
-            result.setdefault(row["categoria"], []).append(row["subcategoria"])
-        return result
+        cur = conn.cursor()
+        cur.execute("SELECT last_id FROM feed_checkpoints WHERE consumer = ?", (consumer,))
+        row = cur.fetchone()
+        return int(row[0]) if row else 0
     finally:
         close_connection(conn)
 
 
-def clear_master_cache():
-    get_master_items.clear()
-    get_subcategories_map.clear()
+def save_feed_checkpoint(consumer, last_id):
+    """Guarda (upsert) la posición del consumidor."""
+    now = _to_utc_naive(get_now_utc())
+
+    def _job(conn):
+        cur = conn.cursor()
+        if _is_sql_server_conn(conn):
+            # Atómico entre instancias (ver _bump_ticket_counter)
+            cur.execute(
+                """
+                MERGE feed_checkpoints WITH (HOLDLOCK) AS f
+                USING (SELECT ? AS consumer) AS k ON f.consumer = k.consumer
+                WHEN MATCHED THEN UPDATE SET last_id = ?, updated_at = ?
+                WHEN NOT MATCHED THEN
+                    INSERT (consumer, last_id, updated_at) VALUES (k.consumer, ?, ?);
+                """,
+                (consumer, int(last_id), now, int(last_id), now),
+            )
+            return
+        cur.execute(
+            "UPDATE feed_checkpoints SET last_id = ?, updated_at = ? WHERE consumer = ?",
+            (int(last_id), now, consumer),
+        )
+        if cur.rowcount == 0:
+            cur.execute(
+                "INSERT INTO feed_checkpoints (consumer, last_id, updated_at) VALUES (?, ?, ?)",
+                (consumer, int(last_id), now),
+            )
 
+    _run_write(_job)
 
-@st.cache_data(ttl=600)
-def get_master_catalogs():
-    """Retorna catálogo de maestras disponibles."""
+
+def get_feed_checkpoints():
+    """Posición de cada consumidor y cuántos eventos tiene pendientes."""
     conn = get_connection()
     try:
-        query = """
-            SELECT id, code, label, is_active
-            FROM master_catalogs
-            ORDER BY label ASC
-        """
-        return pd.read_sql_query(query, conn)
+        return pd.read_sql_query(
+            """
+            SELECT f.consumer, f.last_id,
+                   (SELECT COUNT(*) FROM ticket_log l WHERE l.id > f.last_id) AS pendientes,
+                   f.updated_at
+            FROM feed_checkpoints f
+            ORDER BY f.consumer
+            """,
+            conn,
+        )
     finally:
         close_connection(conn)
 
 
-@st.cache_data(ttl=600)
-def get_master_items_admin(catalog_code, parent_item_id=None):
-    """Retorna items de maestra para administración."""
+@_read_only
+def _read_events(since_id, batch_size):
     conn = get_connection()
     try:
-        query = """
-            SELECT i.id, i.label, i.sort_order, i.is_active, i.parent_item_id,
-                   p.label AS parent_label
-            FROM master_catalog_items i
-            INNER JOIN master_catalogs c ON c.id = i.catalog_id
-            LEFT JOIN master_catalog_items p ON p.id = i.parent_item_id
-            WHERE c.code = ?
-        """
-        params = [catalog_code]
-        if parent_item_id is None:
-            query += " AND i.parent_item_id IS NULL"
-        else:
-            query += " AND i.parent_item_id = ?"
-            params.append(parent_item_id)
-        query += " ORDER BY i.sort_order ASC, i.label ASC"
+        is_sql_server = _is_sql_server_conn(conn)
+        cols = ", ".join(FEED_COLUMNS)
+        query = f"SELECT {cols} FROM ticket_log WHERE id > ?"
+        params = [int(since_id)]
+        if is_sql_server and FEED_SETTLE_SECONDS > 0:
+            query += " AND logged_at < DATEADD(second, ?, SYSUTCDATETIME())"
+            params.append(-FEED_SETTLE_SECONDS)
+        query = _paged(query + " ORDER BY id", is_sql_server, batch_size)
         return pd.read_sql_query(query, conn, params=params)
     finally:
         close_connection(conn)
 
 
-def clear_master_admin_cache():
-    get_master_catalogs.clear()
-    get_master_items_admin.clear()
+def stream_events(since_id=None, batch_size=500, consumer=None):
+    """
+    Genera en bloques (DataFrames, orden de id) los eventos de ticket_log con
+    id > since_id. Cada bloque es una sola lectura por rango de la PK.
+    Con consumer, si since_id es None se parte de su checkpoint y el
+    checkpoint avanza cuando se pide el bloque siguiente (el anterior ya se
+    procesó) y al terminar: entrega "al menos una vez". Los eventos que ya
+    pasaron al archivo o fueron purgados por retención no se reenvían.
+    """
+    if since_id is None:
+        since_id = get_feed_checkpoint(consumer) if consumer else 0
+    last_id = int(since_id)
+    while True:
+        df = _read_events(last_id, batch_size)
+        if df.empty:
+            return
+        yield df
+        last_id = int(df["id"].iloc[-1])
+        if consumer:
+            save_feed_checkpoint(consumer, last_id)
+        if len(df) < batch_size:
+            return
 
 
-def create_master_item(catalog_code, label, sort_order=0, parent_item_id=None):
-    """Crea un item maestro si no existe."""
-    if not label or not str(label).strip():
-        raise ValueError("Label de maestra vacío.")
+# --- MÉTRICAS SLA (ROLLUPS INCREMENTALES) ---
 
-    label = str(label).strip()
-    conn = get_connection()
+SLA_METRICS = {"asignacion": "Tiempo a asignar", "cierre": "Tiempo a cerrar"}
+CLOSED_STATES = ["RESUELTO", "CERRADO"]
+# Eventos más recientes que esto se dejan para la próxima pasada, por si
+# todavía hay transacciones con ids menores sin confirmar.
+ROLLUP_SETTLE_SECONDS = 30
+
+
+def _to_utc_naive(value):
+    """Normaliza timestamps (str de SQLite o datetime de pyodbc) a UTC naive."""
+    if value is None:
+        return None
+    if isinstance(value, str):
+        try:
+            value = datetime.fromisoformat(value)
+        except ValueError:
+            return None
+    if value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _paged(query, is_sql_server, limit):
+    """Agrega un límite de filas a una consulta SELECT según el backend."""
+    if is_sql_server:
+        return query.replace("SELECT", f"SELECT TOP ({int(limit)})", 1)
+    return f"{query} LIMIT {int(limit)}"
+
+
+def _get_rollup_watermark(cur, name):
+    cur.execute("SELECT last_id FROM rollup_state WHERE name = ?", (name,))
+    row = cur.fetchone()
+    if row:
+        return int(row[0])
+    cur.execute(
+        "INSERT INTO rollup_state (name, last_id, updated_at) VALUES (?, 0, ?)",
+        (name, get_now_utc()),
+    )
+    return 0
+
+
+class _WatermarkMoved(Exception):
+    """
+    Otra ejecución avanzó la marca de agua, o esta instancia perdió el lease
+    del scheduler: el lote se descarta (rollback).
+    """
+
+
+def _advance_rollup_watermark(cur, name, old_id, new_id, fence=None):
+    """
+    Compare-and-set de la marca de agua: sólo avanza si sigue en old_id (y,
+    con fence, si el lease sigue siendo de esta instancia). Si dos ejecuciones
+    leen la misma marca, la segunda hace rollback de su lote en lugar de
+    acumularlo dos veces.
+    """
+    lease_sql, lease_params = _lease_condition(cur.connection, fence)
+    cur.execute(
+        "UPDATE rollup_state SET last_id = ?, updated_at = ? WHERE name = ? AND last_id = ?"
+        + lease_sql,
+        (new_id, get_now_utc(), name, old_id) + lease_params,
+    )
+    if cur.rowcount == 0:
+        raise _WatermarkMoved(name)
+
+
+def _classify_transition(old, new):
+    """Retorna la métrica SLA que cierra un cambio de estado old -> new, o None."""
+    if new == "ASIGNADO" and old == "NUEVO":
+        return "asignacion"
+    if new in CLOSED_STATES and old not in CLOSED_STATES:
+        return "cierre"
+    return None
+
+
+def _meta_transition(meta_json):
+    """(from, to) de un meta_json de cambio de estado (registros previos a to_state)."""
     try:
-        cur = conn.cursor()
-        with _db_lock:
-            cur.execute("SELECT id FROM master_catalogs WHERE code = ?", (catalog_code,))
-            row = cur.fetchone()
-            if not row:
-                raise ValueError(f"Catálogo inexistente: {catalog_code}")
-            catalog_id = int(row[0])
+        meta = json.loads(meta_json) if meta_json else {}
+    except (TypeError, ValueError):
+        return None, None
+    if not isinstance(meta, dict):
+        return None, None
+    return meta.get("from"), meta.get("to")
 
-            if parent_item_id is None:
-                cur.execute(
-                    """
-                    SELECT id FROM master_catalog_items
-                    WHERE catalog_id = ? AND label = ? AND parent_item_id IS NULL
-                    """,
-                    (catalog_id, label),
-                )
-            else:
-                cur.execute(
-                    """
-                    SELECT id FROM master_catalog_items
-                    WHERE catalog_id = ? AND label = ? AND parent_item_id = ?
-                    """,
-                    (catalog_id, label, parent_item_id),
-                )
 
-            if cur.fetchone():
-                return
+def refresh_sla_rollups(batch_size=5000):
+    """
+    Procesa los cambios de estado nuevos de ticket_log (id > marca de agua) y
+    acumula conteos y duraciones en sla_rollup. Retorna eventos procesados.
+    """
+    settle_limit = _to_utc_naive(get_now_utc()) - pd.Timedelta(
+        seconds=ROLLUP_SETTLE_SECONDS
+    )
+    fence = _lease_fence.get()
 
+    def _job(conn):
+        """Procesa un lote; retorna (eventos, hay_mas)."""
+        cur = conn.cursor()
+        is_sql_server = _is_sql_server_conn(conn)
+        # En SQL Server la ventana se mide con logged_at (hora del servidor):
+        # created_at lo pone el cliente y puede llegar ya "viejo"
+        settled = (
+            "CASE WHEN l.logged_at < DATEADD(second, ?, SYSUTCDATETIME()) THEN 1 ELSE 0 END"
+            if is_sql_server
+            else "NULL"
+        )
+        query = _paged(
+            f"""
+            SELECT l.id, l.created_at, l.from_state, l.to_state, l.meta_json,
+                   t.created_at, t.area_destino, t.categoria, t.prioridad, {settled}
+            FROM ticket_log l
+            INNER JOIN tickets t ON t.id = l.ticket_id
+            WHERE l.id > ? AND l.event_type = 'status_change'
+            ORDER BY l.id ASC
+            """,
+            is_sql_server,
+            batch_size,
+        )
+        last_id = _get_rollup_watermark(cur, "sla")
+        params = (-ROLLUP_SETTLE_SECONDS, last_id) if is_sql_server else (last_id,)
+        cur.execute(query, params)
+        rows = cur.fetchall()
+        if not rows:
+            return 0, False
+
+        totals = {}
+        new_last_id = last_id
+        for log_id, log_at, old, new, meta_json, opened_at, area, cat, prio, is_settled in rows:
+            log_at = _to_utc_naive(log_at)
+            if is_settled is not None:
+                if not is_settled:
+                    break
+            elif log_at is not None and log_at > settle_limit:
+                break
+            new_last_id = int(log_id)
+            if new is None:
+                # Registro aún no completado por backfill_log_transitions
+                old, new = _meta_transition(meta_json)
+            metric = _classify_transition(old, new)
+            opened_at = _to_utc_naive(opened_at)
+            if not metric or log_at is None or opened_at is None:
+                continue
+            key = (
+                log_at.date().isoformat(),
+                area or "",
+                cat or "",
+                prio or "",
+                metric,
+            )
+            seconds = max((log_at - opened_at).total_seconds(), 0.0)
+            acc = totals.setdefault(key, [0, 0.0, 0.0])
+            acc[0] += 1
+            acc[1] += seconds
+            acc[2] = max(acc[2], seconds)
+
+        # Primero la marca de agua: en SQL Server bloquea la fila hasta el
+        # commit, así una ejecución superpuesta espera y luego falla el CAS
+        if new_last_id != last_id:
+            _advance_rollup_watermark(cur, "sla", last_id, new_last_id, fence)
+        for key, (n, total, max_s) in totals.items():
             cur.execute(
                 """
-                INSERT INTO master_catalog_items
-                (catalog_id, label, sort_order, is_active, parent_item_id)
-                VALUES (?, ?, ?, 1, ?)
+                UPDATE sla_rollup
+                SET n = n + ?, total_seconds = total_seconds + ?,
+                    max_seconds = CASE WHEN max_seconds < ? THEN ? ELSE max_seconds END
+                WHERE dia = ? AND area_destino = ? AND categoria = ?
+                  AND prioridad = ? AND metrica = ?
                 """,
-                (catalog_id, label, int(sort_order), parent_item_id),
+                (n, total, max_s, max_s) + key,
             )
-            conn.commit()
-        clear_master_cache()
-        clear_master_admin_cache()
-    finally:
-        close_connection(conn)
+            if cur.rowcount == 0:
+                cur.execute(
+                    """
+                    INSERT INTO sla_rollup
+                    (dia, area_destino, categoria, prioridad, metrica,
+                     n, total_seconds, max_seconds)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    key + (n, total, max_s),
+                )
+        processed = sum(v[0] for v in totals.values())
+        return processed, new_last_id != last_id and len(rows) == batch_size
 
+    processed = 0
+    more = True
+    while more:
+        try:
+            n, more = _run_write(_job)
+        except _WatermarkMoved:
+            logger.info("SLA: otra ejecución procesó el mismo lote; se omite")
+            break
+        processed += n
+    return processed
 
-def update_master_item(item_id, updates):
-    """Actualiza un item de maestra."""
-    if not updates:
-        return
-    allowed = {"label", "sort_order", "is_active", "parent_item_id"}
-    filtered = {k: v for k, v in updates.items() if k in allowed}
-    if not filtered:
-        return
 
+@_read_only
+def get_sla_summary(desde, hasta, group_by=("area_destino",)):
+    """
+    Lee sólo sla_rollup y retorna conteo, promedio y máximo (en horas) por
+    métrica y por las dimensiones pedidas, entre las fechas desde/hasta.
+    """
+    dims = [d for d in group_by if d in ("area_destino", "categoria", "prioridad")]
+    select_dims = "".join(f"{d}, " for d in dims)
     conn = get_connection()
     try:
-        set_clause = ", ".join([f"{k} = ?" for k in filtered.keys()])
-        values = list(filtered.values())
-        values.append(item_id)
-        query = f"UPDATE master_catalog_items SET {set_clause} WHERE id = ?"
-        with _db_lock:
-            conn.execute(query, values)
-            conn.commit()
-        clear_master_cache()
-        clear_master_admin_cache()
+        query = f"""
+            SELECT {select_dims}metrica,
+                   SUM(n) AS n, SUM(total_seconds) AS total_seconds,
+                   MAX(max_seconds) AS max_seconds
+            FROM sla_rollup
+            WHERE dia BETWEEN ? AND ?
+            GROUP BY {select_dims}metrica
+        """
+        df = pd.read_sql_query(
+            query, conn, params=(str(desde)[:10], str(hasta)[:10])
+        )
     finally:
         close_connection(conn)
+    df["promedio_horas"] = (df["total_seconds"] / df["n"] / 3600).round(2)
+    df["max_horas"] = (df["max_seconds"] / 3600).round(2)
+    return df.drop(columns=["total_seconds", "max_seconds"])
+
+
+# --- TRANSICIONES DE ESTADO ---
+# ticket_log guarda cada cambio de campo en columnas tipadas (field,
+# from_state, to_state) además del texto y meta_json. backfill_log_transitions
+# completa los registros anteriores a esas columnas, por lotes y con marca de
+# agua en rollup_state, a partir de meta_json o del mensaje.
+
+_TRANSITION_MESSAGES = {
+    "assignment": ("responsable_asignado", "Asignación: "),
+    "priority_change": ("prioridad", "Prioridad cambiada: "),
+}
+
+
+def _parse_transition(event_type, message, meta_json):
+    """(field, from, to) de un registro anterior a las columnas, o None."""
+    if event_type in ("status_change", "task_status"):
+        old, new = _meta_transition(meta_json)
+        if new is None:
+            return None
+        return ("estado" if event_type == "status_change" else "tarea.estado"), old, new
+    if event_type == "task_created":
+        return "tarea.estado", None, "PENDIENTE"
+    if event_type == "system" and message == "Ticket creado.":
+        return "estado", None, "NUEVO"
+    if event_type == "system" and message and (
+        message == "Ticket creado con datos de ejemplo." or message.startswith("Ticket importado (")
+    ):
+        # Nacen con el estado de origen, que el mensaje no dice: lo resuelve
+        # backfill_log_transitions con _creation_states
+        return "estado", None, None
+    if event_type in _TRANSITION_MESSAGES:
+        field, prefix = _TRANSITION_MESSAGES[event_type]
+        if not message or not message.startswith(prefix) or " -> " not in message:
+            return None
+        old, new = message[len(prefix):].split(" -> ", 1)
+        if field == "responsable_asignado" and old == "Sin Asignar":
+            old = None
+        return field, old, new
+    return None
 
 
-# --- GESTION DE USUARIOS ---
+def _creation_states(cur, ticket_ids, chunk=500):
+    """
+    {ticket_id: estado con el que se creó}: el from_state del primer cambio de
+    estado o, si nunca cambió, el estado actual.
+    """
+    ids = list(ticket_ids)
+    states = {}
+    for start in range(0, len(ids), chunk):
+        part = ids[start:start + chunk]
+        placeholders = ",".join("?" * len(part))
+        cur.execute(
+            f"""
+            SELECT ticket_id, from_state, meta_json FROM ticket_log_all
+            WHERE event_type = 'status_change' AND ticket_id IN ({placeholders})
+            ORDER BY id
+            """,
+            part,
+        )
+        for ticket_id, from_state, meta_json in cur.fetchall():
+            if ticket_id not in states:
+                states[ticket_id] = from_state or _meta_transition(meta_json)[0]
+        cur.execute(f"SELECT id, estado FROM tickets_all WHERE id IN ({placeholders})", part)
+        for ticket_id, estado in cur.fetchall():
+            if not states.get(ticket_id):
+                states[ticket_id] = estado
+    return states
 
 
-@st.cache_data(ttl=600)  # Caché de 10 minutos para usuarios
-def get_users(only_active=False):
-    """Retorna un DataFrame con todos los usuarios."""
+def backfill_log_transitions(batch_size=2000, max_batches=50):
+    """
+    Completa field/from_state/to_state de ticket_log y ticket_log_archive en
+    registros viejos. Cada llamada procesa hasta max_batches lotes por tabla;
+    retorna la cantidad de registros actualizados.
+    """
+    updated = 0
+    fence = _lease_fence.get()
+    for table in ("ticket_log", "ticket_log_archive"):
+        watermark = f"log_transitions:{table}"
+
+        def _job(conn, table=table, watermark=watermark):
+            cur = conn.cursor()
+            last_id = _get_rollup_watermark(cur, watermark)
+            cur.execute(
+                _paged(
+                    f"""
+                    SELECT id, ticket_id, event_type, message, meta_json FROM {table}
+                    WHERE id > ? AND field IS NULL
+                    ORDER BY id
+                    """,
+                    _is_sql_server_conn(conn),
+                    batch_size,
+                ),
+                (last_id,),
+            )
+            rows = cur.fetchall()
+            if not rows:
+                return 0, False
+            params, created = [], []
+            for log_id, ticket_id, event_type, message, meta_json in rows:
+                parsed = _parse_transition(event_type, message, meta_json)
+                if parsed and parsed[2] is None:
+                    created.append((ticket_id, log_id))
+                elif parsed:
+                    params.append(parsed + (log_id,))
+            if created:
+                states = _creation_states(cur, {ticket_id for ticket_id, _ in created})
+                params.extend(
+                    ("estado", None, states[ticket_id], log_id)
+                    for ticket_id, log_id in created
+                    if states.get(ticket_id)
+                )
+            if params:
+                if _is_sql_server_conn(conn):
+                    cur.fast_executemany = True
+                cur.executemany(
+                    f"UPDATE {table} SET field = ?, from_state = ?, to_state = ? WHERE id = ?",
+                    params,
+                )
+            _advance_rollup_watermark(cur, watermark, last_id, int(rows[-1][0]), fence)
+            return len(params), len(rows) == batch_size
+
+        for _ in range(max_batches):
+            try:
+                n, more = _run_write(_job)
+            except _WatermarkMoved:
+                logger.warning(f"backfill_log_transitions: {watermark} avanzó en otra ejecución")
+                break
+            updated += n
+            if not more:
+                break
+    return updated
+
+
+@_read_only
+def get_transition_counts(desde=None, hasta=None, field="estado"):
+    """Cantidad de transiciones from_state -> to_state del campo, entre fechas."""
+    conditions, params = ["field = ?"], [field]
+    if desde is not None:
+        conditions.append("created_at >= ?")
+        params.append(pd.Timestamp(desde).to_pydatetime())
+    if hasta is not None:
+        conditions.append("created_at < ?")
+        params.append((pd.Timestamp(hasta) + pd.Timedelta(days=1)).to_pydatetime())
     conn = get_connection()
     try:
-        cols = ", ".join(ALLOWED_COLUMNS["users"])
-        query = f"SELECT {cols} FROM users"
-        if only_active:
-            query += " WHERE activo = 1"
-        query += " ORDER BY nombre_completo ASC"
-        df = pd.read_sql_query(query, conn)
-        return df
+        return pd.read_sql_query(
+            f"""
+            SELECT from_state, to_state, COUNT(*) AS n
+            FROM ticket_log_all
+            WHERE {" AND ".join(conditions)}
+            GROUP BY from_state, to_state
+            ORDER BY n DESC
+            """,
+            conn,
+            params=params,
+        )
     finally:
         close_connection(conn)
 
 
-def clear_users_cache():
-    """Invalida la caché de usuarios."""
-    get_users.clear()
-
-
-def create_user(data):
-    """Crea un nuevo usuario."""
+@_read_only
+def get_time_in_state(desde=None, hasta=None, field="estado"):
+    """
+    Tiempo (horas) que los tickets pasan en cada valor del campo: para cada
+    transición, desde que se entra al estado hasta la transición siguiente
+    del mismo ticket (LEAD sobre ticket_log). Filtra por fecha de entrada.
+    """
     conn = get_connection()
     try:
-        query = """
-            INSERT INTO users (nombre_completo, email, rol, area, activo)
-            VALUES (?, ?, ?, ?, ?)
+        is_sql_server = _is_sql_server_conn(conn)
+        seconds = (
+            "DATEDIFF(second, created_at, left_at)"
+            if is_sql_server
+            else "(julianday(left_at) - julianday(created_at)) * 86400.0"
+        )
+        conditions, params = ["left_at IS NOT NULL"], [field]
+        if desde is not None:
+            conditions.append("created_at >= ?")
+            params.append(pd.Timestamp(desde).to_pydatetime())
+        if hasta is not None:
+            conditions.append("created_at < ?")
+            params.append((pd.Timestamp(hasta) + pd.Timedelta(days=1)).to_pydatetime())
+        query = f"""
+            SELECT to_state AS estado, COUNT(*) AS n,
+                   AVG({seconds}) / 3600.0 AS horas_promedio,
+                   MAX({seconds}) / 3600.0 AS horas_max
+            FROM (
+                SELECT to_state, created_at,
+                       LEAD(created_at) OVER (PARTITION BY ticket_id ORDER BY id) AS left_at
+                FROM ticket_log_all
+                WHERE field = ?
+            ) x
+            WHERE {" AND ".join(conditions)}
+            GROUP BY to_state
+            ORDER BY to_state
         """
-        with _db_lock:
-            conn.execute(
-                query,
-                (
-                    data["nombre_completo"],
-                    data.get("email"),
-                    data.get("rol", "Solicitante"),
-                    data.get("area"),
-                    data.get("activo", 1),
-                ),
-            )
-            conn.commit()
-        clear_users_cache()
+        return pd.read_sql_query(query, conn, params=params)
     finally:
         close_connection(conn)
 
 
-def update_user(user_id, updates):
-    """Actualiza datos de un usuario."""
-    if not updates:
-        return
-    # Whitelist check
-    filtered_updates = {
-        k: v for k, v in updates.items() if k in ALLOWED_COLUMNS["users"]
-    }
-    if not filtered_updates:
-        return
+# --- VENCIMIENTOS Y ESCALADO ---
+# due_at = created_at + horas SLA de la prioridad (maestra prioridades,
+# columna sla_hours). Se guarda en tickets con índice (due_at, estado): los
+# vencidos son una lectura por rango y el escalado es un único UPDATE.
 
-    conn = get_connection()
-    try:
-        set_clause = ", ".join([f"{k} = ?" for k in filtered_updates.keys()])
-        values = list(filtered_updates.values())
-        values.append(user_id)
-        query = f"UPDATE users SET {set_clause} WHERE id = ?"
-        with _db_lock:
-            conn.execute(query, values)
-            conn.commit()
-        clear_users_cache()
-    finally:
-        close_connection(conn)
+# Horas SLA de la prioridad del ticket (subconsulta correlacionada)
+_SLA_HOURS_SQL = """(
+    SELECT MAX(i.sla_hours) FROM master_catalog_items i
+    JOIN master_catalogs c ON c.id = i.catalog_id
+    WHERE c.code = 'prioridades' AND i.parent_item_id IS NULL
+    AND i.label = tickets.prioridad AND i.sla_hours > 0
+)"""
 
 
-def get_user_by_name(name):
-    """Busca un usuario por su nombre completo."""
-    conn = get_connection()
-    try:
+def _set_due_at(cur, is_sql_server, where, params=(), bump_version=True):
+    """
+    Recalcula due_at de los tickets que cumplen where. escalated_at se limpia
+    si el nuevo vencimiento ya no está vencido (p. ej. bajó la prioridad).
+    bump_version=False cuando la fila es nueva o ya se versionó en la misma
+    transacción.
+    """
+    if is_sql_server:
+        due = f"DATEADD(hour, {_SLA_HOURS_SQL}, created_at)"
+    else:
+        due = f"datetime(created_at, '+' || {_SLA_HOURS_SQL} || ' hours')"
+    version = ", version = version + 1" if bump_version else ""
+    cur.execute(
+        f"""
+        UPDATE tickets
+        SET due_at = {due},
+            escalated_at = CASE WHEN {due} < ? THEN escalated_at END{version}
+        WHERE {where}
+        """,
+        [_to_utc_naive(get_now_utc())] + list(params),
+    )
+    return cur.rowcount
+
+
+def escalate_overdue_tickets():
+    """
+    Job del scheduler. Completa due_at en tickets abiertos que no lo tienen
+    (anteriores a la columna), marca escalated_at en los abiertos vencidos
+    en un solo UPDATE y registra el historial y los eventos ticket.escalated
+    en lote. Retorna la cantidad de tickets escalados.
+    """
+    states = sorted(CLOSED_STATES)
+    marks = ",".join("?" * len(states))
+    now = _to_utc_naive(get_now_utc())
+
+    def _job(conn):
         cur = conn.cursor()
+        _set_due_at(
+            cur,
+            _is_sql_server_conn(conn),
+            f"due_at IS NULL AND estado NOT IN ({marks}) AND {_SLA_HOURS_SQL} IS NOT NULL",
+            states,
+        )
+        # Los escalados salen del propio UPDATE (OUTPUT INSERTED / RETURNING),
+        # sin volver a buscarlos por escalated_at
+        returned = ("id", "area_destino", "prioridad", "estado", "responsable_asignado", "due_at")
+        where = f"WHERE due_at < ? AND estado NOT IN ({marks}) AND escalated_at IS NULL"
+        params = [now, now] + states
         if _is_sql_server_conn(conn):
-            query = (
-                "SELECT * FROM users WHERE nombre_completo = ? OR "
-                "nombre_completo + ' <' + email + '>' = ?"
+            output = ", ".join(f"INSERTED.{c}" for c in returned)
+            cur.execute(
+                f"UPDATE tickets SET escalated_at = ?, version = version + 1 OUTPUT {output} {where}",
+                params,
             )
-        else:
-            query = (
-                "SELECT * FROM users WHERE nombre_completo = ? OR "
-                "nombre_completo || ' <' || email || '>' = ?"
+            rows = cur.fetchall()
+        elif _SQLITE_RETURNING:
+            cur.execute(
+                f"UPDATE tickets SET escalated_at = ?, version = version + 1 {where} RETURNING {', '.join(returned)}",
+                params,
             )
-        cur.execute(query, (name, name))
-        row = cur.fetchone()
-        if row:
-            # Columns: id, nombre_completo, email, rol, area, activo
-            return {
-                "id": row[0],
-                "nombre_completo": row[1],
-                "email": row[2],
-                "rol": row[3],
-                "area": row[4],
-                "activo": row[5],
-            }
-        return None
-    finally:
-        close_connection(conn)
+            rows = cur.fetchall()
+        else:
+            cur.execute(f"UPDATE tickets SET escalated_at = ?, version = version + 1 {where}", params)
+            if cur.rowcount == 0:
+                return 0
+            cur.execute(f"SELECT {', '.join(returned)} FROM tickets WHERE escalated_at = ?", (now,))
+            rows = cur.fetchall()
+        if not rows:
+            return 0
+        if _is_sql_server_conn(conn):
+            cur.fast_executemany = True
+        cur.executemany(
+            """
+            INSERT INTO ticket_log (ticket_id, created_at, author, event_type, message, meta_json)
+            VALUES (?, ?, 'System', 'escalation', 'Ticket vencido: superó el SLA de su prioridad.', NULL)
+            """,
+            [(row[0], now) for row in rows],
+        )
+        _enqueue_events(
+            cur,
+            [
+                (
+                    "ticket.escalated",
+                    int(tid),
+                    {
+                        "id": int(tid),
+                        "area_destino": area,
+                        "prioridad": prioridad,
+                        "estado": estado,
+                        "responsable_asignado": responsable,
+                        "due_at": due_at,
+                    },
+                )
+                for tid, area, prioridad, estado, responsable, due_at in rows
+            ],
+        )
+        return len(rows)
 
+    n = _run_write(_job)
+    if n:
+        logger.info(f"Escalado: {n} tickets vencidos")
+    return n
 
-def get_ticket_by_id(ticket_id):
-    """Retorna un ticket específico como dict (o Series)."""
+
+@_read_only
+def get_overdue_tickets(area_destino=None, columns=None, limit=500):
+    """
+    Tickets abiertos con due_at vencido, del más atrasado al más reciente
+    (lectura por rango de IX_tickets_due). area_destino: valor o lista.
+    """
+    states = sorted(CLOSED_STATES)
     conn = get_connection()
     try:
-        cols = ", ".join(ALLOWED_COLUMNS["tickets"])
-        query = f"SELECT {cols} FROM tickets WHERE id = ?"
-        df = pd.read_sql_query(query, conn, params=(ticket_id,))
-        if not df.empty:
-            return df.iloc[0]
-        return None
+        cols = _ticket_projection(columns)
+        where, params = _build_ticket_filters({"area_destino": area_destino})
+        where = where.replace(" WHERE ", " AND ", 1)
+        query = _paged(
+            f"""
+            SELECT {', '.join(cols)} FROM tickets
+            WHERE due_at < ? AND estado NOT IN ({','.join('?' * len(states))}){where}
+            ORDER BY due_at
+            """,
+            _is_sql_server_conn(conn),
+            limit,
+        )
+        params = [_to_utc_naive(get_now_utc())] + states + params
+        return _compact_tickets(pd.read_sql_query(query, conn, params=params))
     finally:
         close_connection(conn)
 
 
-def update_ticket(ticket_id, updates, author="System"):
+# --- ARCHIVO DE TICKETS CERRADOS ---
+
+# Días desde el cierre tras los cuales un ticket pasa al archivo
+ARCHIVE_AFTER_DAYS = int(os.environ.get("GESTAR_ARCHIVE_DAYS", "180"))
+
+
+def archive_closed_tickets(days=None, batch_size=500):
     """
-    Actualiza campos de un ticket y registra cambios en el log.
-    updates: dict con {campo: valor}
-    author: usuario que realiza el cambio
+    Mueve a *_archive los tickets RESUELTO/CERRADO con closed_at anterior a
+    days días, junto con sus tareas y su historial. Cada lote es una
+    transacción corta (copiar + borrar); los contadores no cambian porque
+    cuentan activos + archivados. Retorna la cantidad de tickets archivados.
     """
-    conn = get_connection()
+    days = ARCHIVE_AFTER_DAYS if days is None else days
+    cutoff = _to_utc_naive(get_now_utc()) - timedelta(days=days)
+    states = sorted(CLOSED_STATES)
+    marks = ",".join("?" * len(states))
+
+    def _batch(conn):
+        cur = conn.cursor()
+        cur.execute(
+            _paged(
+                f"""
+                SELECT id FROM tickets
+                WHERE estado IN ({marks}) AND closed_at IS NOT NULL AND closed_at < ?
+                ORDER BY id
+                """,
+                _is_sql_server_conn(conn),
+                batch_size,
+            ),
+            states + [cutoff],
+        )
+        ids = [int(r[0]) for r in cur.fetchall()]
+        if not ids:
+            return 0
+        in_ids = ",".join("?" * len(ids))
+        archived_at = _to_utc_naive(get_now_utc())
+        for table, columns in ARCHIVE_COLUMNS.items():
+            cols = ", ".join(columns)
+            key = "id" if table == "tickets" else "ticket_id"
+            extra_cols, extra_vals = (", archived_at", ", ?") if table == "tickets" else ("", "")
+            params = ([archived_at] if extra_cols else []) + ids
+            cur.execute(
+                f"""
+                INSERT INTO {table}_archive ({cols}{extra_cols})
+                SELECT {cols}{extra_vals} FROM {table} WHERE {key} IN ({in_ids})
+                """,
+                params,
+            )
+        # Hijos primero por las foreign keys
+        cur.execute(f"DELETE FROM ticket_log WHERE ticket_id IN ({in_ids})", ids)
+        cur.execute(f"DELETE FROM tasks WHERE ticket_id IN ({in_ids})", ids)
+        cur.execute(f"DELETE FROM tickets WHERE id IN ({in_ids})", ids)
+        return len(ids)
+
+    total = 0
+    while True:
+        n = _run_write(_batch)
+        total += n
+        if n < batch_size:
+            break
+    if total:
+        logger.info(f"Archivo: {total} tickets cerrados movidos a tickets_archive")
+    return total
+
+
+# --- RETENCIÓN DE HISTORIAL ---
+
+# event_type -> días de retención (None = conservar siempre). Se puede
+# reemplazar con GESTAR_LOG_RETENTION='{"system": 90, "assignment": 365}'.
+DEFAULT_LOG_RETENTION = {"system": 180}
+
+
+def get_log_retention_rules():
+    """Reglas de retención vigentes {event_type: días}."""
+    raw = os.environ.get("GESTAR_LOG_RETENTION")
+    if not raw:
+        return dict(DEFAULT_LOG_RETENTION)
     try:
-        # Get current state for comparison
-        current = pd.read_sql_query(
-            "SELECT * FROM tickets WHERE id = ?", conn, params=(ticket_id,)
+        rules = json.loads(raw)
+        return {str(k): (int(v) if v is not None else None) for k, v in rules.items()}
+    except (TypeError, ValueError) as e:
+        logger.error(f"GESTAR_LOG_RETENTION inválido, se usan los valores por defecto: {e}")
+        return dict(DEFAULT_LOG_RETENTION)
+
+
+def _log_space_bytes(conn):
+    """Bytes ocupados: archivo SQLite completo o tablas ticket_log* en SQL Server."""
+    cur = conn.cursor()
+    if _is_sql_server_conn(conn):
+        cur.execute(
+            """
+            SELECT COALESCE(SUM(reserved_page_count), 0) * 8192
+            FROM sys.dm_db_partition_stats
+            WHERE object_id IN (OBJECT_ID('ticket_log'), OBJECT_ID('ticket_log_archive'))
+            """
         )
-        if current.empty:
-            return
-        current = current.iloc[0]
+        return int(cur.fetchone()[0])
+    cur.execute("PRAGMA page_count")
+    pages = int(cur.fetchone()[0])
+    cur.execute("PRAGMA page_size")
+    return pages * int(cur.fetchone()[0])
 
-        # Detect changes and log
-        if "estado" in updates and updates["estado"] != current["estado"]:
-            msg = f"Cambio de estado: {current['estado']} -> {updates['estado']}"
-            meta = json.dumps({"from": current["estado"], "to": updates["estado"]})
-            conn.execute(
-                "INSERT INTO ticket_log (ticket_id, author, event_type, message, meta_json) VALUES (?, ?, ?, ?, ?)",
-                (ticket_id, author, "status_change", msg, meta),
-            )
 
-            # If closed/resolved, set closed_at
-            if (
-                updates["estado"] in ["RESUELTO", "CERRADO"]
-                and not current["closed_at"]
-            ):
-                conn.execute(
-                    "UPDATE tickets SET closed_at = ? WHERE id = ?",
-                    (get_now_utc(), ticket_id),
-                )
+def purge_ticket_logs(rules=None, batch_size=1000):
+    """
+    Borra de ticket_log y ticket_log_archive los eventos más antiguos que la
+    retención de su event_type. Borra en lotes de batch_size (cada lote es una
+    transacción corta) y nunca toca cambios de estado que los rollups SLA aún
+    no procesaron ni transiciones registradas bajo otro tipo (p. ej. el estado
+    inicial, 'system'). Retorna {event_type: filas borradas}.
+    """
+    rules = get_log_retention_rules() if rules is None else rules
+    now = _to_utc_naive(get_now_utc())
+    deleted = {}
 
-        if (
-            "responsable_asignado" in updates
-            and updates["responsable_asignado"] != current["responsable_asignado"]
-        ):
-            old = (
-                current["responsable_asignado"]
-                if current["responsable_asignado"]
-                else "Sin Asignar"
-            )
-            new = updates["responsable_asignado"]
-            msg = f"Asignación: {old} -> {new}"
-            conn.execute(
-                "INSERT INTO ticket_log (ticket_id, author, event_type, message) VALUES (?, ?, ?, ?)",
-                (ticket_id, author, "assignment", msg),
+    def _batch(conn, table, event_type, cutoff):
+        cur = conn.cursor()
+        where = "event_type = ? AND created_at < ?"
+        params = (event_type, cutoff)
+        if event_type not in ("status_change", "task_status"):
+            # Las filas con transición bajo otros tipos (el estado inicial va
+            # como 'system') son el primer intervalo de get_time_in_state y
+            # del SLA: la retención del tipo no las borra, ni las que
+            # backfill_log_transitions todavía no clasificó
+            where += " AND field IS NULL AND id <= ?"
+            params += (_get_rollup_watermark(cur, f"log_transitions:{table}"),)
+        if event_type == "status_change" and table == "ticket_log":
+            # Los cambios de estado alimentan los rollups SLA
+            where += " AND id <= ?"
+            params += (_get_rollup_watermark(cur, "sla"),)
+        if _is_sql_server_conn(conn):
+            cur.execute(f"DELETE TOP ({int(batch_size)}) FROM {table} WHERE {where}", params)
+        else:
+            cur.execute(
+                f"""
+                DELETE FROM {table} WHERE id IN (
+                    SELECT id FROM {table} WHERE {where} LIMIT {int(batch_size)}
+                )
+                """,
+                params,
             )
+        return cur.rowcount
 
-        if "prioridad" in updates and updates["prioridad"] != current["prioridad"]:
-            msg = (
-                f"Prioridad cambiada: {current['prioridad']} -> {updates['prioridad']}"
-            )
-            conn.execute(
-                "INSERT INTO ticket_log (ticket_id, author, event_type, message) VALUES (?, ?, ?, ?)",
-                (ticket_id, author, "priority_change", msg),
-            )
+    for event_type, days in rules.items():
+        if days is None:
+            continue
+        cutoff = now - timedelta(days=int(days))
+        total = 0
+        for table in ("ticket_log", "ticket_log_archive"):
+            while True:
+                n = _run_write(lambda conn: _batch(conn, table, event_type, cutoff))
+                total += n
+                if n < batch_size:
+                    break
+        if total:
+            deleted[event_type] = total
+    return deleted
+
+
+@contextlib.contextmanager
+def _maintenance_connection():
+    """
+    Conexión propia en autocommit para mantenimiento largo (VACUUM, REORGANIZE,
+    sp_updatestats): fuera de _run_write, así no retiene _db_lock ni una
+    transacción abierta que frene las escrituras del proceso.
+    """
+    conn_str = _resolve_conn_str()
+    if conn_str:
+        conn = _connect_sql(conn_str)
+        conn.autocommit = True
+    else:
+        conn = sqlite3.connect(DB_NAME, isolation_level=None, timeout=30)
+    try:
+        yield conn
+    finally:
+        conn.close()
 
-        # Perform Update
-        updates["updated_at"] = get_now_utc()
 
-        # Whitelist check
-        filtered_updates = {
-            k: v for k, v in updates.items() if k in ALLOWED_COLUMNS["tickets"]
-        }
-        if not filtered_updates:
-            conn.commit()
+def compact_log_storage(full=False):
+    """
+    Devuelve al sistema el espacio liberado por las purgas.
+    SQLite: incremental_vacuum si la base está en auto_vacuum=INCREMENTAL;
+    con full=True hace VACUUM completo (y activa el modo incremental).
+    SQL Server: REORGANIZE de los índices de ticket_log (operación en línea).
+    """
+    with _maintenance_connection() as conn:
+        if _is_sql_server_conn(conn):
+            cur = conn.cursor()
+            cur.execute("ALTER INDEX ALL ON ticket_log REORGANIZE")
+            cur.execute("ALTER INDEX ALL ON ticket_log_archive REORGANIZE")
             return
+        mode = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+        if full:
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("VACUUM")
+        elif mode == 2:
+            # executescript recorre todos los pasos del pragma (execute
+            # libera sólo una página)
+            conn.executescript("PRAGMA incremental_vacuum;")
+        else:
+            logger.info("SQLite sin auto_vacuum incremental: se requiere VACUUM completo.")
 
-        set_clause = ", ".join([f"{k} = ?" for k in filtered_updates.keys()])
-        values = list(filtered_updates.values())
-        values.append(ticket_id)
 
-        query = f"UPDATE tickets SET {set_clause} WHERE id = ?"
-        with _db_lock:
-            conn.execute(query, values)
-            conn.commit()
+def run_log_retention(rules=None, full_vacuum=False):
+    """
+    Purga según retención y compacta. Retorna un reporte con filas borradas
+    por event_type y bytes ocupados antes/después.
+    """
+    conn = get_connection()
+    try:
+        before = _log_space_bytes(conn)
+    finally:
+        close_connection(conn)
+    deleted = purge_ticket_logs(rules)
+    if deleted or full_vacuum:
+        compact_log_storage(full=full_vacuum)
+    conn = get_connection()
+    try:
+        after = _log_space_bytes(conn)
     finally:
         close_connection(conn)
+    report = {
+        "deleted": deleted,
+        "bytes_before": before,
+        "bytes_after": after,
+        "bytes_reclaimed": max(before - after, 0),
+    }
+    if deleted:
+        logger.info(f"Retención de historial: {report}")
+    return report
 
 
-# --- TASKS ---
+# --- MANTENIMIENTO Y SCHEDULER ---
+# El scheduler (scheduler.py) usa estas funciones para elegir un único líder
+# entre instancias y registrar el historial de ejecuciones.
 
 
-def create_task(ticket_id, descripcion, responsable):
-    conn = get_connection()
+# (lease, holder) del job de scheduler en curso: las marcas de agua y cursores
+# que escribe sólo avanzan si el lease sigue siendo suyo
+_lease_fence = contextvars.ContextVar("gestar_lease_fence", default=None)
+
+
+@contextlib.contextmanager
+def lease_fence(name, holder):
+    """Asocia las escrituras de marcas de agua del bloque al lease name/holder."""
+    token = _lease_fence.set((name, holder))
     try:
-        with _db_lock:
-            conn.execute(
-                """
-                INSERT INTO tasks (ticket_id, descripcion, responsable, estado)
-                VALUES (?, ?, ?, 'PENDIENTE')
-            """,
-                (ticket_id, descripcion, responsable),
-            )
-            conn.commit()
+        yield
     finally:
-        close_connection(conn)
+        _lease_fence.reset(token)
+
+
+def _lease_condition(conn, fence):
+    """(' AND EXISTS (...)', params) que exige el lease vigente; vacío sin fence."""
+    if fence is None:
+        return "", ()
+    now = "SYSUTCDATETIME()" if _is_sql_server_conn(conn) else "datetime('now')"
+    return (
+        " AND EXISTS (SELECT 1 FROM scheduler_lease"
+        f" WHERE name = ? AND holder = ? AND expires_at > {now})",
+        tuple(fence),
+    )
 
 
-def get_tasks_for_ticket(ticket_id):
+def acquire_lease(name, holder, ttl_s):
+    """
+    Toma o renueva el lease name para holder por ttl_s segundos (hora de la
+    base, así no depende del reloj de cada instancia). Retorna True si holder
+    es el titular.
+    """
+
+    def _job(conn):
+        cur = conn.cursor()
+        if _is_sql_server_conn(conn):
+            now, expires = "SYSUTCDATETIME()", "DATEADD(second, ?, SYSUTCDATETIME())"
+        else:
+            now, expires = "datetime('now')", "datetime('now', '+' || ? || ' seconds')"
+        cur.execute(
+            f"""
+            UPDATE scheduler_lease SET holder = ?, expires_at = {expires}
+            WHERE name = ? AND (holder = ? OR holder IS NULL OR expires_at < {now})
+            """,
+            (holder, int(ttl_s), name, holder),
+        )
+        return cur.rowcount == 1
+
+    return _run_write(_job)
+
+
+def release_lease(name, holder):
+    """Libera el lease si holder es el titular (al cerrar el proceso)."""
+    _execute_write(
+        "UPDATE scheduler_lease SET holder = NULL WHERE name = ? AND holder = ?",
+        (name, holder),
+    )
+
+
+def get_lease(name):
+    """Retorna (holder, expires_at) del lease o None."""
     conn = get_connection()
     try:
-        cols = ", ".join(ALLOWED_COLUMNS["tasks"])
-        query = f"SELECT {cols} FROM tasks WHERE ticket_id = ?"
-        return pd.read_sql_query(query, conn, params=(ticket_id,))
+        cur = conn.cursor()
+        cur.execute("SELECT holder, expires_at FROM scheduler_lease WHERE name = ?", (name,))
+        row = cur.fetchone()
+        return (row[0], row[1]) if row else None
     finally:
         close_connection(conn)
 
 
-def update_task_status(task_id, new_status):
+def record_job_run(job, holder, started_at, finished_at, status, detail=None):
+    duration_ms = int((finished_at - started_at).total_seconds() * 1000)
+    _execute_write(
+        """
+        INSERT INTO job_runs
+        (job, holder, started_at, finished_at, duration_ms, status, detail)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+        (
+            job,
+            holder,
+            _to_utc_naive(started_at),
+            _to_utc_naive(finished_at),
+            duration_ms,
+            status,
+            (str(detail)[:1000] if detail is not None else None),
+        ),
+    )
+
+
+def get_last_job_runs():
+    """Retorna {job: started_at de la última ejecución} (UTC naive)."""
     conn = get_connection()
     try:
-        with _db_lock:
-            conn.execute(
-                "UPDATE tasks SET estado = ? WHERE id = ?", (new_status, task_id)
-            )
-            conn.commit()
+        cur = conn.cursor()
+        cur.execute("SELECT job, MAX(started_at) FROM job_runs GROUP BY job")
+        return {job: _to_utc_naive(started) for job, started in cur.fetchall()}
     finally:
         close_connection(conn)
 
 
-def get_tasks_by_user(user_name):
-    """Retorna tareas asignadas a un usuario específico."""
+@_read_only
+def get_job_runs(limit=200):
+    """Historial de ejecuciones de jobs, más reciente primero."""
     conn = get_connection()
     try:
-        cols_tasks = ", ".join([f"t.{c}" for c in ALLOWED_COLUMNS["tasks"]])
-        query = f"""
-            SELECT {cols_tasks}, tk.titulo as ticket_titulo 
-            FROM tasks t 
-            JOIN tickets tk ON t.ticket_id = tk.id 
-            WHERE t.responsable = ? AND t.estado != 'COMPLETADA'
-        """
-        return pd.read_sql_query(
-            query,
-            conn,
-            params=(user_name,),
+        query = _paged(
+            """
+            SELECT job, holder, started_at, duration_ms, status, detail
+            FROM job_runs
+            ORDER BY id DESC
+            """,
+            _is_sql_server_conn(conn),
+            limit,
         )
+        return pd.read_sql_query(query, conn)
     finally:
         close_connection(conn)
+
+
+def prune_job_runs(days=30):
+    """Borra el historial de jobs anterior a days días."""
+    cutoff = _to_utc_naive(get_now_utc()) - timedelta(days=days)
+    return _run_write(
+        lambda conn: conn.cursor().execute(
+            "DELETE FROM job_runs WHERE started_at < ?", (cutoff,)
+        ).rowcount
+    )
+
+
+def optimize_database():
+    """
+    Actualiza estadísticas del optimizador: PRAGMA optimize en SQLite
+    (ANALYZE sólo de lo que lo necesita, en la conexión de escritura, que es
+    la que registró las consultas) y sp_updatestats en SQL Server, que tarda:
+    va por _maintenance_connection, no por la ruta de escritura.
+    """
+    if _resolve_conn_str():
+        with _maintenance_connection() as conn:
+            conn.cursor().execute("EXEC sp_updatestats")
+        return
+    _run_write(lambda conn: conn.execute("PRAGMA optimize"))
+
+
+def prewarm_caches():
+    """Carga en memoria las fotos compartidas (maestras y usuarios)."""
+    get_catalog_snapshot()
+    get_user_directory()
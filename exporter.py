@@ -0,0 +1,120 @@
+# exporter.py
+# Exportación de tickets, tareas e historial a CSV / Parquet
+#
+# Uso:
+#   python exporter.py ticket_log --formato parquet --salida historial.parquet
+#
+# Los datos se leen con los generadores db.iter_* y se escriben bloque a
+# bloque, por lo que la memoria usada depende del tamaño de lote y no del
+# volumen de la tabla.
+
+import argparse
+import sys
+
+import pandas as pd
+
+import db
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+EXPORTABLES = {
+    "tickets": db.iter_tickets,
+    "tasks": db.iter_tasks,
+    "ticket_log": db.iter_ticket_logs,
+}
+
+FORMATS = ["csv", "parquet"]
+
+
+def _export_csv(chunks, dest):
+    rows = 0
+    header = True
+    with open(dest, "w", newline="", encoding="utf-8") as f:
+        for df in chunks:
+            df.to_csv(f, index=False, header=header)
+            header = False
+            rows += len(df)
+    return rows
+
+
+# Tipos de columna conocidos: el esquema Parquet no se infiere del primer
+# bloque (una columna vacía ahí puede traer fechas más adelante)
+INT_COLUMNS = {"id", "ticket_id", "version"}
+DATE_COLUMNS = set(db.TICKET_DATE_COLUMNS) | {"fecha_creacion"}
+
+
+def _arrow_type(column):
+    if column in INT_COLUMNS:
+        return pa.int64()
+    if column in DATE_COLUMNS:
+        return pa.timestamp("us")
+    return pa.string()
+
+
+def _normalize(df):
+    """Lleva un bloque a los tipos del esquema (fechas UTC naive, texto)."""
+    df = df.copy()
+    for col in df.columns:
+        if col in DATE_COLUMNS:
+            df[col] = pd.to_datetime(
+                df[col], errors="coerce", utc=True, format="ISO8601"
+            ).dt.tz_localize(None)
+        elif col not in INT_COLUMNS:
+            df[col] = df[col].astype(object).where(df[col].notna(), None)
+            df[col] = df[col].map(lambda v: v if v is None or isinstance(v, str) else str(v))
+    return df
+
+
+def _export_parquet(chunks, dest):
+    if pa is None:
+        raise RuntimeError("Para exportar a Parquet se requiere el paquete pyarrow.")
+    rows = 0
+    writer = None
+    schema = None
+    try:
+        for df in chunks:
+            if writer is None:
+                schema = pa.schema([(c, _arrow_type(c)) for c in df.columns])
+                writer = pq.ParquetWriter(dest, schema)
+            writer.write_table(
+                pa.Table.from_pandas(_normalize(df), schema=schema, preserve_index=False)
+            )
+            rows += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def export(kind, fmt, dest, batch_size=db.DEFAULT_FETCH_BATCH):
+    """Exporta una tabla (ver EXPORTABLES) a dest. Retorna filas escritas."""
+    if kind not in EXPORTABLES:
+        raise ValueError(f"Exportación inexistente: {kind}")
+    chunks = EXPORTABLES[kind](batch_size=batch_size)
+    if fmt == "csv":
+        return _export_csv(chunks, dest)
+    if fmt == "parquet":
+        return _export_parquet(chunks, dest)
+    raise ValueError(f"Formato no soportado: {fmt}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Exportación de datos GESTAR")
+    parser.add_argument("tabla", choices=sorted(EXPORTABLES))
+    parser.add_argument("--formato", choices=FORMATS, default="csv")
+    parser.add_argument("--salida", help="Archivo destino (default: <tabla>.<formato>)")
+    parser.add_argument("--lote", type=int, default=db.DEFAULT_FETCH_BATCH)
+    args = parser.parse_args(argv)
+
+    dest = args.salida or f"{args.tabla}.{args.formato}"
+    rows = export(args.tabla, args.formato, dest, batch_size=args.lote)
+    print(f"{rows} filas exportadas a {dest}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
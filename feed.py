@@ -0,0 +1,54 @@
+# feed.py
+# Feed de cambios de GESTAR para consumidores externos (BI, reportes)
+#
+# Uso:
+#   python feed.py --consumidor bi                      # lo nuevo desde su checkpoint
+#   python feed.py --desde 0 --lote 1000 > eventos.jsonl  # sin checkpoint
+#   python feed.py --consumidor tablero --seguir --intervalo 10
+#
+# Escribe los eventos de ticket_log (cambios de tickets, comentarios y eventos
+# de tareas) como líneas JSON en stdout, en orden de id. Con --consumidor la
+# posición queda guardada en feed_checkpoints y la próxima ejecución sigue
+# desde ahí; cada consumidor avanza a su propio ritmo.
+
+import argparse
+import json
+import sys
+import time
+
+import db
+
+
+def emit(df, out=sys.stdout):
+    for record in df.to_dict(orient="records"):
+        out.write(json.dumps(record, default=str) + "\n")
+    out.flush()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Feed de cambios GESTAR")
+    parser.add_argument("--consumidor", help="Nombre del consumidor (guarda checkpoint)")
+    parser.add_argument("--desde", type=int, help="Último id ya procesado (ignora el checkpoint)")
+    parser.add_argument("--lote", type=int, default=500)
+    parser.add_argument("--seguir", action="store_true", help="Esperar eventos nuevos")
+    parser.add_argument("--intervalo", type=float, default=5)
+    args = parser.parse_args(argv)
+    if args.desde is None and not args.consumidor:
+        parser.error("Indicar --consumidor o --desde")
+
+    db.init_db()
+    since_id = args.desde
+    total = 0
+    while True:
+        for df in db.stream_events(since_id, args.lote, consumer=args.consumidor):
+            emit(df)
+            total += len(df)
+            since_id = int(df["id"].iloc[-1])
+        if not args.seguir:
+            break
+        time.sleep(args.intervalo)
+    print(f"{total} eventos", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
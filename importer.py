@@ -0,0 +1,346 @@
+# importer.py
+# Importación masiva de tickets desde CSV/Excel (migración de plantas)
+#
+# Uso:
+#   python importer.py solicitudes.csv --job ut5-legacy --map "Asunto=titulo"
+#
+# El archivo se lee por bloques (memoria acotada sin importar su tamaño),
+# cada fila se valida contra las tablas maestras y los tickets válidos se
+# insertan en lote junto con su log de creación. El avance queda registrado en
+# la tabla import_jobs: si el proceso se corta, volver a ejecutar el mismo
+# --job reanuda desde la última fila confirmada.
+
+import argparse
+import csv
+import os
+import sys
+import time
+from datetime import datetime
+
+import pandas as pd
+
+import db
+import models
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# Encabezados habituales en las planillas de las plantas -> columna de tickets
+HEADER_ALIASES = {
+    "título": "titulo",
+    "asunto": "titulo",
+    "descripción": "descripcion",
+    "detalle": "descripcion",
+    "área": "area_destino",
+    "area": "area_destino",
+    "área destino": "area_destino",
+    "categoría": "categoria",
+    "subcategoría": "subcategoria",
+    "división": "division",
+    "urgencia": "urgencia_sugerida",
+    "responsable": "responsable_asignado",
+    "fecha": "created_at",
+    "fecha creación": "created_at",
+    "fecha cierre": "closed_at",
+}
+
+# columna -> código de catálogo maestro contra el que se valida
+CATALOG_COLUMNS = {
+    "area_destino": "areas",
+    "categoria": "categorias",
+    "prioridad": "prioridades",
+    "urgencia_sugerida": "prioridades",
+    "division": "divisiones",
+    "planta": "plantas",
+}
+
+DATE_FORMATS = ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%d/%m/%Y %H:%M", "%d/%m/%Y"]
+
+
+def load_catalogs():
+    """Retorna {catalogo: {label_en_minusculas: label}} para validar filas."""
+    snapshot = db.get_catalog_snapshot()
+    catalogs = {}
+    for code in set(CATALOG_COLUMNS.values()):
+        catalogs[code] = {label.lower(): label for label in snapshot.labels(code)}
+    catalogs["subcategorias"] = {
+        cat: {sub.lower(): sub for sub in subs}
+        for cat, subs in snapshot.subcategories_map().items()
+    }
+    catalogs["estados"] = {e.lower(): e for e in models.ESTADOS_TICKET}
+    return catalogs
+
+
+def build_header_map(headers, column_map=None):
+    """Resuelve encabezado del archivo -> columna de tickets (None = ignorar)."""
+    column_map = {k.strip().lower(): v for k, v in (column_map or {}).items()}
+    resolved = {}
+    for header in headers:
+        key = str(header).strip().lower()
+        target = column_map.get(key) or HEADER_ALIASES.get(key) or key
+        resolved[header] = target if target in db.IMPORT_TICKET_COLUMNS else None
+    return resolved
+
+
+def _parse_date(value):
+    if isinstance(value, datetime):
+        return value
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    return datetime.fromisoformat(value)
+
+
+def validate_row(raw, header_map, catalogs):
+    """
+    Mapea y valida una fila del archivo.
+    Retorna (ticket_dict, None) si es válida o (None, motivo) si se rechaza.
+    """
+    data = {col: None for col in db.IMPORT_TICKET_COLUMNS}
+    for header, value in raw.items():
+        col = header_map.get(header)
+        if not col:
+            continue
+        if isinstance(value, str):
+            value = value.strip()
+        if value is None or value == "" or value != value:
+            continue
+        data[col] = value
+
+    errors = []
+    if not data["titulo"]:
+        errors.append("titulo vacío")
+    if not data["solicitante"]:
+        errors.append("solicitante vacío")
+
+    for col, code in CATALOG_COLUMNS.items():
+        value = data[col]
+        if value is None:
+            continue
+        canonical = catalogs[code].get(str(value).lower())
+        if canonical is None:
+            errors.append(f"{col} '{value}' no existe en {code}")
+        data[col] = canonical
+
+    if data["subcategoria"]:
+        subs = catalogs["subcategorias"].get(data["categoria"], {})
+        canonical = subs.get(str(data["subcategoria"]).lower())
+        if canonical is None:
+            errors.append(
+                f"subcategoria '{data['subcategoria']}' no pertenece a '{data['categoria']}'"
+            )
+        data["subcategoria"] = canonical
+
+    estado = catalogs["estados"].get(str(data["estado"] or "NUEVO").lower())
+    if estado is None:
+        errors.append(f"estado '{data['estado']}' inválido")
+    data["estado"] = estado
+    data["prioridad"] = data["prioridad"] or "Media"
+
+    for col in ("created_at", "closed_at"):
+        if data[col] is None:
+            continue
+        try:
+            data[col] = _parse_date(data[col])
+        except (TypeError, ValueError):
+            errors.append(f"{col} '{data[col]}' no es una fecha válida")
+
+    if errors:
+        return None, "; ".join(errors)
+    return data, None
+
+
+def iter_chunks(path, chunk_size, skip_rows=0, sheet=None, sep=",", encoding="utf-8-sig"):
+    """
+    Genera (numero_primera_fila, [dict, ...]) leyendo el archivo por bloques.
+    Los números de fila son 1-based y no cuentan el encabezado.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    row_number = skip_rows + 1
+    if ext in (".xlsx", ".xlsm"):
+        if openpyxl is None:
+            raise RuntimeError("Para importar Excel se requiere el paquete openpyxl.")
+        wb = openpyxl.load_workbook(path, read_only=True, data_only=True)
+        try:
+            ws = wb[sheet] if sheet else wb.worksheets[0]
+            rows = ws.iter_rows(values_only=True)
+            headers = [str(h).strip() if h is not None else "" for h in next(rows, [])]
+            chunk = []
+            for idx, values in enumerate(rows):
+                if idx < skip_rows:
+                    continue
+                chunk.append(dict(zip(headers, values)))
+                if len(chunk) >= chunk_size:
+                    yield row_number, chunk
+                    row_number += len(chunk)
+                    chunk = []
+            if chunk:
+                yield row_number, chunk
+        finally:
+            wb.close()
+        return
+
+    reader = pd.read_csv(
+        path,
+        sep=sep,
+        encoding=encoding,
+        dtype=str,
+        keep_default_na=False,
+        chunksize=chunk_size,
+        skiprows=(lambda i: 0 < i <= skip_rows) if skip_rows else None,
+    )
+    with reader:
+        for df in reader:
+            records = df.to_dict("records")
+            yield row_number, records
+            row_number += len(records)
+
+
+def _write_rejects(rejects_path, job_key):
+    """
+    Escribe el CSV de rechazos desde import_rejects (se guardan en la misma
+    transacción que cada lote, así un lote reintentado no los duplica).
+    """
+    if not rejects_path:
+        return
+    rejected = db.get_import_rejects(job_key)
+    if not rejected:
+        return
+    with open(rejects_path, "w", newline="", encoding="utf-8") as f:
+        writer = csv.writer(f)
+        writer.writerow(["fila", "motivo", "datos"])
+        for row_number, reason, raw in rejected:
+            writer.writerow([row_number, reason, raw])
+
+
+def import_file(
+    path,
+    job_key=None,
+    chunk_size=DEFAULT_CHUNK_SIZE,
+    column_map=None,
+    author="Migración",
+    rejects_path=None,
+    progress=None,
+    sheet=None,
+    sep=",",
+    encoding="utf-8-sig",
+):
+    """
+    Importa tickets desde un CSV/XLSX en bloques de chunk_size filas.
+    progress: callable opcional que recibe un dict con el avance tras cada lote.
+    Retorna el estado final del job (ver db.get_import_job).
+    """
+    job_key = job_key or os.path.splitext(os.path.basename(path))[0]
+    job = db.start_import_job(job_key, os.path.abspath(path))
+    if job["status"] == "FINALIZADO":
+        return job
+
+    catalogs = load_catalogs()
+    rows_done = job["rows_done"]
+    imported = job["rows_imported"]
+    rejected_total = job["rows_rejected"]
+    header_map = None
+    started = time.monotonic()
+
+    try:
+        for first_row, records in iter_chunks(
+            path, chunk_size, skip_rows=rows_done, sheet=sheet, sep=sep, encoding=encoding
+        ):
+            if header_map is None and records:
+                header_map = build_header_map(records[0].keys(), column_map)
+
+            valid, rejected = [], []
+            for offset, raw in enumerate(records):
+                row_number = first_row + offset
+                data, error = validate_row(raw, header_map, catalogs)
+                if error:
+                    rejected.append((row_number, error, raw))
+                else:
+                    valid.append((row_number, data))
+
+            rows_done = first_row + len(records) - 1
+            imported += db.bulk_insert_tickets(
+                job_key, valid, rows_done, author=author, rejects=rejected
+            )
+            rejected_total += len(rejected)
+
+            if progress:
+                elapsed = time.monotonic() - started
+                progress(
+                    {
+                        "job_key": job_key,
+                        "rows_done": rows_done,
+                        "rows_imported": imported,
+                        "rows_rejected": rejected_total,
+                        "elapsed_s": elapsed,
+                    }
+                )
+    except Exception:
+        db.finish_import_job(job_key, status="ERROR")
+        _write_rejects(rejects_path, job_key)
+        raise
+
+    db.finish_import_job(job_key)
+    _write_rejects(rejects_path, job_key)
+    return db.get_import_job(job_key)
+
+
+def _print_progress(p):
+    print(
+        f"[{p['job_key']}] filas {p['rows_done']} | importadas {p['rows_imported']}"
+        f" | rechazadas {p['rows_rejected']} | {p['elapsed_s']:.1f}s",
+        file=sys.stderr,
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Importación masiva de tickets GESTAR")
+    parser.add_argument("archivo", help="CSV o XLSX con las solicitudes a migrar")
+    parser.add_argument("--job", help="Identificador del job (default: nombre del archivo)")
+    parser.add_argument("--chunk", type=int, default=DEFAULT_CHUNK_SIZE)
+    parser.add_argument(
+        "--map",
+        action="append",
+        default=[],
+        metavar="ENCABEZADO=COLUMNA",
+        help="Mapeo de columnas adicional (repetible)",
+    )
+    parser.add_argument("--autor", default="Migración")
+    parser.add_argument("--rechazos", help="CSV donde registrar filas rechazadas")
+    parser.add_argument("--hoja", help="Hoja del Excel (default: la primera)")
+    parser.add_argument("--sep", default=",")
+    args = parser.parse_args(argv)
+
+    column_map = {}
+    for item in args.map:
+        if "=" not in item:
+            parser.error(f"Mapeo inválido: {item}")
+        k, v = item.split("=", 1)
+        column_map[k] = v.strip()
+
+    db.init_db()
+    job = import_file(
+        args.archivo,
+        job_key=args.job,
+        chunk_size=args.chunk,
+        column_map=column_map,
+        author=args.autor,
+        rejects_path=args.rechazos,
+        progress=_print_progress,
+        sheet=args.hoja,
+        sep=args.sep,
+    )
+    print(
+        f"Importación {job['job_key']}: {job['status']} - "
+        f"{job['rows_imported']} importadas, {job['rows_rejected']} rechazadas."
+    )
+
+
+if __name__ == "__main__":
+    main()
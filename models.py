@@ -149,6 +149,8 @@ SUBCATEGORIAS = {
 }
 
 PRIORIDADES = ["Baja", "Media", "Alta", "Crítica"]
+# Horas para resolver según prioridad (valor inicial de la maestra; editable en ADMIN)
+SLA_HORAS = {"Baja": 168, "Media": 72, "Alta": 24, "Crítica": 4}
 ESTADOS_TICKET = ["NUEVO", "ASIGNADO", "EN PROCESO", "RESUELTO", "CERRADO"]
 ESTADOS_TAREA = ["PENDIENTE", "EN PROCESO", "COMPLETADA", "CANCELADA"]
 ROLES = ["Solicitante", "Analista", "Jefe", "Director", "Administrador"]
@@ -0,0 +1,195 @@
+# outbox.py
+# Entrega de los eventos de tickets (tabla outbox) a integraciones
+#
+# Uso:
+#   python outbox.py --sinks stdout,file:eventos.jsonl            # una pasada
+#   python outbox.py --sinks stdout --intervalo 5                 # en bucle
+#
+# create_ticket/update_ticket/importación escriben sus eventos en outbox dentro
+# de la misma transacción, así la latencia de la app no depende de cuántas
+# integraciones haya. El Dispatcher lee el outbox por cursor de id, en lotes,
+# para cada sink por separado (uno lento o caído no frena a los demás). Un
+# evento que falla se reintenta con espera creciente y, tras MAX_ATTEMPTS
+# intentos, pasa a outbox_dead_letter. La entrega es "al menos una vez": un
+# sink puede recibir de nuevo un evento si falla después de entregarlo.
+
+import argparse
+import json
+import logging
+import os
+import sys
+import threading
+import time
+
+import db
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = int(os.environ.get("GESTAR_OUTBOX_BATCH", "100"))
+MAX_ATTEMPTS = int(os.environ.get("GESTAR_OUTBOX_MAX_ATTEMPTS", "5"))
+MAX_BACKOFF = 300
+
+
+class Sink:
+    """Destino de eventos. deliver recibe una lista de eventos (dicts)."""
+
+    name = None
+
+    def deliver(self, events):
+        raise NotImplementedError
+
+
+class StdoutSink(Sink):
+    name = "stdout"
+
+    def deliver(self, events):
+        for event in events:
+            sys.stdout.write(json.dumps(event, default=str) + "\n")
+        sys.stdout.flush()
+
+
+class FileSink(Sink):
+    """Agrega los eventos como líneas JSON a un archivo local."""
+
+    def __init__(self, path):
+        self.path = path
+        self.name = f"file:{path}"
+
+    def deliver(self, events):
+        with open(self.path, "a", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, default=str) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+
+_registered = {}
+
+
+def register_sink(sink):
+    """Registra un sink propio (p. ej. mail a responsables de área)."""
+    _registered[sink.name] = sink
+
+
+def build_sinks(spec=None):
+    """
+    Sinks a partir de GESTAR_OUTBOX_SINKS (o spec), separados por coma:
+    "stdout", "file:<ruta>", o el nombre de un sink registrado.
+    """
+    spec = os.environ.get("GESTAR_OUTBOX_SINKS", "") if spec is None else spec
+    sinks = []
+    for item in (s.strip() for s in spec.split(",")):
+        if not item:
+            continue
+        if item == "stdout":
+            sinks.append(StdoutSink())
+        elif item.startswith("file:"):
+            sinks.append(FileSink(item[len("file:"):]))
+        elif item in _registered:
+            sinks.append(_registered[item])
+        else:
+            logger.warning(f"Outbox: sink desconocido '{item}'")
+    return sinks
+
+
+class Dispatcher:
+    def __init__(self, sinks, batch_size=BATCH_SIZE, max_attempts=MAX_ATTEMPTS):
+        self.sinks = sinks
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._retry_at = {}
+        self._lock = threading.Lock()
+
+    def dispatch_once(self):
+        """Una pasada por todos los sinks. Retorna {sink: eventos entregados}."""
+        with self._lock:
+            return {sink.name: self._dispatch_sink(sink) for sink in self.sinks}
+
+    def _dispatch_sink(self, sink):
+        if self._retry_at.get(sink.name, 0) > time.monotonic():
+            return 0
+        last_id, attempts, _ = db.get_outbox_cursor(sink.name)
+        delivered = 0
+        while True:
+            events = db.fetch_outbox(last_id, self.batch_size)
+            if not events:
+                return delivered
+            try:
+                sink.deliver(events)
+            except Exception:
+                # Reintentar de a uno para aislar el evento que falla
+                return delivered + self._deliver_each(sink, events, last_id, attempts)
+            last_id = events[-1]["id"]
+            attempts = 0
+            db.save_outbox_cursor(sink.name, last_id)
+            delivered += len(events)
+            if len(events) < self.batch_size:
+                return delivered
+
+    def _deliver_each(self, sink, events, last_id, attempts):
+        delivered = 0
+        for event in events:
+            try:
+                sink.deliver([event])
+            except Exception as e:
+                attempts += 1
+                if attempts >= self.max_attempts:
+                    logger.error(
+                        f"Outbox: evento {event['id']} descartado para '{sink.name}' "
+                        f"tras {attempts} intentos: {e}"
+                    )
+                    db.dead_letter_event(sink.name, event, attempts, e)
+                    last_id, attempts = event["id"], 0
+                    continue
+                logger.warning(f"Outbox: '{sink.name}' falló (intento {attempts}): {e}")
+                db.save_outbox_cursor(sink.name, last_id, attempts, e)
+                self._retry_at[sink.name] = time.monotonic() + min(
+                    2**attempts, MAX_BACKOFF
+                )
+                return delivered
+            last_id, attempts = event["id"], 0
+            db.save_outbox_cursor(sink.name, last_id)
+            delivered += 1
+        return delivered
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def dispatch_pending():
+    """Job del scheduler: entrega lo pendiente a los sinks configurados."""
+    global _dispatcher
+    with _dispatcher_lock:
+        if _dispatcher is None:
+            _dispatcher = Dispatcher(build_sinks())
+    if not _dispatcher.sinks:
+        return None
+    return _dispatcher.dispatch_once()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Entrega de eventos del outbox GESTAR")
+    parser.add_argument(
+        "--sinks",
+        default=os.environ.get("GESTAR_OUTBOX_SINKS", "stdout"),
+        help="stdout, file:<ruta> (separados por coma)",
+    )
+    parser.add_argument("--lote", type=int, default=BATCH_SIZE)
+    parser.add_argument(
+        "--intervalo", type=float, default=0, help="Segundos entre pasadas (0 = una sola)"
+    )
+    args = parser.parse_args(argv)
+
+    db.init_db()
+    dispatcher = Dispatcher(build_sinks(args.sinks), batch_size=args.lote)
+    while True:
+        result = dispatcher.dispatch_once()
+        print(f"Entregados: {result}", file=sys.stderr)
+        if not args.intervalo:
+            break
+        time.sleep(args.intervalo)
+
+
+if __name__ == "__main__":
+    main()
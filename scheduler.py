@@ -0,0 +1,217 @@
+# scheduler.py
+# Jobs periódicos de mantenimiento dentro del proceso de la app
+#
+# Cada proceso (instancia de App Service, worker de Streamlit) arranca un hilo
+# scheduler. Los jobs de mantenimiento de la base corren sólo en el líder: la
+# instancia que tiene el lease 'scheduler' (fila en scheduler_lease, renovada
+# en cada vuelta y con vencimiento, así otra instancia toma el relevo si el
+# líder se cae). Los jobs locales (p. ej. precargar cachés del proceso) corren
+# en todas las instancias. Cada ejecución queda registrada en job_runs.
+
+import atexit
+import logging
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timezone
+
+import streamlit as st
+
+import db
+import outbox
+
+logger = logging.getLogger(__name__)
+
+LEASE_NAME = "scheduler"
+LEASE_TTL = int(os.environ.get("GESTAR_SCHEDULER_LEASE_TTL", "60"))
+TICK_SECONDS = int(os.environ.get("GESTAR_SCHEDULER_TICK", "10"))
+
+
+class Job:
+    def __init__(self, name, interval_s, fn, leader_only=True, record=True):
+        self.name = name
+        self.interval_s = interval_s
+        self.fn = fn
+        self.leader_only = leader_only
+        self.record = record
+        self.last_run = None
+
+
+def _env_interval(var, default):
+    return int(os.environ.get(var, str(default)))
+
+
+# name, intervalo (segundos, 0 = desactivado), función, sólo en el líder,
+# registrar en job_runs (los jobs de pocos segundos no se registran)
+JOBS = [
+    Job("sla_rollup", _env_interval("GESTAR_SLA_ROLLUP_INTERVAL", 300), db.refresh_sla_rollups),
+    Job(
+        "ticket_counters",
+        _env_interval("GESTAR_COUNTERS_RECONCILE_INTERVAL", 900),
+        db.reconcile_ticket_counters,
+    ),
+    Job(
+        "log_transitions_backfill",
+        _env_interval("GESTAR_TRANSITIONS_BACKFILL_INTERVAL", 600),
+        db.backfill_log_transitions,
+    ),
+    Job(
+        "sla_escalation",
+        _env_interval("GESTAR_ESCALATION_INTERVAL", 300),
+        db.escalate_overdue_tickets,
+    ),
+    Job("archive", _env_interval("GESTAR_ARCHIVE_INTERVAL", 3600), db.archive_closed_tickets),
+    Job(
+        "log_retention",
+        _env_interval("GESTAR_LOG_RETENTION_INTERVAL", 86400),
+        db.run_log_retention,
+    ),
+    Job("optimize", _env_interval("GESTAR_OPTIMIZE_INTERVAL", 21600), db.optimize_database),
+    Job("job_runs_prune", 86400, db.prune_job_runs),
+    Job(
+        "outbox_dispatch",
+        _env_interval("GESTAR_OUTBOX_INTERVAL", 5),
+        outbox.dispatch_pending,
+        record=False,
+    ),
+    Job("outbox_prune", 86400, db.prune_outbox),
+    Job(
+        "prewarm_caches",
+        _env_interval("GESTAR_PREWARM_INTERVAL", 60),
+        db.prewarm_caches,
+        leader_only=False,
+    ),
+    Job(
+        "replica_heartbeat",
+        _env_interval("GESTAR_REPLICA_HEARTBEAT_INTERVAL", 5),
+        db.write_replica_heartbeat,
+        record=False,
+    ),
+    Job(
+        "sqlite_replica_sync",
+        _env_interval("GESTAR_SQLITE_REPLICA_SYNC", 15) if os.environ.get("GESTAR_SQLITE_READ_DB") else 0,
+        db.sync_sqlite_replica,
+        record=False,
+    ),
+]
+
+
+def _now():
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+class Scheduler:
+    def __init__(self, jobs):
+        self.jobs = [j for j in jobs if j.interval_s > 0]
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.is_leader = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="gestar-scheduler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        self._stop.set()
+        if self.is_leader:
+            self.is_leader = False
+            try:
+                db.release_lease(LEASE_NAME, self.holder)
+            except Exception:
+                pass
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self._tick()
+            except Exception as e:
+                logger.error(f"Scheduler: error en la vuelta: {e}")
+            self._stop.wait(TICK_SECONDS)
+
+    def _tick(self):
+        was_leader = self.is_leader
+        self.is_leader = db.acquire_lease(LEASE_NAME, self.holder, LEASE_TTL)
+        if self.is_leader and not was_leader:
+            logger.info(f"Scheduler: {self.holder} es el líder")
+            # Retomar el calendario del líder anterior
+            last = db.get_last_job_runs()
+            for job in self.jobs:
+                if job.leader_only:
+                    job.last_run = last.get(job.name)
+
+        for job in self.jobs:
+            if self._stop.is_set():
+                return
+            if job.leader_only and not self.is_leader:
+                continue
+            now = _now()
+            if job.last_run and (now - job.last_run).total_seconds() < job.interval_s:
+                continue
+            # Renovar antes de cada job: uno lento no debe dejar vencer el
+            # lease a mitad de la vuelta mientras otra instancia lo toma
+            if job.leader_only and not self._renew():
+                return
+            self._run(job)
+
+    def _renew(self):
+        try:
+            self.is_leader = db.acquire_lease(LEASE_NAME, self.holder, LEASE_TTL)
+        except Exception as e:
+            logger.error(f"Scheduler: no se pudo renovar el lease: {e}")
+            self.is_leader = False
+        if not self.is_leader:
+            logger.warning(f"Scheduler: {self.holder} perdió el lease")
+        return self.is_leader
+
+    def _run(self, job):
+        started = _now()
+        job.last_run = started
+        status, detail = "OK", None
+        try:
+            if job.leader_only:
+                # Marcas de agua y cursores sólo avanzan con el lease vigente
+                with db.lease_fence(LEASE_NAME, self.holder):
+                    detail = job.fn()
+            else:
+                detail = job.fn()
+        except Exception as e:
+            status, detail = "ERROR", e
+            logger.error(f"Job '{job.name}' falló: {e}")
+        if job.leader_only and (job.record or status != "OK"):
+            db.record_job_run(job.name, self.holder, started, _now(), status, detail)
+
+
+@st.cache_resource(show_spinner=False)
+def _get_scheduler():
+    scheduler = Scheduler(JOBS)
+    scheduler.start()
+    return scheduler
+
+
+def start():
+    """Arranca (una sola vez por proceso) el scheduler. GESTAR_SCHEDULER=0 lo desactiva."""
+    if os.environ.get("GESTAR_SCHEDULER", "1").lower() in ("0", "false", "no"):
+        return None
+    return _get_scheduler()
+
+
+def status():
+    """Estado para ADMIN: líder actual, si este proceso lo es y los jobs."""
+    lease = db.get_lease(LEASE_NAME)
+    scheduler = start()
+    return {
+        "leader": lease[0] if lease else None,
+        "lease_expires_at": lease[1] if lease else None,
+        "this_process": scheduler.holder if scheduler else None,
+        "jobs": [
+            {
+                "job": j.name,
+                "intervalo_s": j.interval_s,
+                "solo_lider": j.leader_only,
+                "ultima_ejecucion": j.last_run,
+            }
+            for j in (scheduler.jobs if scheduler else [])
+        ],
+    }